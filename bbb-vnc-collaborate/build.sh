@@ -33,7 +33,7 @@ CONFFILES="--deb-no-default-config-files"
 # CONVENIENCE_DEPENDS="gnome-terminal,dbus-x11,chromium-browser,xournal"
 #
 # python3-posix-ipc is ours to declare, not python3-vnc-collaborate's: it is
-# imported lazily inside get_or_add_user(), for adduser < 3.137, and we are the
+# imported lazily by provision.py, for adduser < 3.137, and we are the
 # package that auto-creates users (the websockify proxy will create a UNIX
 # account for an unknown participant).
 #
@@ -47,6 +47,14 @@ except Exception:  # noqa: BLE001
     def fullName_to_UNIX_username(full_name):
         return full_name.replace(" ", "")
 
+# Desktops that have been idle may be frozen (vnc_collaborate/freezer.py);
+# without the collaborate package there's no freezer, so nothing to thaw.
+try:
+    from vnc_collaborate.freezer import thaw_desktop
+except Exception:  # noqa: BLE001
+    def thaw_desktop(rfbpath, by=None):
+        return None
+
 try:
     import bigbluebutton
 except Exception:  # noqa: BLE001
@@ -171,6 +179,11 @@ class MeetingSession:
                     "segment": seg,
                     "rfbport": rfbport_for_user(run_dir, user),
                 }
+                # a frozen desktop would never answer the recorder
+                try:
+                    thaw_desktop(sock, by="recorder")
+                except Exception as e:  # noqa: BLE001
+                    log("desktop %s: thaw failed: %s" % (user, e))
                 rec = DesktopRecorder(
                     sock, out, identity=identity,
                     encoding=self.cfg["recording"]["encoding"],
@@ -32,7 +32,7 @@ cp grid-desktop.tmpfiles staging/usr/lib/tmpfiles.d/grid-desktop.conf
 # and as of 0.0.2+20260721 it does -- so we don't repeat it here.
 #
 # NOT python3-posix-ipc, despite bbb-vnc-collaborate declaring it: it is
-# imported lazily inside get_or_add_user(), on the auto-create-user path, and
+# imported lazily by provision.py, on the auto-create-user path, and
 # only for adduser < 3.137.  ensure_vnc_server never reaches it, and the code
 # comments that it "might not have posix_ipc installed".
 #
@@ -0,0 +1,325 @@
+"""bigbluebutton_roster - an indexed cache of the meetings on a Big Blue Button server
+
+getMeetings() returns the XML for every meeting on the server, and
+finding one attendee in it is a linear XPath scan.  Code that does
+that once per connection (the collaborate websockify proxy does it
+for every websocket) fetches and scans the whole server each time.
+
+A Roster keeps the last getMeetings() result parsed and indexed by
+userID, internalMeetingID and fullName, so lookups are dictionary
+lookups.  It refreshes itself when its snapshot is older than its
+refresh interval, and on demand when a userID lookup misses (a user
+who just joined), with concurrent misses coalesced into one fetch.
+
+Examples:
+
+    >>> import bigbluebutton_roster
+    >>> roster = bigbluebutton_roster.Roster()
+    >>> roster.user(userID)['fullName']
+    >>> [a['fullName'] for a in roster.meeting(internalMeetingID)['attendees']]
+
+Attendees and meetings are plain dicts, so that they can also be
+served to other processes.  A RosterServer serves one Roster over a
+UNIX-domain socket (newline-delimited JSON), and RosterClient has the
+same lookup methods as Roster, so several worker processes can share
+one cache.  shared_roster() returns a client if a server is running
+and a private Roster otherwise.  To run a server:
+
+    python3 -m bigbluebutton_roster [--socket PATH]
+
+Author: Brent Baccala <cosine@freesoft.org>
+License: GNU Lesser General Public License
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+import bigbluebutton
+
+ROSTER_SOCKET = os.environ.get('BBB_ROSTER_SOCKET', '/run/bigbluebutton-roster.sock')
+
+# Attendee and meeting fields copied out of the getMeetings XML.
+
+ATTENDEE_FIELDS = ['userID', 'fullName', 'role', 'isPresenter', 'hasJoinedVoice', 'hasVideo', 'clientType']
+MEETING_FIELDS = ['meetingName', 'meetingID', 'internalMeetingID', 'createTime', 'voiceBridge', 'running', 'isBreakout']
+
+def _text(element, tag):
+    child = element.find(tag)
+    if child is None:
+        return None
+    return child.text
+
+def parse_meetings(xml):
+    r"""
+    Index a getMeetings() XML response.  Returns a tuple of three dicts:
+    userID -> attendee, internalMeetingID -> meeting, fullName -> list of
+    attendees.  Each attendee also carries its meeting's meetingID,
+    internalMeetingID and createTime; each meeting carries a list of its attendees.
+    """
+    users = dict()
+    meetings = dict()
+    names = dict()
+
+    for m in xml.iter('meeting'):
+        meeting = {field: _text(m, field) for field in MEETING_FIELDS}
+        meeting['attendees'] = []
+        for a in m.iter('attendee'):
+            attendee = {field: _text(a, field) for field in ATTENDEE_FIELDS}
+            attendee['meetingID'] = meeting['meetingID']
+            attendee['internalMeetingID'] = meeting['internalMeetingID']
+            attendee['createTime'] = meeting['createTime']
+            meeting['attendees'].append(attendee)
+            users[attendee['userID']] = attendee
+            names.setdefault(attendee['fullName'], []).append(attendee)
+        meetings[meeting['internalMeetingID']] = meeting
+
+    return (users, meetings, names)
+
+class Roster:
+    r"""
+    Roster(interval=2, min_interval=0.5)
+
+    An indexed cache of getMeetings().  `interval` is how old (in seconds)
+    a snapshot can get before meeting lookups refresh it; `min_interval`
+    is the shortest time between two refreshes triggered by lookup misses.
+    """
+
+    def __init__(self, interval=2, min_interval=0.5, fetch=bigbluebutton.getMeetings):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.fetch = fetch
+
+        self.users = dict()
+        self.meetings = dict()
+        self.names = dict()
+        self.fetched_at = None
+
+        self.refresh_lock = threading.Lock()
+
+    def refresh(self, requested_at=None):
+        r"""
+        Fetch and index getMeetings().  If `requested_at` is given, skip the
+        fetch if a refresh that started after that time already finished;
+        this is what coalesces a burst of misses into a single fetch.
+        """
+        with self.refresh_lock:
+            if requested_at is not None and self.fetched_at is not None and self.fetched_at >= requested_at:
+                return
+            started = time.monotonic()
+            xml = self.fetch()
+            if isinstance(xml, str):
+                # _APIcall returns the raw text if the response wasn't XML
+                raise RuntimeError('getMeetings failed: ' + xml[:200])
+            # Swap in all three indexes at once; lookups never take the lock.
+            (self.users, self.meetings, self.names) = parse_meetings(xml)
+            self.fetched_at = started
+
+    def _age(self):
+        if self.fetched_at is None:
+            return None
+        return time.monotonic() - self.fetched_at
+
+    def _refresh_if_stale(self, max_age):
+        age = self._age()
+        if age is None or age > max_age:
+            self.refresh(time.monotonic() - max_age)
+
+    def _refresh_after_miss(self):
+        age = self._age()
+        if age is None or age > self.min_interval:
+            self.refresh(time.monotonic())
+
+    def user(self, userID):
+        r"""
+        Return the attendee dict for `userID`, or None.  A userID never
+        changes its name or meeting, so any snapshot that has it will do;
+        a miss refreshes the snapshot (a user who just joined).
+        """
+        attendee = self.users.get(userID)
+        if attendee is None:
+            self._refresh_after_miss()
+            attendee = self.users.get(userID)
+        return attendee
+
+    def meeting(self, internalMeetingID):
+        r"""
+        Return the meeting dict (with its 'attendees' list) for
+        `internalMeetingID`, or None, from a snapshot at most `interval`
+        seconds old.
+        """
+        self._refresh_if_stale(self.interval)
+        return self.meetings.get(internalMeetingID)
+
+    def users_named(self, fullName):
+        r"""
+        Return the list of attendees (across all meetings) named `fullName`.
+        """
+        self._refresh_if_stale(self.interval)
+        return self.names.get(fullName, [])
+
+#
+# Sharing a Roster between processes
+#
+
+class RosterRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        roster = self.server.roster
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if 'user' in request:
+                    result = roster.user(request['user'])
+                elif 'meeting' in request:
+                    result = roster.meeting(request['meeting'])
+                elif 'fullName' in request:
+                    result = roster.users_named(request['fullName'])
+                else:
+                    result = None
+                response = {'result': result}
+            except Exception as ex:
+                response = {'error': repr(ex)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+class RosterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    r"""
+    RosterServer(path, roster)
+
+    Serve `roster` on the UNIX-domain socket `path`.  Only root and the
+    socket's owner can connect (mode 0600), since the roster holds every
+    attendee's name.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, roster):
+        self.roster = roster
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(path, RosterRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+class RosterClient:
+    r"""
+    RosterClient(path)
+
+    Roster's lookup methods, answered by a RosterServer on `path`.  Each
+    thread keeps its own connection to the server.
+    """
+
+    def __init__(self, path=ROSTER_SOCKET):
+        self.path = path
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, 'file', None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.local.file = sock.makefile('rwb')
+        return self.local.file
+
+    def _call(self, request):
+        for attempt in (1, 2):
+            try:
+                f = self._connection()
+                f.write(json.dumps(request).encode() + b'\n')
+                f.flush()
+                line = f.readline()
+                if not line:
+                    raise ConnectionError('roster server closed the connection')
+                break
+            except OSError:
+                # The server restarted since we connected; reconnect once
+                self.local.file = None
+                if attempt == 2:
+                    raise
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError('roster server: ' + response['error'])
+        return response['result']
+
+    def user(self, userID):
+        return self._call({'user': userID})
+
+    def meeting(self, internalMeetingID):
+        return self._call({'meeting': internalMeetingID})
+
+    def users_named(self, fullName):
+        return self._call({'fullName': fullName})
+
+def shared_roster(path=ROSTER_SOCKET):
+    r"""
+    Return a RosterClient if a RosterServer is answering on `path`,
+    otherwise a private Roster.
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.close()
+        return RosterClient(path)
+    except OSError:
+        return Roster()
+
+def serve(path=ROSTER_SOCKET, watch_parent=False):
+    r"""
+    Run a RosterServer on `path` until killed.  With `watch_parent`, also
+    exit when the process that started us exits.
+    """
+    parent = os.getppid()
+    server = RosterServer(path, Roster())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        while not watch_parent or os.getppid() == parent:
+            time.sleep(1)
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def start_roster_service(path=ROSTER_SOCKET):
+    r"""
+    Fork a process running a RosterServer on `path` that exits along with
+    the calling process, and wait for it to start answering.  Returns the
+    child's pid.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(path, watch_parent=True)
+        finally:
+            os._exit(0)
+    for _ in range(50):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.close()
+            break
+        except OSError:
+            if os.waitpid(pid, os.WNOHANG) != (0, 0):
+                # it died (can't bind the socket?); callers fall back to a private Roster
+                break
+            time.sleep(0.1)
+    return pid
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve an indexed cache of the Big Blue Button meetings')
+    parser.add_argument('-s', '--socket', default=ROSTER_SOCKET, help="UNIX socket to listen on")
+    args = parser.parse_args()
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -27,7 +27,7 @@ setuptools.setup(
     description="Big Blue Button API bindings",
     long_description=long_description,
     long_description_content_type="text/plain",
-    py_modules=['bigbluebutton'],
+    py_modules=['bigbluebutton', 'bigbluebutton_roster'],
     install_requires=['pyjavaproperties'],
     scripts=[
         'bbb-get-meetings',
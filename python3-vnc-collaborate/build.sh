@@ -19,15 +19,20 @@ cd python3-vnc-collaborate
 #
 # It was missing here for a long time without visible breakage, because
 # dependents (bbb-vnc-collaborate) declared it themselves and because
-# python3-vncdotool -> python3-pil *can* reach python3-tk via
-# python3-pil.imagetk.  That path is not reliable: python3-pil's dependency is
+# python3-vncdotool (which vnc.py used to need) -> python3-pil *can* reach
+# python3-tk via python3-pil.imagetk.  That path is not reliable: python3-pil's dependency is
 # the alternative `mime-support | python3-pil.imagetk`, and apt satisfies the
 # first branch, so a fresh install pulls mime-support and no tkinter.
 #
-# python3-posix-ipc is deliberately NOT here: it is imported lazily inside
-# get_or_add_user(), and only for adduser < 3.137.  It belongs to whoever
+# python3-posix-ipc is deliberately NOT here: it is imported lazily by
+# provision.py, and only for adduser < 3.137.  It belongs to whoever
 # actually auto-creates users -- bbb-vnc-collaborate -- which declares it.
-DEPENDS="python3-bigbluebutton,python3-lxml,python3-psutil,python3-service-identity,python3-vncdotool,python3-websockify,python3-psycopg2,python3-tk"
+#
+# python3-numpy is imported lazily, by rfbclient.py and grid_compositor.py,
+# but unlike posix_ipc it's this package's own teacher grid (in compositor
+# mode) that needs it, so it's declared here.  Likewise python3-xlib, which
+# x11.py imports when the teacher's grid starts watching its X display.
+DEPENDS="python3-bigbluebutton,python3-lxml,python3-numpy,python3-psutil,python3-xlib,python3-websockify,python3-websockets,python3-psycopg2,python3-tk"
 
 rm -f python3-vnc-collaborate*.deb
 fpm -s dir -C ./staging -n python3-vnc-collaborate \
@@ -31,12 +31,13 @@ setuptools.setup(
     install_requires=[
         'bigbluebutton',
         'websockify',
+        'websockets',
         'posix-ipc',
         'lxml',
         'psutil',
-        'vncdotool',
+        'numpy',
+        'python-xlib',
         'psycopg2-binary',
-        'service_identity'   # this is just here so twisted doesn't print warning messages
     ],
     scripts=[
         'scripts/set-gnome-terminal-fonts',
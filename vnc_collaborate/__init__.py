@@ -1,6 +1,8 @@
 
 from .teacher_desktop import teacher_desktop, project_to_students
 from .teacher_zoom import teacher_zoom
+from .grid_compositor import grid_compositor
+from .overlay import overlay
 from .student_desktop import student_desktop
 
 from .freeswitch import deaf_students, undeaf_students, mute_students, unmute_students
@@ -8,6 +10,12 @@ from .freeswitch import deaf_students, undeaf_students, mute_students, unmute_st
 from .student_audio_controls import student_audio_controls
 
 from .websockify import websockify
+from .warm_pool import warm_pool
+from .prewarm import prewarm
+from .provision import provision
+from .privileged import spawn_helper
+from .budgets import budgets
+from .thumbnails import thumbnail_service
 
 from .set_geometry import set_geometry
 
@@ -23,6 +23,10 @@ if len(sys.argv) > 1:
         student_desktop(*sys.argv[2:])
     elif sys.argv[1] == 'teacher_zoom':
         teacher_zoom(*sys.argv[2:])
+    elif sys.argv[1] == 'grid_compositor':
+        grid_compositor(*sys.argv[2:])
+    elif sys.argv[1] == 'overlay':
+        overlay(*sys.argv[2:])
     elif sys.argv[1] == 'project_to_students':
         project_to_students(*sys.argv[2:])
     elif sys.argv[1] == 'student_audio_controls':
@@ -41,6 +45,18 @@ if len(sys.argv) > 1:
         sys.exit(rfb_reject(*sys.argv[2:]))
     elif sys.argv[1] == 'websockify':
         websockify()
+    elif sys.argv[1] == 'warm_pool':
+        warm_pool(*sys.argv[2:])
+    elif sys.argv[1] == 'prewarm':
+        sys.exit(prewarm(*sys.argv[2:]))
+    elif sys.argv[1] == 'provision':
+        sys.exit(provision(*sys.argv[2:]))
+    elif sys.argv[1] == 'budgets':
+        sys.exit(budgets(*sys.argv[2:]))
+    elif sys.argv[1] == 'spawn-helper':
+        sys.exit(spawn_helper(*sys.argv[2:]))
+    elif sys.argv[1] == 'thumbnail-service':
+        sys.exit(thumbnail_service(*sys.argv[2:]))
     elif sys.argv[1] == 'tigervncserver':
         with pkg_resources.path(__package__, 'tigervncserver.pl') as tigervncserver:
             subprocess.run(['perl', '--', tigervncserver, *sys.argv[2:]])
@@ -0,0 +1,277 @@
+#
+# An asyncio front end for the websockify proxy
+# (python3 -m vnc_collaborate websockify --async).
+#
+# The websockify library forks a multiprocessing.Process for every
+# websocket connection.  At class start, 30-60 students connect at
+# once, each with two websockets (the BBB remote-desktop plugin opens
+# two per page load), so the forking proxy ends up with 100+ Python
+# processes, each doing its own blocking checkAuthorization, its own
+# getMeetings and its own spawn wait.
+#
+# This front end serves every connection as a coroutine in a single
+# process.  The connection setup -- authentication, roster lookup,
+# user creation and the ensure_vnc_server spawn -- is the same code
+# the forking proxy runs (select_target in websockify.py); it blocks,
+# so it runs on a thread pool off the event loop.  That keeps the
+# flock-based spawn serialization exactly as it is: ensure_vnc_server
+# still takes its per-socket flock, and the kernel serializes those
+# locks between threads (each one open()s the lockfile separately)
+# just as it does between the forked processes.  The RFB relay itself
+# is pure asyncio.
+#
+# To use more than one core, --workers N forks N worker processes,
+# each running its own event loop on a listening socket bound with
+# SO_REUSEPORT, so the kernel load-balances new connections across
+# them.  The parent only supervises: it restarts a worker that dies
+# and passes SIGTERM on to the workers (the systemd unit uses
+# KillMode=process, so nobody else would).
+#
+# Uses the 'websockets' package (python3-websockets), either its
+# current asyncio API or the legacy one shipped with Ubuntu 22.04.
+
+import os
+import signal
+import asyncio
+import argparse
+import concurrent.futures
+
+import bigbluebutton_roster
+
+from .services import error
+from .websockify import select_target, launch_inetd
+from .rfb_reject import PROTOCOL_VERSION, reject_message
+from .metrics import ConnectionMetrics, start_metrics_service
+from .warm_pool import start_warm_pool
+from .prewarm import start_prewarm_service
+from .privileged import start_helper_service
+from .freezer import start_freezer
+from .budgets import start_budget_keeper
+from .thumbnails import start_thumbnail_service
+
+# BigBlueButton 2.7 (or maybe 2.6) introduced the use of haproxy with
+# a 60 second timeout, so we ping every 30 seconds, just like the
+# --heartbeat option we pass to the forking websockify.
+
+HEARTBEAT = 30
+
+# select_target blocks for up to ensure_vnc_server's 40 second bound,
+# so at class start every connecting student holds a thread for the
+# length of their spawn.  The default executor (a handful of threads)
+# would queue most of the class behind the first few spawns.
+
+SETUP_THREADS = int(os.environ.get('VNC_ASYNC_THREADS', '128'))
+
+RELAY_BUFFER_SIZE = 65536
+
+executor = None
+
+def _request_info(websocket):
+    r"""
+    Return the (path, cookie) of a websocket's HTTP upgrade request,
+    for either websockets API.
+    """
+    if hasattr(websocket, 'request') and websocket.request is not None:
+        return (websocket.request.path, websocket.request.headers.get('Cookie', ''))
+    return (websocket.path, websocket.request_headers.get('Cookie', ''))
+
+async def relay(websocket, reader, writer, metrics):
+    r"""
+    Copy RFB bytes between the websocket and the VNC server's stream
+    until either side closes, counting them into `metrics`.
+    """
+
+    async def client_to_server():
+        async for message in websocket:
+            if isinstance(message, str):
+                message = message.encode()
+            metrics.bytes_in += len(message)
+            writer.write(message)
+            await writer.drain()
+
+    async def server_to_client():
+        while True:
+            data = await reader.read(RELAY_BUFFER_SIZE)
+            if not data:
+                break
+            metrics.bytes_out += len(data)
+            await websocket.send(data)
+
+    tasks = [asyncio.ensure_future(client_to_server()),
+             asyncio.ensure_future(server_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+async def reject(websocket, reason, timeout=10):
+    r"""
+    Refuse the connection at the RFB layer with `reason` (see
+    rfb_reject.py), speaking the handshake directly on the websocket.
+    """
+    async def client_version():
+        received = b''
+        async for message in websocket:
+            received += message if isinstance(message, bytes) else message.encode()
+            if len(received) >= len(PROTOCOL_VERSION):
+                break
+
+    await websocket.send(PROTOCOL_VERSION)
+    try:
+        await asyncio.wait_for(client_version(), timeout)
+    except asyncio.TimeoutError:
+        # like rfb_reject, send the reason anyway
+        pass
+    await websocket.send(reject_message(reason))
+    await websocket.close()
+
+async def handle_client(websocket, path=None):
+    loop = asyncio.get_running_loop()
+    (path, cookie) = _request_info(websocket)
+    metrics = ConnectionMetrics()
+
+    try:
+        target = await loop.run_in_executor(executor, select_target, path, cookie, metrics)
+        if target[0] == 'reject':
+            await reject(websocket, target[1])
+            metrics.finish('rejected')
+            return
+        with metrics.phase('connect'):
+            if target[0] == 'inetd':
+                sock = await loop.run_in_executor(executor, launch_inetd, *target[1:])
+                (reader, writer) = await asyncio.open_unix_connection(sock=sock)
+            elif target[0] == 'tcp':
+                (reader, writer) = await asyncio.open_connection(target[1], target[2])
+            else:
+                (reader, writer) = await asyncio.open_unix_connection(target[1])
+    except Exception as ex:
+        error('connection setup failed:', repr(ex))
+        metrics.finish('failed')
+        await websocket.close(1011, 'Failed to connect to downstream server')
+        return
+
+    metrics.setup_done()
+    try:
+        await relay(websocket, reader, writer, metrics)
+    finally:
+        metrics.finish('relayed')
+
+def _serve(host, port, reuse_port):
+    r"""
+    Return the websockets server for one worker, using whichever
+    websockets API is installed.
+    """
+    kwargs = dict(subprotocols=['binary'],
+                  ping_interval=HEARTBEAT,
+                  # noVNC doesn't negotiate permessage-deflate with websockify
+                  # either; compressing RFB (already compressed) only burns CPU
+                  compression=None,
+                  max_size=None,
+                  reuse_port=reuse_port)
+    try:
+        from websockets.asyncio.server import serve
+    except ImportError:
+        from websockets import serve
+    return serve(handle_client, host, port, **kwargs)
+
+async def worker_main(host, port, reuse_port):
+    stop = asyncio.get_running_loop().create_future()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    async with _serve(host, port, reuse_port):
+        await stop
+
+def run_worker(host, port, reuse_port):
+    global executor
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=SETUP_THREADS)
+    try:
+        asyncio.run(worker_main(host, port, reuse_port))
+    except KeyboardInterrupt:
+        pass
+
+def start_worker(host, port):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_worker(host, port, reuse_port=True)
+        finally:
+            os._exit(0)
+    return pid
+
+def supervise(host, port, num_workers):
+    r"""
+    Fork `num_workers` workers sharing the listen port and keep them
+    running until we're told to stop.
+    """
+    workers = set()
+    stopping = False
+
+    def stop_workers(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    for i in range(num_workers):
+        workers.add(start_worker(host, port))
+
+    while workers:
+        try:
+            (pid, status) = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in workers:
+            # one of the helper services (roster, warm pool, prewarm, metrics,
+            # spawn helper, freezer, budget keeper), not a worker
+            continue
+        workers.discard(pid)
+        if not stopping:
+            error('websockify worker', pid, 'exited with status', status, '- restarting it')
+            workers.add(start_worker(host, port))
+
+def _host_port(address):
+    if ':' in address:
+        (host, port) = address.rsplit(':', 1)
+    else:
+        (host, port) = ('', address)
+    return (host or None, int(port))
+
+def async_websockify(args):
+    parser = argparse.ArgumentParser(prog='vnc_collaborate websockify --async',
+                                     description='asyncio websocket-to-VNC proxy for BigBlueButton')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('VNC_ASYNC_WORKERS', '1')),
+                        help='number of SO_REUSEPORT worker processes (default 1)')
+    parser.add_argument('listen', help='[HOST:]PORT to listen on')
+    # The forking websockify takes a default target here; we always pick
+    # the target per connection, so it's accepted for compatibility and ignored.
+    parser.add_argument('target', nargs='?', help='ignored')
+    args = parser.parse_args(args)
+
+    (host, port) = _host_port(args.listen)
+
+    start_warm_pool()
+    start_prewarm_service()
+    start_metrics_service()
+    start_helper_service()
+    start_freezer()
+    start_budget_keeper()
+    start_thumbnail_service()
+
+    if args.workers <= 1:
+        run_worker(host, port, reuse_port=False)
+    else:
+        # The workers share one roster cache (see lookup_attendee in websockify.py)
+        bigbluebutton_roster.start_roster_service()
+        supervise(host, port, args.workers)
@@ -0,0 +1,133 @@
+#
+# A short-lived cache of bbb-web checkAuthorization results, used by
+# the websockify proxy (see check_authorization in websockify.py).
+#
+# The BBB remote-desktop plugin opens two websockets per page load
+# and reconnects often, and every one of those connections used to
+# make its own fresh HTTP request to bbb-web's Grails stack.  We keep
+# a bounded LRU of recent answers keyed on the session token plus the
+# JSESSIONID cookie -- the two things checkAuthorization validates --
+# and make the requests that do go through over a pooled keep-alive
+# session.
+#
+# Successful answers are cached for VNC_AUTH_CACHE_TTL seconds (from
+# /etc/default/bbb-vnc-collaborate, default 10), refusals (401) for
+# VNC_AUTH_CACHE_NEGATIVE_TTL (default 2), so a reconnect storm from
+# an expired page doesn't reach bbb-web either.  Any other status
+# (bbb-web restarting, a 500) is never cached.  Keep both TTLs short:
+# an ended session stays authorized until its entry expires.
+#
+# The cache lives in the process that serves the connection, so it
+# pays off with the asyncio front end (websockify --async), where one
+# process serves every connection.  The forking front end starts each
+# connection in a fresh child, which gets an empty cache.
+#
+# Every lookup is counted, as a hit or a miss, in the metrics collector's
+# vnc_auth_cache_lookups_total (see metrics.py); requests that carry no
+# cache key aren't looked up, and count as "uncached".
+
+import os
+import time
+import threading
+import urllib.parse
+import collections
+
+import requests
+
+from . import metrics
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return float(default)
+
+def _count(result):
+    metrics.send([{'name': 'vnc_auth_cache_lookups_total', 'labels': {'result': result}, 'value': 1}])
+
+class AuthCache:
+    r"""
+    AuthCache(url, ttl, negative_ttl, max_entries)
+
+    check(path, cookie) returns the (userID, meetingID) tuple that
+    checkAuthorization at `url` returned for this session, or None if
+    it refused the session.
+    """
+
+    def __init__(self, url, ttl=10, negative_ttl=2, max_entries=1024):
+        self.url = url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def key(path, cookie):
+        r"""
+        The cache key: the sessionToken from the request path plus the
+        JSESSIONID cookie.  Returns None if the request carries neither,
+        so that it's passed straight through to bbb-web.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        token = query.get('sessionToken', [None])[0]
+        jsessionid = None
+        for crumb in cookie.split(';'):
+            (name, _, value) = crumb.strip().partition('=')
+            if name == 'JSESSIONID':
+                jsessionid = value
+        if token is None and jsessionid is None:
+            return None
+        return (token, jsessionid)
+
+    def _lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                (expires, result) = self.entries[key]
+                if time.monotonic() < expires:
+                    self.entries.move_to_end(key)
+                    return (True, result)
+                del self.entries[key]
+            return (False, None)
+
+    def _store(self, key, result, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def check(self, path, cookie):
+        key = self.key(path, cookie)
+        if key is None:
+            _count('uncached')
+        else:
+            (found, result) = self._lookup(key)
+            _count('hit' if found else 'miss')
+            if found:
+                return result
+
+        resp = self.session.get(self.url,
+                                headers={'X-Original-URI': path,
+                                         'Cookie': cookie},
+                                allow_redirects=False)
+        if resp.status_code == 200:
+            result = (resp.headers['User-Id'], resp.headers['Meeting-Id'])
+            if key is not None:
+                self._store(key, result, self.ttl)
+            return result
+
+        if resp.status_code == 401 and key is not None:
+            self._store(key, None, self.negative_ttl)
+        return None
+
+def auth_cache_from_environment(url):
+    return AuthCache(url,
+                     ttl=_env_float('VNC_AUTH_CACHE_TTL', 10),
+                     negative_ttl=_env_float('VNC_AUTH_CACHE_NEGATIVE_TTL', 2),
+                     max_entries=int(_env_float('VNC_AUTH_CACHE_SIZE', 1024)))
@@ -0,0 +1,263 @@
+#
+# Per-desktop resource budgets.
+#
+# Every desktop on a host shares its CPUs, memory and disk, so one
+# student compiling something, or playing a video in a browser, slows
+# down everybody else's desktop -- including the teacher's grid, which
+# is showing all of them.  So each desktop gets a budget, by role:
+#
+#   teacher     the desktops of teachers (group bigbluebutton)
+#   projected   the desktop the teacher is projecting to the class (the
+#               vnc_screenshare table), and the meetings' shared desktops,
+#               which everyone is looking at
+#   student     everyone else's
+#
+# A budget is a list of systemd resource-control properties, set with
+# `systemctl set-property --runtime` on the user's slice (user-UID.slice,
+# which holds their desktop session, as in freezer.py), from
+# VNC_BUDGET_TEACHER, VNC_BUDGET_PROJECTED and VNC_BUDGET_STUDENT.
+# CPUWeight and IOWeight are relative shares, only felt when the host is
+# busy, so a student's desktop can still use an idle machine; MemoryHigh
+# is where the kernel starts throttling and reclaiming a slice's memory.
+#
+# start_VNC_server gives a new desktop its budget (in the background,
+# so the connection doesn't wait for systemctl, and through the spawn
+# helper, privileged.py, if the proxy isn't root), and a root proxy forks a
+# budget keeper (like its other helper services) that moves desktops
+# between budgets as their roles change: it LISTENs for vnc_screenshare
+# notifications, so the projected desktop is boosted as soon as the
+# teacher projects it, and looks at every desktop every BUDGET_POLL
+# seconds.  To see the budgets and what the desktops are using:
+#
+#     python3 -m vnc_collaborate budgets
+
+import os
+import grp
+import pwd
+import stat
+import time
+import select
+import threading
+import subprocess
+
+from .services import error, start_service
+
+BUDGETS = {
+    'teacher': os.environ.get('VNC_BUDGET_TEACHER', 'CPUWeight=400 IOWeight=400 MemoryHigh=infinity').split(),
+    'projected': os.environ.get('VNC_BUDGET_PROJECTED', 'CPUWeight=400 IOWeight=400 MemoryHigh=infinity').split(),
+    'student': os.environ.get('VNC_BUDGET_STUDENT', 'CPUWeight=100 IOWeight=100 MemoryHigh=4G').split(),
+}
+
+# In order of budget, smallest first: a user with several desktops gets the
+# budget of the last of their roles here, so each role's budget (every one
+# of its properties) should be at least as big as the one before's
+
+ROLES = ['student', 'teacher', 'projected']
+
+BUDGET_POLL = 10
+
+RUN_DIR = '/run/vnc'
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+def _unit(uid):
+    return 'user-{}.slice'.format(uid)
+
+def _is_teacher(UNIXuser):
+    try:
+        return UNIXuser in grp.getgrnam('bigbluebutton').gr_mem
+    except KeyError:
+        return False
+
+def desktop_role(UNIXuser):
+    r"""
+    The role whose budget `UNIXuser`'s desktop gets, unless it's being
+    projected.
+    """
+    if UNIXuser == 'default':
+        return 'projected'
+    if _is_teacher(UNIXuser):
+        return 'teacher'
+    return 'student'
+
+def apply_budget(uid, role):
+    r"""
+    Set user `uid`'s slice to the budget for `role`.  Returns True if
+    systemctl did.
+    """
+    proc = subprocess.run(['systemctl', 'set-property', '--runtime', _unit(uid)] + BUDGETS[role],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        error('budgets: setting', _unit(uid), 'to', role, 'failed:', proc.stderr.decode().strip())
+    return proc.returncode == 0
+
+def _budget_desktop(UNIXuser):
+    from .privileged import budget_desktop
+    try:
+        budget_desktop(UNIXuser)
+    except (OSError, KeyError, RuntimeError) as ex:
+        error('budgets: no budget for', UNIXuser + "'s desktop:", ex)
+
+def budget_new_desktop(UNIXuser):
+    r"""
+    Give `UNIXuser`'s just-started desktop its budget, in the background
+    (through the spawn helper, if we aren't root).
+    """
+    # Not a daemon thread: a short-lived caller (grid-desktop@.service)
+    # waits for it at exit
+    threading.Thread(target=_budget_desktop, args=(UNIXuser,)).start()
+
+#
+# The budget keeper
+#
+
+def _open_pg_database():
+    import psycopg2
+    try:
+        conn = psycopg2.connect(host='127.0.0.1', dbname='collaborate',
+                                user='collaborate', password='collaborate')
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("LISTEN vnc_screenshare")
+        cur.close()
+        return conn
+    except psycopg2.Error:
+        return None
+
+def _projected(pg_conn):
+    import psycopg2
+    try:
+        cur = pg_conn.cursor()
+        cur.execute('SELECT screenshare FROM vnc_screenshare')
+        projected = {row[0] for row in cur.fetchall()}
+        cur.close()
+        return projected
+    except psycopg2.Error:
+        return set()
+
+def _desktops():
+    r"""
+    A dict mapping the names of the desktop sockets in /run/vnc to the
+    uids (and user names) that own them.
+    """
+    desktops = dict()
+    for name in os.listdir(RUN_DIR):
+        if name.startswith('.'):
+            continue
+        try:
+            st = os.stat(os.path.join(RUN_DIR, name))
+            if stat.S_ISSOCK(st.st_mode) and st.st_uid != 0:
+                desktops[name] = (st.st_uid, pwd.getpwuid(st.st_uid).pw_name)
+        except (FileNotFoundError, KeyError):
+            continue
+    return desktops
+
+def _desired_roles(projected):
+    roles = dict()
+    for (name, (uid, UNIXuser)) in _desktops().items():
+        role = 'projected' if name in projected else desktop_role(UNIXuser)
+        # a user with several desktops gets the biggest budget any of them needs
+        roles[uid] = max(roles.get(uid, role), role, key=ROLES.index)
+    return roles
+
+def run_budget_keeper(watch_parent=False):
+    r"""
+    Keep every desktop on its role's budget, until killed (or, with
+    `watch_parent`, until the process that started us exits).
+    """
+    parent = os.getppid()
+    applied = dict()            # uid -> role
+    pg_conn = None
+
+    while not watch_parent or os.getppid() == parent:
+        if pg_conn is None or pg_conn.closed:
+            pg_conn = _open_pg_database()
+        projected = _projected(pg_conn) if pg_conn else set()
+
+        try:
+            roles = _desired_roles(projected)
+        except OSError as ex:
+            error('budgets:', ex)
+            roles = dict()
+        for (uid, role) in roles.items():
+            if applied.get(uid) != role and apply_budget(uid, role):
+                applied[uid] = role
+        for uid in list(applied):
+            if uid not in roles:
+                applied.pop(uid)
+
+        # Sleep until the next poll, or a projection changes
+        if pg_conn:
+            try:
+                if select.select([pg_conn], [], [], BUDGET_POLL)[0]:
+                    pg_conn.poll()
+                    pg_conn.notifies.clear()
+            except Exception:
+                pg_conn.close()
+        else:
+            time.sleep(BUDGET_POLL)
+
+def start_budget_keeper():
+    r"""
+    Fork a budget keeper that exits along with the calling process, if
+    we're root.  Returns its pid, or None.
+    """
+    if os.geteuid() != 0:
+        return None
+    return start_service('budget keeper', run_budget_keeper)
+
+#
+# Status
+#
+
+def _read(uid, name):
+    try:
+        with open(os.path.join(CGROUP_ROOT, 'user.slice', _unit(uid), name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cpu_seconds(uid):
+    for line in (_read(uid, 'cpu.stat') or '').split('\n'):
+        if line.startswith('usage_usec '):
+            return int(line.split()[1]) / 1e6
+    return None
+
+def _megabytes(value):
+    if value is None:
+        return '-'
+    if value == 'max':
+        return 'max'
+    return '{:.0f}M'.format(int(value) / 2**20)
+
+def budgets(*args):
+    r"""
+    budgets [SECONDS]
+
+    Show every desktop's budget and its use of it: CPU (cores, averaged
+    over SECONDS, default 1) against its CPU weight, memory against its
+    MemoryHigh, and its IO weight.
+    """
+    interval = float(args[0]) if args else 1
+    pg_conn = _open_pg_database()
+    projected = _projected(pg_conn) if pg_conn else set()
+    desktops = _desktops()
+
+    uids = {uid for (uid, UNIXuser) in desktops.values()}
+    before = {uid: _cpu_seconds(uid) for uid in uids}
+    time.sleep(interval)
+    after = {uid: _cpu_seconds(uid) for uid in uids}
+
+    print('{:24} {:10} {:>6} {:>9} {:>9} {:>9} {:>8}  {}'.format(
+        'DESKTOP', 'ROLE', 'CPU', 'CPUWEIGHT', 'MEMORY', 'MEMHIGH', 'IOWEIGHT', 'STATE'))
+    for (name, (uid, UNIXuser)) in sorted(desktops.items()):
+        role = 'projected' if name in projected else desktop_role(UNIXuser)
+        if before[uid] is not None and after[uid] is not None:
+            cpu = '{:.2f}'.format((after[uid] - before[uid]) / interval)
+        else:
+            cpu = '-'
+        io_weight = (_read(uid, 'io.weight') or '-').split('\n')[0].replace('default ', '')
+        frozen = _read(uid, 'cgroup.freeze') == '1'
+        print('{:24} {:10} {:>6} {:>9} {:>9} {:>9} {:>8}  {}'.format(
+            name, role, cpu, _read(uid, 'cpu.weight') or '-',
+            _megabytes(_read(uid, 'memory.current')), _megabytes(_read(uid, 'memory.high')),
+            io_weight, 'frozen' if frozen else 'running'))
@@ -0,0 +1,150 @@
+#
+# Host-wide X display number allocation.
+#
+# tigervncserver.pl, left to itself, picks "the lowest free display":
+# it looks for X lock files in /tmp and takes the first number without
+# one.  Two spawns that look at the same moment pick the same :N, and
+# the one whose Xvnc starts second dies ("A VNC/X11 server is already
+# running as :N"), wasting a whole spawn attempt -- the collision that
+# ensure_vnc_server's retry-with-jitter loop was written to recover
+# from, and one that happens constantly at class start, when dozens of
+# desktops and inetd sessions start at once.
+#
+# Instead, we reserve a display number before starting a server and
+# pass it to tigervncserver.pl explicitly.  A reservation is a file
+# /run/vnc/.displays/<N>, created while holding a flock on the
+# directory's lock file, so no two allocators ever see the same number
+# as free.  A number is free if it has neither a reservation nor an X
+# server: an X lock file or socket in /tmp, or something listening on
+# its TCP port (6000+N) -- the same tests tigervncserver.pl makes,
+# which would otherwise refuse a number we handed out.
+#
+# Reservations only have to last until the X server is up and has
+# made its own lock file.  start_VNC_server releases its reservation
+# as soon as the desktop's socket appears (or the spawn fails); inetd
+# sessions release theirs when the X lock file appears (or the session
+# fails to start).  Either way, a reservation older than
+# RESERVATION_SECONDS, which its releaser didn't live to release, is stale
+# and is reclaimed by the next allocation.  So is the lock file of an
+# X server that died without removing it (its pid is gone), which
+# would otherwise make tigervncserver.pl refuse that number forever.
+
+import os
+import time
+import fcntl
+import socket
+import threading
+
+from .inotify import wait_for_path
+
+DISPLAYS_DIR = '/run/vnc/.displays'
+
+# tigervncserver.pl's own search stops at 199; we hand out up to this
+# many, since at class start every student has a desktop and an inetd
+# session or two.
+
+FIRST_DISPLAY = 1
+LAST_DISPLAY = 499
+
+RESERVATION_SECONDS = 120
+
+X_TCP_PORT = 6000
+
+def _x_lock_pid(n):
+    r"""
+    The pid in display `n`'s X lock file, None if there's no lock file,
+    or 0 if it can't be read.
+    """
+    try:
+        with open('/tmp/.X{}-lock'.format(n)) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        return 0
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _x_server_running(n):
+    r"""
+    Does display `n` have an X server, as far as tigervncserver.pl would
+    be concerned?  Cleans up after an X server that died uncleanly.
+    """
+    pid = _x_lock_pid(n)
+    if pid is not None and pid > 0 and not _pid_alive(pid):
+        for stale in ('/tmp/.X{}-lock'.format(n), '/tmp/.X11-unix/X{}'.format(n)):
+            try:
+                os.unlink(stale)
+            except FileNotFoundError:
+                pass
+        return False
+    return pid is not None or os.path.exists('/tmp/.X11-unix/X{}'.format(n))
+
+def _tcp_port_used(n):
+    r"""
+    Is something listening on display `n`'s X server TCP port?  Tested as
+    tigervncserver.pl tests it, by trying to bind the port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('', X_TCP_PORT + n))
+        except OSError:
+            return True
+    return False
+
+def _reserved(n, now):
+    try:
+        age = now - os.stat(os.path.join(DISPLAYS_DIR, str(n))).st_mtime
+    except FileNotFoundError:
+        return False
+    return age < RESERVATION_SECONDS
+
+def reserve_display():
+    r"""
+    Reserve a free X display number and return it.  Raises RuntimeError
+    if there isn't one.
+    """
+    os.makedirs(DISPLAYS_DIR, mode=0o755, exist_ok=True)
+    fd = os.open(os.path.join(DISPLAYS_DIR, '.lock'), os.O_CREAT | os.O_WRONLY, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        now = time.time()
+        for n in range(FIRST_DISPLAY, LAST_DISPLAY + 1):
+            if _reserved(n, now) or _x_server_running(n) or _tcp_port_used(n):
+                continue
+            # Any reservation left here is stale; replace it
+            with open(os.path.join(DISPLAYS_DIR, str(n)), 'w') as f:
+                f.write('{}\n'.format(os.getpid()))
+            return n
+    finally:
+        os.close(fd)
+    raise RuntimeError('no free X display number')
+
+def release_display(n):
+    r"""
+    Give back a reservation from reserve_display(), once its X server is
+    running (its own lock file takes over) or has failed to start.
+    """
+    try:
+        os.unlink(os.path.join(DISPLAYS_DIR, str(n)))
+    except FileNotFoundError:
+        pass
+
+def release_display_when_running(n):
+    r"""
+    Give back a reservation from reserve_display() in the background, as
+    soon as an X server on it has made its lock file (or the reservation
+    expires anyway).  For servers we don't start ourselves.
+    """
+    def wait_and_release():
+        wait_for_path('/tmp/.X{}-lock'.format(n), RESERVATION_SECONDS)
+        release_display(n)
+    threading.Thread(target=wait_and_release, daemon=True).start()
@@ -2,6 +2,8 @@
 import subprocess
 import json
 import re
+import time
+import threading
 from lxml import etree
 
 import bigbluebutton
@@ -33,6 +35,20 @@ freeswitch_ids = {}
 mute_status = {}
 deaf_status = {}
 
+# get_status() is a BBB getMeetingInfo call and an fs_cli fork.  A
+# long-running caller can use set_deaf() instead, which works from
+# whatever get_status() found, if that was less than STATUS_MAX_AGE (or
+# its `max_age`) seconds ago -- but only if nothing else deafs or undeafs
+# the students in the meantime.  teacher_desktop's zooms can't count on
+# that (the teacher's menu runs deaf_students in a process of its own),
+# so they pass max_age=0.  status_lock keeps such a caller's threads from
+# running get_status() on top of each other.
+
+STATUS_MAX_AGE = 30
+
+status_time = None
+status_lock = threading.RLock()
+
 def get_freeswitch_password():
     global freeswitch_pw
     if not freeswitch_pw:
@@ -97,6 +113,9 @@ def get_status(meetingID = myMeetingID, viewersOnly = True):
                             mute_status[id] = not member['flags']['can_speak']
                             deaf_status[id] = not member['flags']['can_hear']
 
+    global status_time
+    status_time = time.monotonic()
+
 mutestr={True: 'MUTED', False: 'UNMUTED'}
 deafstr={True: 'DEAFED', False: 'UNDEAFED'}
 
@@ -148,6 +167,24 @@ def mute_student(student_name):
     if student_name in freeswitch_ids:
         freeswitch_conference_cmd('mute', freeswitch_ids[student_name])
 
+def set_deaf(student_name, deaf, max_age=STATUS_MAX_AGE):
+    r"""
+    Deaf (or undeaf) `student_name`, unless they already are, going by
+    conference data at most `max_age` seconds old.  Returns True if we
+    changed them.
+    """
+    with status_lock:
+        if status_time is None or time.monotonic() - status_time > max_age:
+            get_status()
+        if student_name not in freeswitch_ids:
+            return False
+        id = freeswitch_ids[student_name]
+        if deaf_status[id] == deaf:
+            return False
+        freeswitch_conference_cmd('deaf' if deaf else 'undeaf', id)
+        deaf_status[id] = deaf
+        return True
+
 def undeaf_student(student_name):
     get_status()
     if student_name in freeswitch_ids:
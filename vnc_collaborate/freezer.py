@@ -0,0 +1,327 @@
+#
+# Freezing idle desktops.
+#
+# A persistent desktop (/run/vnc/<user>) keeps running from the first
+# time its user connects until somebody runs `loginctl terminate-user`,
+# and a GNOME session nobody is looking at still wakes up constantly:
+# gnome-shell's timers and animations, Xtigervnc's own, the session's
+# services.  With dozens of students' desktops on a host, that adds up.
+#
+# So the proxy forks a freezer (like its other helper services) that
+# looks at the desktops every FREEZE_POLL seconds, and freezes a user's
+# desktops when none of them has had a VNC client for VNC_FREEZE_AFTER
+# seconds (0, the default, disables freezing).  Desktops only take
+# input from VNC clients, so no clients also means no input.  A client
+# of a desktop socket shows up in /proc/net/unix as a connected socket
+# bound to the path the server listens on, and the server holds it open.
+# We count them by the server (its uid), not the path: a desktop adopted
+# from the warm pool listens under the .pool name it was started with,
+# not the /run/vnc path its clients connect to (see warm_pool.py).
+#
+# A desktop runs in its user's logind session, so what we freeze is the
+# user's slice, user-UID.slice, with the cgroup v2 freezer (by writing
+# its cgroup.freeze): the desktop session, the user's systemd --user
+# services, everything.  Its processes stop using any CPU until thawed,
+# but keep all of their state.  A user with several desktops (the
+# 'default' user has one per meeting) is frozen only when all of them
+# are idle, and the warm pool's user never is.
+#
+# Anything that connects to a desktop socket has to thaw it first, or
+# its connection just hangs: ensure_vnc_server does it for the proxy,
+# and the teacher's grid and the recorder call thaw_desktop before they
+# connect.  Thawing takes a write and a wait of well under a
+# millisecond for the kernel to finish.  Callers that aren't root thaw
+# through the spawn helper (privileged.py), which thaws for anyone, but
+# only marks the desktop recently used (see below) for its own users.
+#
+# Per-user state is kept in FREEZER_DIR/<uid>, flock()ed by freezes and
+# thaws: a thaw touches it, and the freezer leaves a desktop that was
+# thawed in the last VNC_FREEZE_AFTER seconds alone, so it can't freeze
+# a desktop between the thaw and the connection that wanted it.  While
+# a desktop is frozen, the file holds when it was frozen and how much
+# CPU it was using while idle, so that its thaw can estimate the CPU
+# time the freeze saved.  The thaw latencies and the savings are
+# reported to the metrics collector (metrics.py):
+#
+#     vnc_desktop_freezes_total
+#     vnc_desktop_thaw_seconds{by="proxy"|"grid"|"recorder"}
+#     vnc_desktop_frozen_cpu_seconds_saved_total
+
+import os
+import pwd
+import json
+import stat
+import time
+import fcntl
+import contextlib
+
+from .services import error, start_service
+from .metrics import send
+
+FREEZE_AFTER = int(os.environ.get('VNC_FREEZE_AFTER', '0'))
+
+FREEZE_POLL = 30
+
+RUN_DIR = '/run/vnc'
+POOL_DIR = '/run/vnc/.pool'
+FREEZER_DIR = '/run/vnc/.freezer'
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# The names (/proc/PID/comm) of the VNC servers whose clients we count
+
+VNC_SERVERS = ('Xtigervnc', 'Xvnc')
+
+# How long to wait for the kernel to thaw a cgroup before giving up on
+# waiting (the thaw itself is already under way)
+
+THAW_TIMEOUT = 1
+
+def _slice(uid):
+    return os.path.join(CGROUP_ROOT, 'user.slice', 'user-{}.slice'.format(uid))
+
+def is_frozen(uid):
+    try:
+        with open(os.path.join(_slice(uid), 'cgroup.freeze')) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+def _cpu_usage(uid):
+    r"""
+    The CPU time (seconds) used so far by user `uid`'s slice, or None.
+    """
+    try:
+        with open(os.path.join(_slice(uid), 'cpu.stat')) as f:
+            for line in f:
+                (key, value) = line.split()
+                if key == 'usage_usec':
+                    return int(value) / 1e6
+    except (OSError, ValueError):
+        pass
+    return None
+
+def rfb_clients():
+    r"""
+    A dict mapping the uid of every VNC server with clients connected to
+    a UNIX socket in RUN_DIR to how many it has.
+    """
+    connected = set()
+    with open('/proc/net/unix') as f:
+        next(f)
+        for line in f:
+            # Num RefCount Protocol Flags Type St Inode Path
+            fields = line.split()
+            if len(fields) >= 8 and fields[5] == '03' and fields[7].startswith(RUN_DIR + '/'):
+                connected.add('socket:[{}]'.format(fields[6]))
+
+    clients = dict()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'comm')) as f:
+                if f.read().strip() not in VNC_SERVERS:
+                    continue
+            uid = os.stat(os.path.join('/proc', pid)).st_uid
+            fds = os.path.join('/proc', pid, 'fd')
+            for fd in os.listdir(fds):
+                try:
+                    if os.readlink(os.path.join(fds, fd)) in connected:
+                        clients[uid] = clients.get(uid, 0) + 1
+                except FileNotFoundError:
+                    pass
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            # it exited, or isn't ours to look at
+            continue
+    return clients
+
+@contextlib.contextmanager
+def _state(uid):
+    r"""
+    Hold user `uid`'s state file locked, yielding it, open for update.
+    """
+    os.makedirs(FREEZER_DIR, mode=0o700, exist_ok=True)
+    path = os.path.join(FREEZER_DIR, str(uid))
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        # never thawed
+        os.utime(fd, (0, 0))
+    except FileExistsError:
+        fd = os.open(path, os.O_RDWR)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+def _write_state(f, state):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(state))
+    f.flush()
+
+def _freeze(uid, idle_cpu_rate, freeze_after=FREEZE_AFTER):
+    r"""
+    Freeze user `uid`'s slice, unless somebody thawed it recently.
+    Returns True if it did.
+    """
+    with _state(uid) as f:
+        if time.time() - os.fstat(f.fileno()).st_mtime < freeze_after:
+            return False
+        with open(os.path.join(_slice(uid), 'cgroup.freeze'), 'w') as freeze:
+            freeze.write('1')
+        _write_state(f, {'frozen_at': time.time(), 'idle_cpu_rate': idle_cpu_rate})
+    send([{'name': 'vnc_desktop_freezes_total', 'labels': {}, 'value': 1}])
+    return True
+
+def _thaw(uid, by, mark_used=True):
+    r"""
+    Thaw user `uid`'s slice if it's frozen, and (if `mark_used`) mark it
+    recently used.  Returns how long the thaw took (seconds), or None if
+    it wasn't frozen.
+    """
+    with _state(uid) as f:
+        if mark_used:
+            os.utime(f.fileno())
+        if not is_frozen(uid):
+            return None
+        started = time.monotonic()
+        with open(os.path.join(_slice(uid), 'cgroup.freeze'), 'w') as freeze:
+            freeze.write('0')
+        # cgroup.events says "frozen 0" once every process is running again
+        while time.monotonic() - started < THAW_TIMEOUT:
+            with open(os.path.join(_slice(uid), 'cgroup.events')) as events:
+                if 'frozen 0' in events.read():
+                    break
+            time.sleep(0.0002)
+        seconds = time.monotonic() - started
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        _write_state(f, {})
+    records = [{'name': 'vnc_desktop_thaw_seconds', 'labels': {'by': by}, 'value': seconds}]
+    if 'frozen_at' in state:
+        saved = max(0, time.time() - state['frozen_at']) * state.get('idle_cpu_rate', 0)
+        records.append({'name': 'vnc_desktop_frozen_cpu_seconds_saved_total', 'labels': {}, 'value': saved})
+    send(records)
+    return seconds
+
+def thaw_desktop(rfbpath, by='proxy', UNIXuser=None, mark_used=True):
+    r"""
+    Make sure the desktop listening on `rfbpath` isn't frozen, before
+    connecting to it.  If it isn't running, but `UNIXuser` is given,
+    make sure a desktop started for them won't start out frozen.
+    Returns how long thawing took, or None if nothing was frozen.
+    The spawn helper passes `mark_used`=False for callers who may only
+    thaw, so that they can't keep a desktop from ever being frozen.
+    """
+    try:
+        uid = os.stat(rfbpath).st_uid
+    except FileNotFoundError:
+        try:
+            uid = pwd.getpwnam(UNIXuser).pw_uid
+        except (KeyError, TypeError):
+            return None
+    if uid == 0:
+        return None
+    # Only root can mark a desktop recently used, and only the freezer cares
+    if not is_frozen(uid) and (os.geteuid() != 0 or FREEZE_AFTER <= 0):
+        return None
+    if os.geteuid() == 0:
+        return _thaw(uid, by, mark_used)
+    from .privileged import thaw
+    return thaw(rfbpath, by)
+
+#
+# The freezer
+#
+
+def _desktops():
+    r"""
+    A dict mapping the uids that own desktop sockets in /run/vnc to their
+    sockets' paths.
+    """
+    desktops = dict()
+    for name in os.listdir(RUN_DIR):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(RUN_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISSOCK(st.st_mode) and st.st_uid != 0:
+            desktops.setdefault(st.st_uid, []).append(path)
+    return desktops
+
+def _pool_uids():
+    uids = set()
+    try:
+        for name in os.listdir(POOL_DIR):
+            try:
+                uids.add(os.stat(os.path.join(POOL_DIR, name)).st_uid)
+            except FileNotFoundError:
+                pass
+    except FileNotFoundError:
+        pass
+    return uids
+
+def run_freezer(freeze_after=FREEZE_AFTER, watch_parent=False):
+    r"""
+    Freeze users' desktops once they've been idle for `freeze_after`
+    seconds, until killed (or, with `watch_parent`, until the process that
+    started us exits).
+    """
+    parent = os.getppid()
+    last_active = dict()        # uid -> time.monotonic() it last had a client
+    last_usage = dict()         # uid -> (time.monotonic(), CPU seconds used)
+
+    while not watch_parent or os.getppid() == parent:
+        now = time.monotonic()
+        try:
+            clients = rfb_clients()
+            desktops = _desktops()
+            pool_uids = _pool_uids()
+        except OSError as ex:
+            error('freezer:', ex)
+            time.sleep(FREEZE_POLL)
+            continue
+
+        for uid in desktops:
+            if is_frozen(uid):
+                last_usage.pop(uid, None)
+                continue
+            usage = _cpu_usage(uid)
+            (then, used) = last_usage.get(uid, (None, None))
+            last_usage[uid] = (now, usage)
+
+            if uid not in last_active or uid in pool_uids or clients.get(uid):
+                last_active[uid] = now
+            elif now - last_active[uid] >= freeze_after and usage is not None and used is not None:
+                # the CPU it used over the last poll, while idle
+                idle_cpu_rate = max(0, usage - used) / (now - then)
+                try:
+                    if _freeze(uid, idle_cpu_rate, freeze_after):
+                        last_usage.pop(uid, None)
+                except OSError as ex:
+                    error('freezer: freezing user', uid, 'failed:', ex)
+
+        for uid in list(last_active):
+            if uid not in desktops:
+                last_active.pop(uid)
+                last_usage.pop(uid, None)
+
+        time.sleep(FREEZE_POLL)
+
+def start_freezer(freeze_after=FREEZE_AFTER):
+    r"""
+    Fork a freezer that exits along with the calling process, unless
+    VNC_FREEZE_AFTER is 0 or there's no cgroup v2 freezer.  Returns its
+    pid, or None.
+    """
+    if freeze_after <= 0:
+        return None
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        error('freezer: no cgroup v2 hierarchy at', CGROUP_ROOT, '; not freezing idle desktops')
+        return None
+    return start_service('freezer', run_freezer, freeze_after)
@@ -0,0 +1,385 @@
+#
+# The teacher's grid, drawn by one process.
+#
+# The grid used to be an ssvncviewer per desktop (each decoding its
+# desktop at full resolution and scaling it down in software) plus a Tk
+# label process per desktop -- fifty-odd processes for a 5x5 grid.  In
+# compositor mode (the grid_renderer root window property, set from the
+# teacher's menu) teacher_desktop starts this instead:
+#
+#     python3 -m vnc_collaborate grid_compositor
+#
+# and writes it the layout of the grid's current page, as JSON lines on
+# its stdin, whenever it changes:
+#
+#     {"screen": [W, H], "tiles": [{"display": ..., "socket": ...,
+#                                   "title": ..., "label": ...,
+#                                   "frame": [X, Y, W, H],
+#                                   "area": [X, Y, W, H]}, ...],
+#      "prefetch": [TILE, ...],
+#      "rates": {"normal": FPS, "hover": FPS, "projected": FPS,
+#                "prefetch": FPS},
+#      "flipped_at": TIME}
+#     {"highlight": DISPLAY or null}
+#
+# The "prefetch" tiles are on the grid's neighbouring pages: they're kept,
+# hidden, with their thumbnails updated at the (very low) prefetch rate, so
+# that flipping to their page just shows them, instead of connecting to
+# every desktop on it and waiting for all of their framebuffers.  A layout
+# that flips the page says when the page was flipped (time.monotonic()),
+# and once the new page's tiles are all drawn (or FLIP_TIMEOUT goes by),
+# we write how long that took, as a JSON line on our stdout:
+#
+#     {"flip": {"first_pixel": SECONDS, "complete": SECONDS or null,
+#               "tiles": N, "prefetched": N}}
+#
+# Each tile has a thumbnail (thumbnails.py) of its desktop, scaled down
+# to fit in the tile's area: from the host's thumbnail service, which
+# shares one connection to each desktop among all the teachers' grids,
+# if it's running, or else our own connection to the desktop.  Every
+# REFRESH_MS, the Tk thread copies whatever changed into the tiles'
+# images on a single full-screen canvas, which also has the tiles'
+# labels, and the red frame around the desktop being screenshared.
+# When stdin closes, we exit.
+#
+# A desktop only sends a framebuffer update when it has been asked for
+# one, so each tile paces its thumbnail's FramebufferUpdateRequests (or
+# its subscription to the thumbnail service): at most `normal` times a
+# second, or `hover` times a second while the pointer is over it, or
+# `projected` times a second while it's being screenshared (RATES, or
+# the grid_fps, grid_hover_fps and grid_projected_fps root window
+# properties, via teacher_desktop).  A prefetch tile on a neighbouring
+# page asks only `prefetch` times a second, and a tile on any other page
+# has no connection at all.  So a teacher glancing at a 5x5 grid costs
+# each desktop a couple of (cheap, Raw, see rfbclient.py) updates a
+# second, and the desktops on the pages either side one every few
+# seconds, not a full-rate viewer.
+#
+# fvwm and teacher_zoom identify a desktop by the title of the window
+# that was clicked ("TeacherViewVNC;ID;display;WxH;socket;label", see
+# teacher_desktop.py), and fvwm matches window names against its
+# bindings, and expands $[w.name], when the click happens.  So the
+# compositor's window takes the title of whichever tile the pointer is
+# over, and IDLE_TITLE between tiles, and clicking a tile zooms it just
+# like clicking an ssvncviewer did.  The window's class is WINDOW_CLASS,
+# not Tk, so that the teacher-mode fvwm config can keep it below the
+# "End screenshare" button, which is a Tk window of the overlay server
+# (overlay.py).
+
+import sys
+import json
+import time
+import queue
+import threading
+import subprocess
+
+import tkinter as tk
+
+from .services import error
+from .thumbnails import open_thumbnail
+
+REFRESH_MS = 50
+
+# How many updates a second a tile asks its desktop for (see above)
+
+RATES = {'normal': 2, 'hover': 10, 'projected': 5, 'prefetch': 0.2}
+
+FLIP_TIMEOUT = 10
+
+WINDOW_CLASS = 'GridCompositor'
+IDLE_TITLE = 'TeacherGridBackground'
+
+LABEL_BG = 'cyan'
+LABEL_FG = 'black'
+HIGHLIGHT = 'red'
+
+class Tile:
+    r"""
+    A desktop's place on the grid: its thumbnail and its label.
+    """
+
+    def __init__(self, canvas, spec):
+        self.canvas = canvas
+        self.socket = spec['socket']
+        self.size = (0, 0)
+        self.visible = True
+        self.photo = tk.PhotoImage(master=canvas, width=1, height=1)
+        self.image_item = canvas.create_image(0, 0, anchor='nw', image=self.photo, tags='thumbnail')
+        self.label_bg = canvas.create_rectangle(0, 0, 0, 0, fill=LABEL_BG, outline='', tags='label')
+        self.label_text = canvas.create_text(0, 0, anchor='n', justify='center', fill=LABEL_FG, tags='label')
+        self.thumbnail = open_thumbnail(self.socket, *spec['area'][2:])
+        self.thumbnail.start()
+        self.place(spec)
+
+    def place(self, spec):
+        self.spec = spec
+        (x, y, w, h) = spec['area']
+        self.thumbnail.fit(w, h)
+        self.canvas.itemconfigure(self.label_text, text=spec['label'])
+        self.canvas.coords(self.label_text, x + w//2, y)
+        self.canvas.coords(self.label_bg, *self.canvas.bbox(self.label_text))
+        self.canvas.coords(self.image_item, *self.bounds()[:2])
+
+    def show(self, visible):
+        r"""
+        Show the tile, or hide it (because it's prefetched).
+        """
+        if visible != self.visible:
+            self.visible = visible
+            state = 'normal' if visible else 'hidden'
+            for item in (self.image_item, self.label_bg, self.label_text):
+                self.canvas.itemconfigure(item, state=state)
+
+    def bounds(self):
+        r"""
+        The (x0, y0, x1, y1) of the thumbnail, centered in the tile's area.
+        """
+        (x, y, w, h) = self.spec['area']
+        (cols, rows) = self.size
+        x0 = x + (w - cols)//2
+        y0 = y + (h - rows)//2
+        return (x0, y0, x0 + cols, y0 + rows)
+
+    def refresh(self):
+        # a hidden tile's changes pile up in its thumbnail until it's shown
+        if not self.visible:
+            return
+        taken = self.thumbnail.take()
+        if taken is None:
+            return
+        (size, (r0, c0), pixels) = taken
+        if size != self.size:
+            self.size = size
+            self.photo.configure(width=size[0], height=size[1])
+            self.canvas.coords(self.image_item, *self.bounds()[:2])
+        (rows, cols) = pixels.shape[:2]
+        ppm = b'P6 %d %d 255\n' % (cols, rows) + pixels.tobytes()
+        self.photo.tk.call(self.photo.name, 'put', ppm, '-format', 'ppm', '-to', c0, r0)
+
+    def destroy(self):
+        self.thumbnail.close()
+        self.canvas.delete(self.image_item, self.label_bg, self.label_text)
+
+class Compositor:
+    r"""
+    The compositor's window, and the tiles on it.
+    """
+
+    def __init__(self):
+        self.window = tk.Tk(className=WINDOW_CLASS)
+        self.window.title(IDLE_TITLE)
+        self.canvas = tk.Canvas(self.window, background='black', highlightthickness=0)
+        self.canvas.pack(fill='both', expand=True)
+        self.highlight_item = self.canvas.create_rectangle(0, 0, 0, 0, fill=HIGHLIGHT, outline='', state='hidden')
+
+        self.tiles = dict()
+        self.highlighted = None
+        self.hovered = None
+        self.rates = RATES
+        self.pointer = None
+        self.title = IDLE_TITLE
+        # the page flip we're timing, if any
+        self.flip = None
+
+        self.canvas.bind('<Motion>', self.motion)
+        self.canvas.bind('<Leave>', self.leave)
+
+        self.messages = queue.Queue()
+        threading.Thread(target=self.read_messages, daemon=True).start()
+        self.window.after(REFRESH_MS, self.refresh)
+
+    def read_messages(self):
+        for line in sys.stdin:
+            try:
+                self.messages.put(json.loads(line))
+            except ValueError:
+                error('grid_compositor: bad message', repr(line))
+        self.messages.put(None)
+
+    def layout(self, message):
+        if 'screen' in message:
+            self.window.geometry('{}x{}+0+0'.format(*message['screen']))
+        self.rates = dict(RATES, **message.get('rates', {}))
+        specs = {spec['display']: spec for spec in message.get('prefetch', [])}
+        visible = {spec['display'] for spec in message['tiles']}
+        specs.update({spec['display']: spec for spec in message['tiles']})
+        prefetched = {display for (display, tile) in self.tiles.items() if not tile.visible}
+        for display in list(self.tiles):
+            if display not in specs or specs[display]['socket'] != self.tiles[display].socket:
+                self.tiles.pop(display).destroy()
+                prefetched.discard(display)
+        for (display, spec) in specs.items():
+            if display in self.tiles:
+                self.tiles[display].place(spec)
+            else:
+                self.tiles[display] = Tile(self.canvas, spec)
+            self.tiles[display].show(display in visible)
+        self.canvas.tag_raise('label')
+        if 'flipped_at' in message:
+            self.flip = {'flipped_at': message['flipped_at'], 'first_pixel': None,
+                         'tiles': len(visible), 'prefetched': len(visible & prefetched)}
+        self.highlight(self.highlighted)
+        self.retitle()
+
+    def highlight(self, display):
+        self.highlighted = display
+        if display in self.tiles and self.tiles[display].visible:
+            (x, y, w, h) = self.tiles[display].spec['frame']
+            self.canvas.coords(self.highlight_item, x, y, x + w, y + h)
+            self.canvas.itemconfigure(self.highlight_item, state='normal')
+            self.canvas.tag_lower(self.highlight_item)
+        else:
+            self.canvas.itemconfigure(self.highlight_item, state='hidden')
+        self.pace()
+
+    def pace(self):
+        for (display, tile) in self.tiles.items():
+            if not tile.visible:
+                fps = self.rates['prefetch']
+            elif display == self.hovered:
+                fps = self.rates['hover']
+            elif display == self.highlighted:
+                fps = self.rates['projected']
+            else:
+                fps = self.rates['normal']
+            tile.thumbnail.pace(fps)
+
+    def retitle(self):
+        hovered = None
+        if self.pointer:
+            (x, y) = self.pointer
+            for (display, tile) in self.tiles.items():
+                (x0, y0, x1, y1) = tile.bounds()
+                if tile.visible and x0 <= x < x1 and y0 <= y < y1:
+                    hovered = display
+                    break
+        title = self.tiles[hovered].spec['title'] if hovered is not None else IDLE_TITLE
+        if title != self.title:
+            self.title = title
+            self.window.title(title)
+        if hovered != self.hovered:
+            self.hovered = hovered
+            self.pace()
+
+    def motion(self, event):
+        self.pointer = (event.x, event.y)
+        self.retitle()
+
+    def leave(self, event):
+        self.pointer = None
+        self.retitle()
+
+    def refresh(self):
+        while not self.messages.empty():
+            message = self.messages.get()
+            if message is None:
+                self.window.destroy()
+                return
+            if 'tiles' in message:
+                self.layout(message)
+            if 'highlight' in message:
+                self.highlight(message['highlight'])
+        for tile in self.tiles.values():
+            tile.refresh()
+        if self.flip:
+            self.time_flip()
+        # a tile's thumbnail can change size under the pointer
+        self.retitle()
+        self.window.after(REFRESH_MS, self.refresh)
+
+    def time_flip(self):
+        r"""
+        Report the page flip we're timing, once its tiles are all drawn.
+        """
+        flip = self.flip
+        painted = sum(1 for tile in self.tiles.values() if tile.visible and tile.size != (0, 0))
+        timed_out = time.monotonic() - flip['flipped_at'] >= FLIP_TIMEOUT
+        if painted == 0 and flip['tiles'] > 0 and not timed_out:
+            return
+        # the tiles' images get onto the screen when Tk is idle
+        self.window.update_idletasks()
+        elapsed = time.monotonic() - flip['flipped_at']
+        if flip['first_pixel'] is None:
+            flip['first_pixel'] = elapsed
+        if painted < flip['tiles'] and not timed_out:
+            return
+        report = {'first_pixel': flip['first_pixel'],
+                  'complete': elapsed if painted == flip['tiles'] else None,
+                  'tiles': flip['tiles'], 'prefetched': flip['prefetched']}
+        print(json.dumps({'flip': report}), flush=True)
+        self.flip = None
+
+def grid_compositor(*args):
+    r"""
+    grid_compositor
+
+    Draw the teacher's grid in one window, following the layouts that
+    teacher_desktop writes to our stdin, until it closes.
+    """
+    compositor = Compositor()
+    compositor.window.mainloop()
+    for tile in compositor.tiles.values():
+        tile.thumbnail.close()
+
+class GridCompositor:
+    r"""
+    teacher_desktop's end of a compositor: starts one, and sends it
+    layouts and highlights, when they change.  `on_flip` is called (from
+    another thread) with the compositor's reports of how long page flips
+    took.
+    """
+
+    def __init__(self, on_flip=None):
+        self.proc = subprocess.Popen(['python3', '-m', 'vnc_collaborate', 'grid_compositor'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.last_layout = None
+        self.highlighted = None
+        self.page = None
+        self.on_flip = on_flip
+        threading.Thread(target=self._read_reports, daemon=True).start()
+
+    def _read_reports(self):
+        for line in self.proc.stdout:
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if 'flip' in report and self.on_flip:
+                self.on_flip(report['flip'])
+
+    def _send(self, message):
+        try:
+            self.proc.stdin.write(json.dumps(message).encode() + b'\n')
+            self.proc.stdin.flush()
+        except OSError:
+            # it died; poll() will say so
+            pass
+
+    def layout(self, screen, tiles, rates, prefetch=[], page=None):
+        r"""
+        Lay out `tiles` (page `page` of the grid), with the `prefetch`
+        tiles (from its neighbouring pages) hidden.
+        """
+        flipped = self.page is not None and page != self.page
+        self.page = page
+        if (screen, tiles, rates, prefetch) != self.last_layout:
+            self.last_layout = (screen, tiles, rates, prefetch)
+            message = {'screen': screen, 'tiles': tiles, 'rates': rates, 'prefetch': prefetch}
+            if flipped:
+                message['flipped_at'] = time.monotonic()
+            self._send(message)
+
+    def highlight(self, display):
+        if display != self.highlighted:
+            self.highlighted = display
+            self._send({'highlight': display})
+
+    def poll(self):
+        return self.proc.poll()
+
+    def terminate(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.terminate()
@@ -0,0 +1,124 @@
+#
+# Waiting for files (mostly UNIX sockets) to appear, using inotify.
+#
+# Starting a session means waiting for some other process to create a
+# socket: a VNC server's -rfbunixpath in /run/vnc, a socat's
+# UNIX-LISTEN in /tmp.  We used to spin on os.path.exists() every
+# 100 ms, which adds up to 100 ms to every hop of a connection and,
+# with a forked handler per connection at class start, a lot of
+# pointless wakeups.  Here we put an inotify watch on the directory
+# instead and sleep until something is created in it.
+#
+# The waits are also bounded and watch the process that's supposed to
+# create the socket, so that a process that dies without creating it
+# ends the wait right away instead of at the deadline (or never, as it
+# used to for the socat relays, which had no timeout at all).  The
+# process is watched with a pidfd, so that its exit wakes us up too.
+#
+# Python has no inotify binding, so we call libc through ctypes.  If
+# that isn't possible (or the directory can't be watched), we fall
+# back to polling.
+
+import os
+import time
+import select
+import ctypes
+import ctypes.util
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+POLL_INTERVAL = 0.1
+
+_libc = None
+
+def _inotify_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+def inotify_watch(directory, mask=IN_CREATE | IN_MOVED_TO):
+    r"""
+    Return a non-blocking inotify file descriptor watching `directory`
+    for `mask` events, or None if that isn't possible.  Close it with
+    os.close().
+    """
+    libc = _inotify_libc()
+    if not libc:
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def drain(fd):
+    r"""
+    Discard the events waiting on inotify descriptor `fd`.
+    """
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+
+def _pidfd(proc):
+    if proc is None or not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(proc.pid)
+    except OSError:
+        # already reaped, or the kernel is older than 5.3
+        return None
+
+def wait_for_path(path, timeout=None, proc=None):
+    r"""
+    Wait until `path` exists.  Returns True if it does, or False if
+    `timeout` seconds went by first, or if `proc` (a subprocess.Popen,
+    the process expected to create `path`) exited without creating it.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # Watch first, then look, so a path created in between isn't missed
+    fd = inotify_watch(os.path.dirname(path) or '.')
+    pidfd = _pidfd(proc)
+    try:
+        while True:
+            if os.path.exists(path):
+                return True
+            if proc is not None and proc.poll() is not None:
+                # it may have created the path just before exiting
+                return os.path.exists(path)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            if fd is None or (proc is not None and pidfd is None):
+                # nothing to sleep on (or nothing to tell us about proc's exit)
+                wait = POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining)
+            else:
+                wait = remaining
+
+            fds = [f for f in (fd, pidfd) if f is not None]
+            try:
+                (readable, _, _) = select.select(fds, [], [], wait)
+            except InterruptedError:
+                continue
+            if fd in readable:
+                drain(fd)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if pidfd is not None:
+            os.close(pidfd)
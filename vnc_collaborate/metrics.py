@@ -0,0 +1,325 @@
+#
+# Connection metrics for the websockify proxy.
+#
+# A slow "black panel" can come from any of several steps of a
+# connection's setup: bbb-web's checkAuthorization, the roster lookup
+# (getMeetings), get_or_add_user (and adduser), waiting for another
+# connection's spawn of the same desktop, the desktop spawn and its
+# retries, or starting the per-connection inetd server.  Each
+# connection records how long each of those phases took, how it came
+# out (relayed, rejected, failed), whether its desktop was already
+# running, adopted from the warm pool or spawned (and in how many
+# attempts), and how many bytes it relayed each way.
+#
+# Connections are served by short-lived forked processes (or by
+# several --async workers), so the numbers are sent, one datagram per
+# connection, to a collector process that the proxy forks at startup
+# (like the roster service).  The collector keeps Prometheus-style
+# counters and histograms and serves them on localhost, port
+# VNC_METRICS_PORT (default 6103; 0 disables it):
+#
+#     curl http://localhost:6103/metrics         Prometheus text format
+#     curl http://localhost:6103/metrics.json    the same, as JSON
+#     curl http://localhost:6103/spawn-queue.json
+#                   the desktop spawns waiting for a slot, with their
+#                   queue positions and expected waits (spawn_queue.py)
+#
+# The checkAuthorization cache (auth_cache.py) counts its hits and misses.
+# The freezer (freezer.py) and whoever thaws a desktop send theirs too:
+# how many desktops were frozen, how long thaws took, and an estimate of
+# the CPU time the freezes saved.
+#
+# Sending is fire-and-forget: if the collector isn't running, or is
+# behind, the datagrams are dropped, never the connection.
+
+import os
+import json
+import time
+import socket
+import threading
+import contextlib
+import http.server
+
+from .services import error, start_service
+from .spawn_queue import queue_status
+
+METRICS_SOCKET = '/run/vnc-collaborate-metrics.sock'
+METRICS_PORT = int(os.environ.get('VNC_METRICS_PORT', '6103'))
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60]
+BYTES_BUCKETS = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9]
+THAW_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 1]
+
+# name -> (type, help, buckets).  Records naming anything else are ignored.
+
+METRICS = {
+    'vnc_connect_phase_seconds': ('histogram', 'Time spent in each phase of connection setup', SECONDS_BUCKETS),
+    'vnc_connect_seconds': ('histogram', 'Time from websocket upgrade to relaying (or rejecting)', SECONDS_BUCKETS),
+    'vnc_connections_total': ('counter', 'Connections by outcome and how their desktop was found', None),
+    'vnc_auth_cache_lookups_total': ('counter', 'checkAuthorization cache lookups, by hit or miss (auth_cache.py)', None),
+    'vnc_spawn_attempts_total': ('counter', 'start_VNC_server attempts made for connections', None),
+    'vnc_connection_bytes': ('histogram', 'Bytes relayed per connection', BYTES_BUCKETS),
+    'vnc_desktop_freezes_total': ('counter', 'Idle desktops frozen', None),
+    'vnc_desktop_thaw_seconds': ('histogram', 'Time to thaw a frozen desktop, by who thawed it', THAW_BUCKETS),
+    'vnc_desktop_frozen_cpu_seconds_saved_total': ('counter', 'Estimated CPU time not used by frozen desktops', None),
+}
+
+#
+# The sending side
+#
+
+_sender = None
+
+def send(records, path=METRICS_SOCKET):
+    r"""
+    Send a list of metric records to the collector.  A record is a dict
+    with 'name', 'labels' (a dict), and 'value' (a counter increment or
+    a histogram observation).  Never blocks and never fails.
+    """
+    global _sender
+    try:
+        if _sender is None:
+            _sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            _sender.setblocking(False)
+        _sender.sendto(json.dumps(records).encode(), path)
+    except OSError:
+        pass
+
+class ConnectionMetrics:
+    r"""
+    The phase timings and outcome of one connection, sent to the
+    collector by finish().
+
+        metrics = ConnectionMetrics()
+        with metrics.phase('auth'):
+            ...
+        metrics.label(desktop='spawned')
+        metrics.finish('relayed')
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = dict()
+        self.labels = {'desktop': 'none'}
+        self.attempts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.finished = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def label(self, **labels):
+        self.labels.update(labels)
+
+    def setup_done(self):
+        r"""
+        Mark the end of connection setup (the relay starts now).
+        """
+        self.setup_seconds = time.monotonic() - self.started
+
+    def finish(self, outcome):
+        r"""
+        Send this connection's numbers, once.  `outcome` is 'relayed',
+        'rejected' or 'failed'.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        setup_seconds = getattr(self, 'setup_seconds', time.monotonic() - self.started)
+        records = [{'name': 'vnc_connect_phase_seconds', 'labels': {'phase': phase}, 'value': seconds}
+                   for (phase, seconds) in self.phases.items()]
+        records.append({'name': 'vnc_connect_seconds', 'labels': {'outcome': outcome}, 'value': setup_seconds})
+        records.append({'name': 'vnc_connections_total', 'labels': dict(self.labels, outcome=outcome), 'value': 1})
+        if self.attempts:
+            records.append({'name': 'vnc_spawn_attempts_total', 'labels': {}, 'value': self.attempts})
+        if outcome == 'relayed':
+            records.append({'name': 'vnc_connection_bytes', 'labels': {'direction': 'in'}, 'value': self.bytes_in})
+            records.append({'name': 'vnc_connection_bytes', 'labels': {'direction': 'out'}, 'value': self.bytes_out})
+        send(records)
+
+class CountingSocket:
+    r"""
+    Wrap the socket `sock`, counting the bytes sent to it and received
+    from it into `metrics`.  Has the parts of the socket interface that
+    websockify's do_proxy uses.
+    """
+
+    def __init__(self, sock, metrics):
+        self.sock = sock
+        self.metrics = metrics
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.metrics.bytes_in += sent
+        return sent
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.metrics.bytes_out += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+#
+# The collector
+#
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+class Collector:
+    r"""
+    Counters and histograms accumulated from metric records.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: dict() for name in METRICS}
+
+    def add(self, record):
+        name = record.get('name')
+        if name not in METRICS:
+            return
+        (kind, _, buckets) = METRICS[name]
+        key = _label_key(record.get('labels', {}))
+        value = float(record.get('value', 0))
+        with self.lock:
+            if kind == 'counter':
+                self.values[name][key] = self.values[name].get(key, 0) + value
+            else:
+                h = self.values[name].get(key)
+                if h is None:
+                    h = self.values[name][key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+                for (i, le) in enumerate(buckets):
+                    if value <= le:
+                        h['buckets'][i] += 1
+                h['sum'] += value
+                h['count'] += 1
+
+    def as_json(self):
+        result = dict()
+        with self.lock:
+            for (name, series) in self.values.items():
+                (kind, _, buckets) = METRICS[name]
+                result[name] = []
+                for (key, v) in series.items():
+                    entry = {'labels': dict(key)}
+                    if kind == 'counter':
+                        entry['value'] = v
+                    else:
+                        entry.update(sum=v['sum'], count=v['count'],
+                                     buckets=dict(zip([str(le) for le in buckets], v['buckets'])))
+                    result[name].append(entry)
+        return result
+
+    def as_text(self):
+        def fmt(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for (k, v) in labels) + '}'
+        lines = []
+        with self.lock:
+            for (name, series) in self.values.items():
+                (kind, help, buckets) = METRICS[name]
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for (key, v) in sorted(series.items()):
+                    if kind == 'counter':
+                        lines.append('{}{} {}'.format(name, fmt(key), v))
+                        continue
+                    for (le, count) in zip(buckets, v['buckets']):
+                        lines.append('{}_bucket{} {}'.format(name, fmt(key + (('le', str(le)),)), count))
+                    lines.append('{}_bucket{} {}'.format(name, fmt(key + (('le', '+Inf'),)), v['count']))
+                    lines.append('{}_sum{} {}'.format(name, fmt(key), v['sum']))
+                    lines.append('{}_count{} {}'.format(name, fmt(key), v['count']))
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        collector = self.server.collector
+        if self.path == '/metrics':
+            body = collector.as_text().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(collector.as_json()).encode()
+            content_type = 'application/json'
+        elif self.path == '/spawn-queue.json':
+            body = json.dumps(queue_status()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _receive(sock, collector):
+    while True:
+        try:
+            records = json.loads(sock.recv(65536))
+        except ValueError:
+            continue
+        except OSError:
+            return
+        for record in records:
+            collector.add(record)
+
+def serve(path=METRICS_SOCKET, port=METRICS_PORT, watch_parent=False):
+    r"""
+    Collect metric records sent to `path` and serve them over HTTP on
+    localhost:`port` until killed (or, with `watch_parent`, until the
+    process that started us exits).
+    """
+    parent = os.getppid()
+    collector = Collector()
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    # the connection handlers run as root, like us, but the inetd servers don't
+    os.chmod(path, 0o600)
+    threading.Thread(target=_receive, args=(sock, collector), daemon=True).start()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.daemon_threads = True
+    server.collector = collector
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        while not watch_parent or os.getppid() == parent:
+            time.sleep(1)
+    finally:
+        server.server_close()
+        sock.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def start_metrics_service(path=METRICS_SOCKET, port=METRICS_PORT):
+    r"""
+    Fork a metrics collector that exits along with the calling process,
+    unless VNC_METRICS_PORT is 0.  Returns its pid, or None.
+    """
+    if port == 0:
+        return None
+    return start_service('metrics collector', serve, path, port)
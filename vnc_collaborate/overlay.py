@@ -0,0 +1,274 @@
+#
+# The teacher's labels, highlight and "End screenshare" button, drawn by
+# one process.
+#
+# Each of these used to be its own multiprocessing.Process (simple_text,
+# colored_rect and close_projection_button), forked from teacher_desktop
+# -- so carrying a copy of its whole interpreter -- just to run a Tk
+# main loop for one small window.  A 5x5 grid of ssvncviewers had 25
+# label processes, and re-laying out the grid killed and forked them
+# again.
+#
+# Instead, teacher_desktop starts
+#
+#     python3 -m vnc_collaborate overlay
+#
+# once, and sends it commands, as JSON lines on its stdin:
+#
+#     {"create": ID, "text": TEXT, "at": [X, Y]}
+#     {"create": ID, "rect": [X, Y, W, H], "color": COLOR, "title": TITLE}
+#     {"create": ID, "button": TEXT, "title": TITLE}
+#     {"move": ID, "at": [X, Y]}  or  {"move": ID, "rect": [X, Y, W, H]}
+#     {"retitle": ID, "text": TEXT}
+#     {"destroy": ID}
+#
+# Each ID is a window of its own (a Tk toplevel), since fvwm places,
+# layers and binds them by their titles.  A text label is titled with its
+# text, and (like simple_text did) is placed with the middle of its top
+# edge at (X, Y); a button goes in the top right corner of the screen.
+# Creating an ID that exists replaces it.  The windows' class is Tk, for
+# the teacher-mode fvwm config's "Style Tk".
+#
+# When a window is closed by the window manager (fvwm's "Close") or a
+# button is clicked, we destroy it and write
+#
+#     {"closed": ID}
+#
+# on our stdout.  When stdin closes, we exit.
+
+import sys
+import json
+import queue
+import threading
+import subprocess
+
+import tkinter as tk
+
+from .services import error
+
+REFRESH_MS = 50
+
+WINDOW_CLASS = 'Tk'
+
+LABEL_BG = 'cyan'
+LABEL_FG = 'black'
+
+class Overlays:
+    r"""
+    The overlay server's windows.
+    """
+
+    def __init__(self):
+        # the windows are toplevels of this one, which is never shown
+        self.root = tk.Tk(className=WINDOW_CLASS)
+        self.root.withdraw()
+        self.windows = dict()
+        self.anchors = dict()
+
+        self.messages = queue.Queue()
+        threading.Thread(target=self.read_messages, daemon=True).start()
+        self.root.after(REFRESH_MS, self.refresh)
+
+    def read_messages(self):
+        for line in sys.stdin:
+            try:
+                self.messages.put(json.loads(line))
+            except ValueError:
+                error('overlay: bad message', repr(line))
+        self.messages.put(None)
+
+    def create(self, message):
+        id = message['create']
+        self.destroy(id)
+        window = tk.Toplevel(self.root, class_=WINDOW_CLASS)
+        # placed before it's mapped, so it doesn't appear in the wrong place
+        window.withdraw()
+        window.protocol('WM_DELETE_WINDOW', lambda: self.close(id))
+        self.windows[id] = window
+        if 'text' in message:
+            tk.Label(window, text=message['text'], bg=LABEL_BG, fg=LABEL_FG).pack()
+            window.title(message['text'])
+            self.move({'move': id, 'at': message['at']})
+        elif 'rect' in message:
+            window.configure(background=message.get('color', 'red'))
+            window.title(message.get('title', id))
+            self.move({'move': id, 'rect': message['rect']})
+        elif 'button' in message:
+            button = tk.Label(window, text=message['button'], bg=LABEL_BG, fg=LABEL_FG)
+            button.bind('<Button-1>', lambda event: self.close(id))
+            button.pack()
+            window.title(message.get('title', id))
+            window.geometry('-0+0')
+        window.deiconify()
+
+    def move(self, message):
+        window = self.windows.get(message['move'])
+        if window is None:
+            return
+        if 'at' in message:
+            self.anchors[message['move']] = message['at']
+            (x, y) = message['at']
+            # the label's width, without mapping it
+            window.update_idletasks()
+            x = int(x - window.winfo_reqwidth()/2)
+            window.geometry('+{}+{}'.format(x, int(y)))
+        else:
+            (x, y, width, height) = (int(v) for v in message['rect'])
+            window.geometry('{}x{}+{}+{}'.format(width, height, x, y))
+
+    def retitle(self, message):
+        id = message['retitle']
+        window = self.windows.get(id)
+        if window is None:
+            return
+        for child in window.winfo_children():
+            child.configure(text=message['text'])
+        window.title(message['text'])
+        if id in self.anchors:
+            # keep it centered
+            self.move({'move': id, 'at': self.anchors[id]})
+
+    def destroy(self, id):
+        window = self.windows.pop(id, None)
+        self.anchors.pop(id, None)
+        if window is not None:
+            window.destroy()
+
+    def close(self, id):
+        self.destroy(id)
+        print(json.dumps({'closed': id}), flush=True)
+
+    def refresh(self):
+        while not self.messages.empty():
+            message = self.messages.get()
+            if message is None:
+                self.root.destroy()
+                return
+            try:
+                if 'create' in message:
+                    self.create(message)
+                elif 'move' in message:
+                    self.move(message)
+                elif 'retitle' in message:
+                    self.retitle(message)
+                elif 'destroy' in message:
+                    self.destroy(message['destroy'])
+            except (KeyError, TypeError, ValueError, tk.TclError) as ex:
+                error('overlay: bad message', message, repr(ex))
+        self.root.after(REFRESH_MS, self.refresh)
+
+def overlay(*args):
+    r"""
+    overlay
+
+    Show the windows that teacher_desktop asks for on our stdin, until
+    it closes.
+    """
+    Overlays().root.mainloop()
+
+class Overlay:
+    r"""
+    teacher_desktop's end of an overlay server: starts one (when it's
+    first needed, and again if it dies, with the windows it had), and
+    sends it commands, when they change something.  `on_close` is called
+    (from another thread) with the ID of a window that was closed or
+    clicked.
+    """
+
+    def __init__(self, on_close=None):
+        self.proc = None
+        self.on_close = on_close
+        # ID -> the message that would create the window as it is now
+        self.windows = dict()
+
+    def _start(self):
+        self.proc = subprocess.Popen(['python3', '-m', 'vnc_collaborate', 'overlay'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        threading.Thread(target=self._read_reports, args=(self.proc,), daemon=True).start()
+        for message in list(self.windows.values()):
+            self._write(message)
+
+    def _read_reports(self, proc):
+        for line in proc.stdout:
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if 'closed' in report:
+                self.windows.pop(report['closed'], None)
+                if self.on_close:
+                    self.on_close(report['closed'])
+
+    def _write(self, message):
+        try:
+            self.proc.stdin.write(json.dumps(message).encode() + b'\n')
+            self.proc.stdin.flush()
+        except OSError:
+            # it died; _send will start another
+            pass
+
+    def _send(self, message):
+        if self.proc is None or self.proc.poll() is not None:
+            if self.proc is not None:
+                error('overlay server died')
+            self._start()
+        self._write(message)
+
+    def _create(self, message):
+        if self.windows.get(message['create']) != message:
+            # a new server gets the windows we had before this one
+            self._send(message)
+            self.windows[message['create']] = message
+
+    def __contains__(self, id):
+        return id in self.windows
+
+    def create_text(self, id, text, x, y):
+        r"""
+        Show `text`, with the middle of its top edge at (`x`, `y`).
+        """
+        self._create({'create': id, 'text': text, 'at': [int(x), int(y)]})
+
+    def create_rect(self, id, width, height, x, y, color='red', title='highlight'):
+        self._create({'create': id, 'rect': [int(x), int(y), int(width), int(height)],
+                      'color': color, 'title': title})
+
+    def create_button(self, id, text, title):
+        r"""
+        Show a button labeled `text` in the top right corner of the screen.
+        """
+        self._create({'create': id, 'button': text, 'title': title})
+
+    def move(self, id, x, y):
+        message = self.windows.get(id)
+        if message is None:
+            return
+        if 'at' in message:
+            position = {'at': [int(x), int(y)]}
+        elif 'rect' in message:
+            position = {'rect': [int(x), int(y)] + message['rect'][2:]}
+        else:
+            return
+        if any(message[key] != value for (key, value) in position.items()):
+            self._send(dict(position, move=id))
+            self.windows[id] = dict(message, **position)
+
+    def retitle(self, id, text):
+        message = self.windows.get(id)
+        if message is not None and message.get('text', text) != text:
+            self._send({'retitle': id, 'text': text})
+            self.windows[id] = dict(message, text=text)
+
+    def destroy(self, id):
+        if self.windows.pop(id, None) is not None:
+            self._send({'destroy': id})
+
+    def terminate(self):
+        self.windows.clear()
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.terminate()
+            self.proc = None
@@ -0,0 +1,380 @@
+#
+# Predictive desktop pre-spawn when a meeting starts.
+#
+# A class starts with every student opening the remote desktop within
+# a minute or two of each other, and each of them cold-spawns their
+# own desktop (see tests/remote-desktop-class-start.cjs for the spawn
+# storm that produces).  But we usually know who's coming: the
+# meeting was just created by its moderator's login (bbb-auth-jwt
+# calls bigbluebutton.create), and the class is the same people as
+# last time.  So when a meeting is created we start the expected
+# desktops ahead of time, a few at a time, in the order people are
+# likely to need them: the teacher first, then the meeting's shared
+# desktop, then students in the order they arrived last session.
+#
+# The expected users come from two places:
+#
+#   /etc/bigbluebutton/rosters/<meetingID>  (optional) one BBB fullName
+#       per line, as it appears in the JWT 'sub' claim; '#' comments
+#
+#   /var/lib/vnc-collaborate/attendance/<meetingID>.json  written by the
+#       proxy (record_arrival below, called from select_target) with
+#       each user's arrival time, relative to the meeting's createTime,
+#       for the current and the previous session of the meeting
+#
+# Both are keyed on the external meetingID, the one in the JWT 'mtg'
+# claim (or the hostname), since that's what stays the same from one
+# session of a class to the next.
+#
+# A prewarm is just ensure_vnc_server for each user, so it takes the
+# same per-socket flock as the proxy: a student who connects while
+# their desktop is being pre-spawned waits for that spawn instead of
+# starting a second one.  VNC_PREWARM_CONCURRENCY (default 4) bounds
+# how many spawns run at once, so the prewarm doesn't become a spawn
+# storm of its own.
+#
+# bbb-auth-jwt runs as www-data and can't start desktops itself, so it
+# asks the proxy to do it: websockify() starts a prewarm service (like
+# the roster service and the warm pool) listening for meetingIDs on a
+# datagram socket, PREWARM_SOCKET, that group bigbluebutton can write.
+#
+# The proxy also hands the service the spawns of users who gave up
+# waiting in the spawn queue (request_spawn below).  Those start a
+# desktop at a priority of the sender's choosing, so they're only taken
+# from the proxy itself (root, or whoever it runs as): the kernel tells
+# us each datagram's sender (SO_PASSCRED).  And all a request names is
+# the BBB userID; what to start, as whom, and at what priority come
+# from the roster, the same way select_target decides them.
+#
+# By hand:
+#
+#     python3 -m vnc_collaborate prewarm MEETINGID
+
+import os
+import grp
+import pwd
+import json
+import time
+import fcntl
+import struct
+import socket
+import threading
+import concurrent.futures
+
+import bigbluebutton_roster
+
+from .services import error, start_service
+from .users import fullName_to_UNIX_username, fullName_to_rfbport
+from .spawn_queue import PRIORITY_TEACHER, PRIORITY_STUDENT, PRIORITY_PREWARM
+from .provision import provision_users
+from .privileged import _check_user
+
+ROSTER_DIR = '/etc/bigbluebutton/rosters'
+ATTENDANCE_DIR = '/var/lib/vnc-collaborate/attendance'
+
+PREWARM_SOCKET = '/run/vnc-collaborate-prewarm.sock'
+
+PREWARM_CONCURRENCY = int(os.environ.get('VNC_PREWARM_CONCURRENCY', '4'))
+
+# Moderators log in again (a page reload, a second device) long after
+# the meeting was created; don't prewarm the same meeting more often
+# than this many seconds.
+
+PREWARM_INTERVAL = 300
+
+# Prewarms wait behind every live connection in the spawn queue
+# (spawn_queue.py), so they get much longer than a connection's 40 s.
+
+PREWARM_TIMEOUT = 600
+
+def _attendance_path(meetingID):
+    # meetingIDs are chosen by whoever signs the JWT; keep them out of the path
+    return os.path.join(ATTENDANCE_DIR, meetingID.replace('/', '_') + '.json')
+
+def _is_teacher(UNIXuser):
+    # the same test select_target uses to pick teacher_desktop
+    try:
+        return UNIXuser in grp.getgrnam('bigbluebutton').gr_mem
+    except KeyError:
+        return False
+
+#
+# Attendance history
+#
+
+def record_arrival(attendee, UNIXuser):
+    r"""
+    Note that `UNIXuser` (the roster `attendee` dict of a user connecting
+    to their desktop) has arrived, if this is their first connection of
+    this session of the meeting.  When the meeting's createTime changes,
+    the current session's arrivals become the previous session's.
+    """
+    if not attendee.get('meetingID') or not attendee.get('createTime'):
+        return
+    offset = time.time() - int(attendee['createTime']) / 1000
+
+    os.makedirs(ATTENDANCE_DIR, mode=0o755, exist_ok=True)
+    fd = os.open(_attendance_path(attendee['meetingID']), os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            history = json.load(f)
+        except ValueError:
+            history = dict()
+
+        if history.get('createTime') != attendee['createTime']:
+            if history.get('arrivals'):
+                history['previous'] = history['arrivals']
+            history['createTime'] = attendee['createTime']
+            history['arrivals'] = dict()
+
+        if UNIXuser in history['arrivals']:
+            return
+        history['arrivals'][UNIXuser] = {'offset': round(offset, 1),
+                                         'moderator': attendee.get('role') == 'MODERATOR'}
+        f.seek(0)
+        f.truncate()
+        json.dump(history, f)
+
+def rostered_users(meetingID):
+    r"""
+    Return the UNIX users in `meetingID`'s roster file, if it has one.
+    """
+    rostered = []
+    try:
+        with open(os.path.join(ROSTER_DIR, meetingID.replace('/', '_'))) as f:
+            for line in f:
+                fullName = line.split('#')[0].strip()
+                if fullName and not fullName_to_rfbport(fullName):
+                    rostered.append(fullName_to_UNIX_username(fullName))
+    except OSError:
+        pass
+    return rostered
+
+def expected_users(meetingID):
+    r"""
+    Return the UNIX users expected in `meetingID` as (UNIXuser, teacher)
+    tuples, in the order their desktops should be started: teachers first,
+    then students by their arrival time last session, then roster-file
+    users we haven't seen yet.
+    """
+    arrivals = dict()
+    try:
+        with open(_attendance_path(meetingID)) as f:
+            history = json.load(f)
+        # The previous session predicts this one; arrivals already seen
+        # this session (a prewarm after the class started) come first.
+        for (UNIXuser, arrival) in history.get('previous', {}).items():
+            arrivals[UNIXuser] = arrival
+        for (UNIXuser, arrival) in history.get('arrivals', {}).items():
+            arrivals[UNIXuser] = dict(arrival, offset=-1)
+    except (OSError, ValueError):
+        pass
+
+    rostered = rostered_users(meetingID)
+
+    users = []
+    for UNIXuser in dict.fromkeys(list(arrivals) + rostered):
+        arrival = arrivals.get(UNIXuser, {})
+        teacher = arrival.get('moderator', False) or _is_teacher(UNIXuser)
+        users.append((UNIXuser, teacher, arrival.get('offset', float('inf'))))
+
+    # sorted() is stable, so unseen roster users keep the file's order
+    users.sort(key=lambda u: (not u[1], u[2]))
+    return [(UNIXuser, teacher) for (UNIXuser, teacher, offset) in users if UNIXuser]
+
+#
+# Starting the desktops
+#
+
+def _prewarm_user(UNIXuser, teacher=False):
+    from .websockify import get_or_add_user, ensure_vnc_server
+    passwd_struct = get_or_add_user(UNIXuser)
+    # Users with their own .vncsocket or .vncserver never use /run/vnc/USER
+    if os.path.exists(passwd_struct.pw_dir + '/.vncsocket') or os.path.exists(passwd_struct.pw_dir + '/.vncserver'):
+        return
+    # The teacher is likely to be connecting right now
+    ensure_vnc_server(UNIXuser, '/run/vnc/' + UNIXuser, total_timeout=PREWARM_TIMEOUT,
+                      priority=PRIORITY_TEACHER if teacher else PRIORITY_PREWARM)
+
+def _prewarm_shared_desktop(meetingID):
+    r"""
+    Start the view-only 'default' desktop that select_target gives
+    participants without a UNIX account, if `meetingID` is running.
+    """
+    from .websockify import ensure_vnc_server
+    roster = bigbluebutton_roster.Roster()
+    roster.refresh()
+    for meeting in roster.meetings.values():
+        if meeting['meetingID'] == meetingID:
+            ensure_vnc_server('default', '/run/vnc/' + meeting['internalMeetingID'], viewOnly=True,
+                              total_timeout=PREWARM_TIMEOUT, priority=PRIORITY_PREWARM)
+
+def prewarm_meeting(meetingID, executor):
+    r"""
+    Create the accounts of the users expected in `meetingID` that don't
+    exist yet, then queue their desktops on `executor`, in priority order,
+    and return the futures.  The executor starts them in the order they
+    were queued.
+    """
+    futures = dict()
+    users = expected_users(meetingID)
+    # in one batch, rather than one adduser per spawn (see provision.py)
+    provision_users([UNIXuser for (UNIXuser, teacher) in users])
+    for (UNIXuser, teacher) in users:
+        if teacher:
+            futures[executor.submit(_prewarm_user, UNIXuser, teacher=True)] = UNIXuser
+    futures[executor.submit(_prewarm_shared_desktop, meetingID)] = meetingID
+    for (UNIXuser, teacher) in users:
+        if not teacher:
+            futures[executor.submit(_prewarm_user, UNIXuser)] = UNIXuser
+    return futures
+
+def _report(futures):
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            future.result()
+        except Exception as ex:
+            error('prewarm of', futures[future], 'failed:', repr(ex))
+
+def _prewarm_and_report(meetingID, executor):
+    _report(prewarm_meeting(meetingID, executor))
+
+def prewarm(meetingID=None, *args):
+    r"""
+    prewarm MEETINGID
+
+    Start the desktops expected in a meeting now, and wait for them.
+    """
+    if meetingID is None:
+        print("Usage: prewarm MEETINGID")
+        return 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PREWARM_CONCURRENCY) as executor:
+        futures = prewarm_meeting(meetingID, executor)
+        print('Prewarming', ', '.join(futures.values()))
+        _report(futures)
+
+#
+# The prewarm service
+#
+
+def request_spawn(userID, path=PREWARM_SOCKET):
+    r"""
+    Ask the prewarm service to start the desktop that select_target
+    would start for the attendee `userID`.  select_target does this when
+    a connection gives up waiting in the spawn queue, so that the desktop
+    keeps its place in line and is running when its user reconnects.
+    Never blocks and never fails.
+    """
+    request = {'userID': userID}
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto(json.dumps(request).encode(), path)
+        finally:
+            sock.close()
+    except OSError:
+        pass
+
+def _spawn(request):
+    from .websockify import lookup_attendee, ensure_vnc_server
+    try:
+        attendee = lookup_attendee(request['userID'])
+        if fullName_to_rfbport(attendee['fullName']):
+            raise ValueError('{} has no desktop of ours'.format(attendee['fullName']))
+        UNIXuser = fullName_to_UNIX_username(attendee['fullName'])
+        if UNIXuser:
+            # their own desktop, at the priority select_target gives them
+            rfbpath = '/run/vnc/' + UNIXuser
+            viewOnly = False
+            if _is_teacher(UNIXuser) or attendee.get('role') == 'MODERATOR':
+                priority = PRIORITY_TEACHER
+            else:
+                priority = PRIORITY_STUDENT
+        else:
+            # their meeting's shared desktop
+            UNIXuser = 'default'
+            rfbpath = '/run/vnc/' + attendee['internalMeetingID']
+            viewOnly = True
+            priority = PRIORITY_TEACHER
+        if os.path.dirname(rfbpath) != '/run/vnc' or os.path.basename(rfbpath).startswith('.'):
+            raise ValueError('not a desktop socket: ' + rfbpath)
+        _check_user(UNIXuser)
+        ensure_vnc_server(UNIXuser, rfbpath, viewOnly=viewOnly,
+                          total_timeout=PREWARM_TIMEOUT, priority=priority)
+    except Exception as ex:
+        error('spawn of', request, 'failed:', repr(ex))
+
+def _sender_uid(ancdata):
+    for (level, type, data) in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_CREDENTIALS:
+            (pid, uid, gid) = struct.unpack('3i', data[:struct.calcsize('3i')])
+            return uid
+    return None
+
+def serve(path=PREWARM_SOCKET, watch_parent=False):
+    r"""
+    Prewarm the meetings named in datagrams sent to `path` until killed
+    (or, with `watch_parent`, until the process that started us exits).
+    A datagram holding a JSON object is a request_spawn() instead, taken
+    only from root or our own user.
+    """
+    parent = os.getppid()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+    sock.bind(path)
+    try:
+        os.chown(path, -1, grp.getgrnam('bigbluebutton').gr_gid)
+        os.chmod(path, 0o660)
+    except (KeyError, OSError):
+        os.chmod(path, 0o600)
+    sock.settimeout(1)
+    spawners = {0, os.geteuid()}
+
+    # One executor for every meeting, so that two classes starting at
+    # once share the concurrency bound rather than doubling it.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREWARM_CONCURRENCY)
+    last_prewarm = dict()
+
+    try:
+        while not watch_parent or os.getppid() == parent:
+            try:
+                (data, ancdata, flags, address) = sock.recvmsg(4096, socket.CMSG_SPACE(struct.calcsize('3i')))
+            except socket.timeout:
+                continue
+            meetingID = data.decode(errors='replace').strip()
+            if meetingID.startswith('{'):
+                if _sender_uid(ancdata) not in spawners:
+                    error('spawn request from uid', _sender_uid(ancdata), 'refused')
+                    continue
+                # Each in its own thread: these are live users, who shouldn't
+                # wait for the executor's prewarms (the spawn queue orders them)
+                try:
+                    threading.Thread(target=_spawn, args=(json.loads(meetingID),), daemon=True).start()
+                except ValueError:
+                    pass
+                continue
+            now = time.monotonic()
+            if not meetingID or now - last_prewarm.get(meetingID, -PREWARM_INTERVAL) < PREWARM_INTERVAL:
+                continue
+            last_prewarm[meetingID] = now
+            # Provisioning the meeting's accounts takes a while; keep listening
+            threading.Thread(target=_prewarm_and_report, args=(meetingID, executor), daemon=True).start()
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def start_prewarm_service(path=PREWARM_SOCKET):
+    r"""
+    Fork a process running the prewarm service on `path` that exits along
+    with the calling process.  Returns its pid.
+    """
+    return start_service('prewarm service', serve, path)
@@ -0,0 +1,494 @@
+#
+# The privileged operations of a desktop spawn, without sudo.
+#
+# Starting a desktop used to fork a chain of sudos: `sudo mkdir -p
+# /run/vnc`, `sudo machinectl shell ...`, then `sudo chgrp bigbluebutton`
+# and `sudo chmod g+rw` on its socket, `sudo adduser` for a new user, and
+# a `sudo -u USER [-g bigbluebutton] -i ...` for every inetd session.
+# Each one is a fork, an exec and a PAM conversation, tens of
+# milliseconds apiece, on the path of every connection -- and the
+# websockify proxy runs as root (bbb-vnc-collaborate.service), so none
+# of them granted anything it didn't already have.
+#
+# The operations are collected here, and done in-process when we are
+# root: mkdir, chown and chmod are system calls, adduser and machinectl
+# are exec'ed directly, and an inetd session is started as its user the
+# way sudo -i would start it (the user's login shell, running the
+# command, with the user's uid, groups, home and a fresh environment),
+# but with the uid switch done by the exec'ing child itself.
+#
+# A caller that isn't root asks the spawn helper instead: a root process
+# listening on HELPER_SOCKET (a SOCK_SEQPACKET socket), which checks the
+# caller's credentials (SO_PEERCRED) against VNC_HELPER_USERS, does the
+# operation, and returns a file descriptor (over SCM_RIGHTS) where there
+# is one: the socket of an inetd session, or a pidfd for a desktop's
+# machinectl.  The helper only runs sessions and desktops as ordinary
+# users, builds their commands itself from validated fields (a desktop's
+# user, display, socket and view-only flag; which of our sessions, and
+# its display), only creates accounts for BBB attendees, and only
+# touches sockets in /run/vnc, so the privilege boundary is this short
+# list of operations rather than sudoers.  It sets a new desktop's
+# resource budget (budgets.py), for the role it works out itself, and
+# thaws frozen desktops (freezer.py) for anyone who asks, since the
+# teachers' grids need to.  The proxy starts the helper (like its other
+# helper services) if VNC_HELPER_USERS names anyone or desktops get
+# frozen; it can also be run by itself:
+#
+#     python3 -m vnc_collaborate spawn-helper
+#
+# Requests and replies are single JSON datagrams:
+#
+#     {"op": "start_session", "args": ["alice", "student_desktop", {...}, "bigbluebutton", 12]}
+#     {"result": null}                  (+ the session's socket)
+#     {"error": "..."}
+
+import os
+import re
+import grp
+import pwd
+import json
+import shlex
+import select
+import socket
+import time
+import struct
+import threading
+import subprocess
+
+import bigbluebutton_roster
+
+from .services import error, start_service
+from .freezer import FREEZE_AFTER, thaw_desktop
+from .budgets import apply_budget, desktop_role
+from .displays import FIRST_DISPLAY, LAST_DISPLAY
+from .users import fullName_to_UNIX_username
+
+HELPER_SOCKET = '/run/vnc-collaborate-helper.sock'
+
+# Users (besides root) whose processes may use the spawn helper
+
+HELPER_USERS = [u.strip() for u in os.environ.get('VNC_HELPER_USERS', '').split(',') if u.strip()]
+
+RUN_DIR = '/run/vnc'
+
+# Where desktops may listen: RUN_DIR, and the warm pool's directory
+
+DESKTOP_SOCKET_DIRS = (RUN_DIR, os.path.join(RUN_DIR, '.pool'))
+
+# The PATH that sudo's secure_path gave sessions
+
+SECURE_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/snap/bin'
+
+# The lowest uid the helper will run anything as
+
+FIRST_USER_UID = 1000
+
+# The inetd sessions start_session runs (see _session_argv), the primary
+# groups they may run as, and the variables a caller may put in their
+# environment
+
+SESSIONS = ('vncserver', 'teacher_desktop', 'student_desktop')
+
+SESSION_GROUPS = (None, 'bigbluebutton')
+
+SESSION_ENV = ('UserId', 'MeetingId', 'fullName', 'UNIXuser')
+
+# The roster the helper checks add_user requests against, created on first
+# use, and how old (seconds) a snapshot of it may be
+
+add_user_roster = None
+
+ADD_USER_ROSTER_AGE = 2
+
+# Operations anybody may ask for: thawing a desktop only undoes a freeze
+
+OPEN_OPERATIONS = {'thaw'}
+
+#
+# The operations, as done by root
+#
+
+def _make_run_dir():
+    os.makedirs(RUN_DIR, exist_ok=True)
+    os.chmod(RUN_DIR, 0o1777)
+
+def _share_socket(path):
+    os.chown(path, -1, grp.getgrnam('bigbluebutton').gr_gid)
+    os.chmod(path, os.stat(path).st_mode & 0o7777 | 0o060)
+
+def _add_user(UNIXuser, create_home=True):
+    subprocess.run(['adduser', '--force-badname', '--disabled-password', '--gecos', '']
+                   + ([] if create_home else ['--no-create-home']) + [UNIXuser])
+
+def _start_desktop(UNIXuser, display, rfbpath, viewOnly=False):
+    # GPT-4o suggested machinectl shell as a way to get gnome-session
+    # to start properly (i.e, to start at all).
+    # I had done it with sudo on Ubuntu 18, but had problems with sudo
+    # on Ubuntu 20; gnome-shell kept failing with "Unset XDG_SESSION_ID".
+    #
+    # The display number has to be tigervncserver.pl's first argument.
+    args = ['machinectl', 'shell', UNIXuser+'@.host',
+            '/usr/bin/python3', '-m', 'vnc_collaborate', 'tigervncserver',
+            ':{}'.format(display),
+            '-localhost', 'yes',
+            '-SendPrimary=0', '-SetPrimary=0',
+            '-rfbunixpath', rfbpath,
+            '-SecurityTypes', 'None',
+            '-BlacklistThreshold', '1000000',
+            '-fg',
+    ]
+
+    if (viewOnly):
+        args.extend(['-AcceptPointerEvents=0', '-AcceptKeyEvents=0'])
+
+    return subprocess.Popen(args, start_new_session=True)
+
+def _session_argv(UNIXuser, session, display=None):
+    if session == 'vncserver':
+        # the user's own ~/.vncserver (see select_target)
+        return [pwd.getpwnam(UNIXuser).pw_dir + '/.vncserver']
+    # Our Xvnc, in -inetd mode on the connection itself, running
+    # teacher_desktop or student_desktop.
+    #
+    # -blank-name forces an empty RFB desktop name at spawn. Without it,
+    # tigervncserver's stock default ("<HOSTFQDN>:<display> (<USER>)")
+    # rides in the RFB ServerInit the client reads on connect, so the
+    # moderator user list briefly flashes e.g. "itpietraining.com:29
+    # (SamuelRodriguez)" before student_desktop.py blanks it a beat
+    # later. We use a dedicated no-argument flag (not -name "") because
+    # this command goes through the user's login shell (as it did
+    # under "sudo -i", and socat's EXEC: address before that), which
+    # can't reliably carry an empty or whitespace-containing argument
+    # token.
+    command = "python3 -m vnc_collaborate tigervncserver :{} -quiet -fg -localhost yes -SecurityTypes None -I-KNOW-THIS-IS-INSECURE -blank-name -inetd -xstartup python3 -- -m vnc_collaborate {}".format(display, session)
+    return command.split()
+
+def _start_session(UNIXuser, session, env, group=None, display=None):
+    pw = pwd.getpwnam(UNIXuser)
+    gid = grp.getgrnam(group).gr_gid if group else pw.pw_gid
+    shell = pw.pw_shell or '/bin/sh'
+    argv = _session_argv(UNIXuser, session, display)
+    env = {name: str(value) for (name, value) in env.items() if name in SESSION_ENV}
+    session_env = dict(env, HOME=pw.pw_dir, SHELL=shell, USER=UNIXuser, LOGNAME=UNIXuser, PATH=SECURE_PATH)
+
+    (ours, theirs) = socket.socketpair()
+    try:
+        # A login shell running the command, as `sudo -i` ran it
+        subprocess.Popen(['-' + os.path.basename(shell), '-c', shlex.join(argv)], executable=shell,
+                         stdin=theirs, stdout=theirs, env=session_env,
+                         cwd=pw.pw_dir if os.path.isdir(pw.pw_dir) else '/',
+                         user=pw.pw_uid, group=gid, extra_groups=os.getgrouplist(UNIXuser, pw.pw_gid))
+    except Exception:
+        ours.close()
+        raise
+    finally:
+        theirs.close()
+    return ours
+
+#
+# The spawn helper's client side
+#
+
+class RemoteProcess:
+    r"""
+    A process the spawn helper started for us, watched through a pidfd.
+    Has the parts of subprocess.Popen that wait_for_path uses.  We can
+    tell that it exited, but not its exit status.
+    """
+
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.pidfd = pidfd
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and select.select([self.pidfd], [], [], 0)[0]:
+            self.returncode = -1
+        return self.returncode
+
+    def __del__(self):
+        os.close(self.pidfd)
+
+def _budget_desktop(UNIXuser):
+    return apply_budget(pwd.getpwnam(UNIXuser).pw_uid, desktop_role(UNIXuser))
+
+def _call(op, *args, path=HELPER_SOCKET):
+    r"""
+    Have the spawn helper do `op`.  Returns its result and the file
+    descriptors that came with it.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as sock:
+        sock.connect(path)
+        sock.send(json.dumps({'op': op, 'args': args}).encode())
+        (message, fds, _, _) = socket.recv_fds(sock, 65536, 1)
+    reply = json.loads(message)
+    if 'error' in reply:
+        for fd in fds:
+            os.close(fd)
+        raise RuntimeError('spawn helper: ' + reply['error'])
+    return (reply.get('result'), fds)
+
+#
+# The operations, for everybody
+#
+
+def make_run_dir():
+    r"""
+    Create /run/vnc, where the desktops' sockets live.
+    """
+    if os.geteuid() == 0:
+        _make_run_dir()
+    elif not os.path.isdir(RUN_DIR):
+        _call('make_run_dir')
+
+def share_socket(path):
+    r"""
+    Let group bigbluebutton (teachers, screen shares) connect to the
+    desktop socket `path`.
+    """
+    if os.geteuid() == 0:
+        _share_socket(path)
+    else:
+        _call('share_socket', path)
+
+def add_user(UNIXuser, create_home=True):
+    r"""
+    Create the account `UNIXuser`, with its home directory unless
+    `create_home` is False (see provision.py).
+    """
+    if os.geteuid() == 0:
+        _add_user(UNIXuser, create_home)
+    else:
+        _call('add_user', UNIXuser, create_home)
+
+def start_desktop(UNIXuser, display, rfbpath, viewOnly=False):
+    r"""
+    Start `UNIXuser`'s desktop (our tigervncserver, in a `machinectl
+    shell`) on X display `display`, listening on `rfbpath`, and without
+    input if `viewOnly`.  Returns the subprocess.Popen, or a
+    RemoteProcess if the spawn helper started it.
+    """
+    if os.geteuid() == 0:
+        return _start_desktop(UNIXuser, display, rfbpath, viewOnly)
+    (pid, fds) = _call('start_desktop', UNIXuser, display, rfbpath, viewOnly)
+    return RemoteProcess(pid, fds[0])
+
+def budget_desktop(UNIXuser):
+    r"""
+    Set `UNIXuser`'s slice to the budget for their desktop's role (see
+    budgets.py).  Returns True if systemctl did.
+    """
+    if os.geteuid() == 0:
+        return _budget_desktop(UNIXuser)
+    (result, _) = _call('budget_desktop', UNIXuser)
+    return result
+
+def thaw(rfbpath, by):
+    r"""
+    Thaw the frozen desktop listening on `rfbpath` (see freezer.py) for
+    a caller that isn't root.  Returns how long that took.
+    """
+    (result, _) = _call('thaw', rfbpath, by)
+    return result
+
+def start_session(UNIXuser, session, env, group=None, display=None):
+    r"""
+    Start `session` as `UNIXuser` (with primary group `group`, if given)
+    inetd-style, with one end of a socketpair as its stdin and stdout,
+    and return the other end.  `session` is one of SESSIONS: the user's
+    own ~/.vncserver, or our Xvnc on X display `display` running
+    teacher_desktop or student_desktop.  The SESSION_ENV variables in
+    `env` are passed to it; the rest of its environment is set up as for
+    a login.
+    """
+    if os.geteuid() == 0:
+        _check_session_args(UNIXuser, session, env, group, display)
+        return _start_session(UNIXuser, session, env, group, display)
+    (_, fds) = _call('start_session', UNIXuser, session, env, group, display)
+    return socket.socket(fileno=fds[0])
+
+#
+# The spawn helper
+#
+
+def _check_user(UNIXuser):
+    if pwd.getpwnam(UNIXuser).pw_uid < FIRST_USER_UID:
+        raise PermissionError('{} is a system account'.format(UNIXuser))
+
+def _check_run_socket(path):
+    if os.path.dirname(os.path.realpath(path)) != RUN_DIR:
+        raise PermissionError('{} is not in {}'.format(path, RUN_DIR))
+
+def _check_display(display):
+    if type(display) is not int or not FIRST_DISPLAY <= display <= LAST_DISPLAY:
+        raise ValueError('bad display {!r}'.format(display))
+
+def _check_desktop_args(UNIXuser, display, rfbpath, viewOnly):
+    _check_user(UNIXuser)
+    _check_display(display)
+    # a desktop's own socket, or a warm pool desktop's (see warm_pool.py)
+    if os.path.dirname(os.path.realpath(rfbpath)) not in DESKTOP_SOCKET_DIRS:
+        raise PermissionError('{} is not a desktop socket'.format(rfbpath))
+    if type(viewOnly) is not bool:
+        raise ValueError('bad viewOnly {!r}'.format(viewOnly))
+
+def _check_session_args(UNIXuser, session, env, group=None, display=None):
+    _check_user(UNIXuser)
+    if session not in SESSIONS:
+        raise ValueError('unknown session {!r}'.format(session))
+    if session == 'vncserver':
+        if display is not None:
+            raise ValueError('~/.vncserver takes no display')
+    else:
+        _check_display(display)
+    if not isinstance(env, dict):
+        raise ValueError('bad environment {!r}'.format(env))
+    if group not in SESSION_GROUPS:
+        raise PermissionError('sessions may not run as group {!r}'.format(group))
+
+def _may_add_user(UNIXuser):
+    r"""
+    Is `UNIXuser` somebody a non-root proxy may create an account for:
+    an attendee of a running meeting, or a user in one of the roster
+    files that prewarm.py reads?
+    """
+    from .prewarm import ROSTER_DIR, rostered_users
+    global add_user_roster
+    if add_user_roster is None:
+        add_user_roster = bigbluebutton_roster.Roster()
+    # a user who just joined isn't in a snapshot from before they did
+    add_user_roster.refresh(time.monotonic() - ADD_USER_ROSTER_AGE)
+    if any(fullName_to_UNIX_username(attendee['fullName']) == UNIXuser
+           for attendee in add_user_roster.users.values()):
+        return True
+    try:
+        meetingIDs = os.listdir(ROSTER_DIR)
+    except OSError:
+        return False
+    return any(UNIXuser in rostered_users(meetingID) for meetingID in meetingIDs)
+
+def _serve_request(request, privileged=True):
+    r"""
+    Do one request, for a caller who may do all of them (`privileged`)
+    or only the OPEN_OPERATIONS.  Returns (result, fds to send and then
+    close).
+    """
+    op = request.get('op')
+    args = request.get('args', [])
+    if op == 'make_run_dir':
+        _make_run_dir()
+        return (None, [])
+    elif op == 'share_socket':
+        _check_run_socket(args[0])
+        _share_socket(args[0])
+        return (None, [])
+    elif op == 'add_user':
+        if not re.fullmatch(r'[\w][\w.-]*', args[0]):
+            raise ValueError('bad user name {!r}'.format(args[0]))
+        if not _may_add_user(args[0]):
+            raise PermissionError('{} is not in any meeting or roster'.format(args[0]))
+        _add_user(args[0], bool(args[1]) if len(args) > 1 else True)
+        return (None, [])
+    elif op == 'start_desktop':
+        # the arguments are checked one by one, and the command built here
+        _check_desktop_args(*args)
+        proc = _start_desktop(*args)
+        pidfd = os.pidfd_open(proc.pid)
+        # reap it when it's done
+        threading.Thread(target=proc.wait, daemon=True).start()
+        return (proc.pid, [pidfd])
+    elif op == 'start_session':
+        # the session is one of ours, its command built here
+        _check_session_args(*args)
+        sock = _start_session(*args)
+        return (None, [sock.detach()])
+    elif op == 'budget_desktop':
+        _check_user(args[0])
+        return (_budget_desktop(args[0]), [])
+    elif op == 'thaw':
+        _check_run_socket(args[0])
+        # only our own users' thaws keep the desktop from being frozen
+        return (thaw_desktop(args[0], str(args[1]), mark_used=privileged), [])
+    raise ValueError('unknown operation {!r}'.format(op))
+
+def _serve_connection(conn, allowed_uids):
+    try:
+        (pid, uid, gid) = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                              struct.calcsize('3i')))
+        fds = []
+        try:
+            request = json.loads(conn.recv(65536))
+            privileged = uid in allowed_uids
+            if not privileged and request.get('op') not in OPEN_OPERATIONS:
+                raise PermissionError('uid {} may not use the spawn helper'.format(uid))
+            (result, fds) = _serve_request(request, privileged)
+            socket.send_fds(conn, [json.dumps({'result': result}).encode()], fds)
+        except Exception as ex:
+            error('spawn helper: request from pid {} (uid {}) failed: {!r}'.format(pid, uid, ex))
+            conn.send(json.dumps({'error': str(ex)}).encode())
+        finally:
+            for fd in fds:
+                os.close(fd)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def serve(path=HELPER_SOCKET, users=HELPER_USERS, watch_parent=False):
+    r"""
+    Serve spawn helper requests on `path` from root and `users` until
+    killed (or, with `watch_parent`, until the process that started us
+    exits).
+    """
+    parent = os.getppid()
+    allowed_uids = {0}
+    for user in users:
+        try:
+            allowed_uids.add(pwd.getpwnam(user).pw_uid)
+        except KeyError:
+            error('spawn helper: no such user', user)
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.bind(path)
+    # SO_PEERCRED is the access check; the mode just keeps out everybody else
+    os.chmod(path, 0o666)
+    sock.listen(64)
+    sock.settimeout(1)
+    try:
+        while not watch_parent or os.getppid() == parent:
+            try:
+                (conn, _) = sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            threading.Thread(target=_serve_connection, args=(conn, allowed_uids), daemon=True).start()
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def start_helper_service(path=HELPER_SOCKET, users=HELPER_USERS):
+    r"""
+    Fork a spawn helper that exits along with the calling process, if
+    we're root and VNC_HELPER_USERS names somebody to serve (or desktops
+    get frozen, and teachers' grids need to thaw them).  Returns its pid,
+    or None.
+    """
+    if os.geteuid() != 0 or not (users or FREEZE_AFTER > 0):
+        return None
+    return start_service('spawn helper', serve, path, users)
+
+def spawn_helper(*args):
+    r"""
+    Run the spawn helper in the foreground (`vnc_collaborate spawn-helper`).
+    """
+    if os.geteuid() != 0:
+        error('spawn-helper must run as root')
+        return 1
+    serve()
@@ -0,0 +1,182 @@
+#
+# Creating UNIX accounts for a class ahead of time.
+#
+# Every BBB participant gets a UNIX account (fullName_to_UNIX_username),
+# created by get_or_add_user the first time they connect.  That used to
+# mean, on the connect path: running `adduser --version` and parsing its
+# output, taking a system-wide semaphore (for adduser < 3.137, whose
+# concurrent runs corrupted /etc/passwd), and running adduser, which
+# also copies /etc/skel -- so the first session of a class with 40 new
+# students ran 40 adduser's one after another while their browsers
+# waited.
+#
+# Here, the accounts a meeting needs are created in one pass before
+# anyone connects: the adduser version is looked up once per process,
+# the semaphore is taken once for the whole batch, adduser runs without
+# creating home directories (so each run only updates the account
+# databases), and then the home directories are populated from the
+# skeleton directory in parallel, VNC_PROVISION_WORKERS at a time.
+# prewarm_meeting provisions the expected users before it starts their
+# desktops, and by hand:
+#
+#     python3 -m vnc_collaborate provision MEETINGID...
+#     python3 -m vnc_collaborate provision -f FILE     (BBB full names,
+#                                                       one per line, '-'
+#                                                       for stdin)
+#
+# get_or_add_user still creates a missing account on the connect path
+# (through provision_users), but for a provisioned class it only does a
+# pwd.getpwnam.
+
+import os
+import re
+import sys
+import pwd
+import shutil
+import contextlib
+import subprocess
+import concurrent.futures
+
+from .services import error
+from .users import fullName_to_UNIX_username, fullName_to_rfbport
+from .privileged import add_user
+
+ADDUSER_CONF = '/etc/adduser.conf'
+
+PROVISION_WORKERS = int(os.environ.get('VNC_PROVISION_WORKERS', '8'))
+
+# adduser older than this needs its runs serialized (see above)
+
+ADDUSER_SAFE_VERSION = 3.137
+
+_adduser_version = None
+
+def adduser_version():
+    r"""
+    The installed adduser's version, as a float.  Runs `adduser --version`
+    the first time it's called in a process (or its parent, for the
+    forked connection handlers; see websockify).
+    """
+    global _adduser_version
+    if _adduser_version is None:
+        proc = subprocess.run(['adduser', '--version'], stdout=subprocess.PIPE)
+        _adduser_version = float(re.search('[0-9.]+', [l for l in proc.stdout.decode().split('\n') if 'adduser version' in l][0])[0])
+    return _adduser_version
+
+@contextlib.contextmanager
+def _adduser_lock():
+    # There's was race condition in the system adduser script, so protect this code with a semaphore
+    # We don't need it (and might not have posix_ipc installed) if adduser is new enough
+    if adduser_version() < ADDUSER_SAFE_VERSION:
+        import posix_ipc
+        with posix_ipc.Semaphore('/etc.passwd', posix_ipc.O_CREAT, initial_value=1):
+            yield
+    else:
+        yield
+
+def _adduser_conf():
+    r"""
+    The adduser.conf settings we need to populate home directories the
+    way adduser would have.
+    """
+    conf = {'SKEL': '/etc/skel', 'DIR_MODE': '0755',
+            'SKEL_IGNORE_REGEX': r'\.(dpkg|ucf)-(old|new|dist|save)'}
+    try:
+        with open(ADDUSER_CONF) as f:
+            for line in f:
+                m = re.match(r'\s*(\w+)\s*=\s*"?([^"#\n]*)"?', line)
+                if m:
+                    conf[m[1]] = m[2].strip()
+    except OSError:
+        pass
+    return conf
+
+def _populate_home(UNIXuser, conf):
+    r"""
+    Create `UNIXuser`'s home directory from the skeleton, owned by them.
+    """
+    pw = pwd.getpwnam(UNIXuser)
+    ignore = re.compile(conf['SKEL_IGNORE_REGEX']) if conf['SKEL_IGNORE_REGEX'] else None
+    os.makedirs(pw.pw_dir, exist_ok=True)
+    if os.path.isdir(conf['SKEL']):
+        shutil.copytree(conf['SKEL'], pw.pw_dir, symlinks=True, dirs_exist_ok=True,
+                        ignore=lambda d, names: [n for n in names if ignore and ignore.search(n)])
+    for (root, dirs, files) in os.walk(pw.pw_dir):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), pw.pw_uid, pw.pw_gid)
+    os.chown(pw.pw_dir, pw.pw_uid, pw.pw_gid)
+    os.chmod(pw.pw_dir, int(conf['DIR_MODE'], 8))
+
+def _exists(UNIXuser):
+    try:
+        pwd.getpwnam(UNIXuser)
+        return True
+    except KeyError:
+        return False
+
+def provision_users(UNIXusers):
+    r"""
+    Create the accounts in `UNIXusers` that don't exist yet, in one
+    batch.  Returns the ones created.
+    """
+    missing = [UNIXuser for UNIXuser in dict.fromkeys(UNIXusers) if UNIXuser and not _exists(UNIXuser)]
+    if not missing:
+        return missing
+
+    if os.geteuid() != 0:
+        # The spawn helper does a plain adduser for us
+        with _adduser_lock():
+            for UNIXuser in missing:
+                add_user(UNIXuser)
+        return missing
+
+    with _adduser_lock():
+        for UNIXuser in missing:
+            add_user(UNIXuser, create_home=False)
+
+    conf = _adduser_conf()
+    created = [UNIXuser for UNIXuser in missing if _exists(UNIXuser)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROVISION_WORKERS) as executor:
+        futures = {executor.submit(_populate_home, UNIXuser, conf): UNIXuser for UNIXuser in created}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                error('populating home directory of', futures[future], 'failed:', repr(future.exception()))
+    return created
+
+def _read_names(path):
+    r"""
+    The UNIX users for the BBB full names in `path` (or stdin, for '-'),
+    one per line, with '#' comments.
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        users = []
+        for line in f:
+            fullName = line.split('#')[0].strip()
+            if fullName and not fullName_to_rfbport(fullName):
+                users.append(fullName_to_UNIX_username(fullName))
+        return users
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def provision(*args):
+    r"""
+    provision MEETINGID...
+    provision -f FILE
+
+    Create the accounts of the users expected in meetings (see prewarm.py),
+    or named (BBB full names, one per line) in FILE ('-' for stdin).
+    """
+    from .prewarm import expected_users
+
+    if len(args) == 0 or (args[0] == '-f' and len(args) != 2):
+        print("Usage: provision MEETINGID...")
+        print("       provision -f FILE")
+        return 1
+    if args[0] == '-f':
+        users = _read_names(args[1])
+    else:
+        users = [UNIXuser for meetingID in args for (UNIXuser, teacher) in expected_users(meetingID)]
+    created = provision_users(users)
+    print('Created', len(created), 'of', len(set(users)), 'accounts:', ' '.join(created))
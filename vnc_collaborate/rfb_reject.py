@@ -11,11 +11,13 @@ To get a *specific* message to the user (e.g. "your session expired") the
 rejection has to happen at the RFB layer instead, so noVNC fires
 ``securityfailure`` with our reason.
 
-This module is an ``inetd``-style filter: it reads the client side of the
-connection from stdin and writes the server side to stdout (websockify bridges
-the WebSocket to it via ``socat UNIX-LISTEN ... EXEC:``, exactly like the real
-VNC servers).  The reason comes from ``argv[1]`` or the ``RFB_REJECT_REASON``
-environment variable.
+The websockify proxy runs the handshake in-process (``reject_socket`` for the
+forking front end, ``reject_message`` for the asyncio one), so a rejection
+costs no process spawn -- which matters while the reject sentinel is on and
+every client keeps retrying.  ``rfb_reject`` is the same handshake as an
+``inetd``-style filter: it reads the client side of the connection from stdin
+and writes the server side to stdout.  The reason comes from ``argv[1]`` or
+the ``RFB_REJECT_REASON`` environment variable.
 
 RFB 3.8 handshake, minimal reject path (see RFC 6143 §7 and noVNC rfb.js
 ``_negotiateSecurity`` / ``_handleSecurityReason``):
@@ -48,30 +50,51 @@ def _read_exactly(stream, n):
     return buf
 
 
-def rfb_reject(*args):
-    reason = args[0] if args else os.environ.get('RFB_REJECT_REASON', '')
-    if not reason:
-        reason = 'The remote desktop connection was rejected.'
+PROTOCOL_VERSION = b'RFB 003.008\n'
+
+DEFAULT_REASON = 'The remote desktop connection was rejected.'
+
+
+def reject_message(reason):
+    """The server's reply to the client's ProtocolVersion: zero security
+    types, then the length-prefixed reason."""
+    reason_bytes = (reason or DEFAULT_REASON).encode('utf-8')
+    return b'\x00' + struct.pack('>I', len(reason_bytes)) + reason_bytes
+
 
-    out = sys.stdout.buffer
-    inp = sys.stdin.buffer
+def reject_stream(inp, out, reason):
+    """Run the reject handshake on the binary streams `inp` (from the
+    client) and `out` (to the client)."""
 
     # 1. ProtocolVersion, server -> client
-    out.write(b'RFB 003.008\n')
+    out.write(PROTOCOL_VERSION)
     out.flush()
 
     # 2. ProtocolVersion, client -> server (12 bytes); tolerate a short read
     #    (the client may hang up early — we just proceed to send the reason).
-    _read_exactly(inp, 12)
+    _read_exactly(inp, len(PROTOCOL_VERSION))
 
     # 3. number-of-security-types = 0  -> the client treats this as a failure
     #    and reads a reason string next.
-    out.write(b'\x00')
-
     # 4. reason: uint32 big-endian length, then the UTF-8 bytes
-    reason_bytes = reason.encode('utf-8')
-    out.write(struct.pack('>I', len(reason_bytes)))
-    out.write(reason_bytes)
+    out.write(reject_message(reason))
     out.flush()
 
+
+def reject_socket(sock, reason, timeout=10):
+    """Run the reject handshake on the connected socket `sock`, then close
+    it.  Gives up on a client that doesn't answer within `timeout` seconds."""
+    sock.settimeout(timeout)
+    try:
+        with sock.makefile('rb') as inp, sock.makefile('wb') as out:
+            reject_stream(inp, out, reason)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def rfb_reject(*args):
+    reason = args[0] if args else os.environ.get('RFB_REJECT_REASON', '')
+    reject_stream(sys.stdin.buffer, sys.stdout.buffer, reason)
     return 0
@@ -0,0 +1,187 @@
+#
+# A minimal RFB (VNC) client, for looking at desktops, not using them.
+#
+# The grid compositor (grid_compositor.py) keeps a connection open to
+# every desktop on the teacher's grid and only needs their pixels, so
+# this speaks just enough of RFB 3.8 (RFC 6143) for that:
+#
+#   - security type None, the only one our desktops' UNIX sockets offer
+#   - a shared ClientInit, so we never kick anybody off a desktop
+#   - 32-bit true color pixels, so a framebuffer is an array of
+#     little-endian 0x00RRGGBB, or bytes B, G, R, X
+#   - the Raw and CopyRect encodings, and the DesktopSize pseudo-encoding
+#     so that a desktop can change its geometry under us (set_geometry)
+#
+# Raw is the cheapest encoding for the server -- it just copies pixels
+# -- and these connections are all local UNIX sockets, so there's no
+# point in making every desktop compress its updates for us.
+#
+# The framebuffer is a numpy array (height, width, 4), imported only
+# when a client is created, so that just importing this module (which
+# `import vnc_collaborate` does) doesn't need numpy.
+
+import socket
+import struct
+
+PROTOCOL_VERSION = b'RFB 003.008\n'
+
+SECURITY_NONE = 1
+
+ENCODING_RAW = 0
+ENCODING_COPYRECT = 1
+ENCODING_DESKTOPSIZE = -223
+
+# Server-to-client message types
+
+FRAMEBUFFER_UPDATE = 0
+SET_COLOUR_MAP_ENTRIES = 1
+BELL = 2
+SERVER_CUT_TEXT = 3
+
+# 32 bits per pixel, depth 24, little-endian, true color, 8 bits each of
+# red, green and blue at bits 16, 8 and 0
+
+PIXEL_FORMAT = struct.pack('>BBBBHHHBBB3x', 32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+
+class RFBError(Exception):
+    pass
+
+class RFBClient:
+    r"""
+    A view-only RFB connection to the desktop listening on the UNIX
+    socket `path`.  `width`, `height` and `name` are the desktop's, and
+    `framebuffer` is its pixels, updated by read_message().
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.stream = None
+        try:
+            self.sock.connect(path)
+            self.stream = self.sock.makefile('rb')
+            self._handshake()
+            # once we're connected, only close() ends a read
+            self.sock.settimeout(None)
+        except Exception:
+            self.close()
+            raise
+
+    def _read(self, n):
+        data = self.stream.read(n)
+        if len(data) < n:
+            raise RFBError('connection to {} closed'.format(self.path))
+        return data
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._read(struct.calcsize(fmt)))
+
+    def _reason(self):
+        (length,) = self._unpack('>I')
+        return self._read(length).decode(errors='replace')
+
+    def _handshake(self):
+        version = self._read(12)
+        if not version.startswith(b'RFB '):
+            raise RFBError('{} is not an RFB server'.format(self.path))
+        if version < b'RFB 003.007\n':
+            # 3.3: the server picks the security type
+            self.sock.sendall(b'RFB 003.003\n')
+            (security,) = self._unpack('>I')
+            if security == 0:
+                raise RFBError(self._reason())
+        else:
+            self.sock.sendall(PROTOCOL_VERSION)
+            (count,) = self._unpack('>B')
+            if count == 0:
+                raise RFBError(self._reason())
+            security = SECURITY_NONE if SECURITY_NONE in self._read(count) else None
+            if security is None:
+                raise RFBError('{} needs authentication'.format(self.path))
+            self.sock.sendall(struct.pack('>B', security))
+        if security != SECURITY_NONE:
+            raise RFBError('{} needs authentication'.format(self.path))
+        if version >= b'RFB 003.008\n':
+            (result,) = self._unpack('>I')
+            if result != 0:
+                raise RFBError(self._reason())
+
+        # shared
+        self.sock.sendall(b'\x01')
+        (width, height) = self._unpack('>HH16x')
+        self.name = self._reason()
+        self._resize(width, height)
+
+        self.sock.sendall(struct.pack('>B3x', 0) + PIXEL_FORMAT)
+        encodings = [ENCODING_COPYRECT, ENCODING_RAW, ENCODING_DESKTOPSIZE]
+        self.sock.sendall(struct.pack('>BxH', 2, len(encodings)) +
+                          struct.pack('>{}i'.format(len(encodings)), *encodings))
+
+    def _resize(self, width, height):
+        import numpy
+        self.width = width
+        self.height = height
+        self.framebuffer = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    def request_update(self, incremental=True):
+        r"""
+        Ask for a FramebufferUpdate of the whole desktop: just what
+        changed, if `incremental`, or all of it.
+        """
+        self.sock.sendall(struct.pack('>BBHHHH', 3, 1 if incremental else 0,
+                                      0, 0, self.width, self.height))
+
+    def read_message(self):
+        r"""
+        Read the next message from the server, updating the framebuffer.
+        Returns the rectangles (x, y, width, height) that changed, or
+        None if the message wasn't a FramebufferUpdate.  A change of
+        desktop size replaces the framebuffer and is returned as a
+        change of all of it.
+        """
+        import numpy
+
+        (message_type,) = self._unpack('>B')
+
+        if message_type == FRAMEBUFFER_UPDATE:
+            (count,) = self._unpack('>xH')
+            rects = []
+            for i in range(count):
+                (x, y, w, h, encoding) = self._unpack('>HHHHi')
+                if encoding == ENCODING_RAW:
+                    pixels = self._read(w * h * 4)
+                    self.framebuffer[y:y+h, x:x+w] = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(h, w, 4)
+                    rects.append((x, y, w, h))
+                elif encoding == ENCODING_COPYRECT:
+                    (sx, sy) = self._unpack('>HH')
+                    # copy() because the source and destination can overlap
+                    self.framebuffer[y:y+h, x:x+w] = self.framebuffer[sy:sy+h, sx:sx+w].copy()
+                    rects.append((x, y, w, h))
+                elif encoding == ENCODING_DESKTOPSIZE:
+                    self._resize(w, h)
+                    rects = [(0, 0, w, h)]
+                else:
+                    raise RFBError('unexpected encoding {} from {}'.format(encoding, self.path))
+            return rects
+
+        elif message_type == SET_COLOUR_MAP_ENTRIES:
+            (first, count) = self._unpack('>xHH')
+            self._read(6 * count)
+        elif message_type == BELL:
+            pass
+        elif message_type == SERVER_CUT_TEXT:
+            (length,) = self._unpack('>3xI')
+            self._read(length)
+        else:
+            raise RFBError('unexpected message type {} from {}'.format(message_type, self.path))
+        return None
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.stream:
+            self.stream.close()
+        self.sock.close()
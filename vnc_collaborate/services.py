@@ -0,0 +1,34 @@
+#
+# What the proxy's helper services have in common.
+#
+# The proxy forks a handful of helper services (the spawn helper, the
+# prewarm service, the warm pool, the freezer, the budget keeper, the
+# thumbnail and metrics services).  Each one runs until the process
+# that started it exits, which it notices by its parent pid changing
+# (`watch_parent`), and leaves with os._exit, so that the proxy's own
+# cleanup (atexit handlers, websockify's) doesn't run again in the
+# child.  They all log with error(), as does the rest of the package.
+
+import os
+import sys
+
+def error(*args, **kwargs):
+    kwargs['file'] = sys.stderr
+    kwargs['flush'] = True
+    print(*args, **kwargs)
+
+def start_service(name, target, *args, **kwargs):
+    r"""
+    Fork a process running `target`(*`args`, watch_parent=True,
+    **`kwargs`), that exits along with the calling process.  An OSError
+    that stops it is reported as coming from `name`.  Returns its pid.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            target(*args, watch_parent=True, **kwargs)
+        except OSError as ex:
+            error(name + ':', ex)
+        finally:
+            os._exit(0)
+    return pid
@@ -25,12 +25,20 @@ This module does that idempotently: it will not create a duplicate mode on
 repeated calls with the same geometry, and it emits no spurious X errors.
 """
 
+import os
 import re
+import stat
 import subprocess
 import sys
 
+from .vnc import invalidate_VNC_info
+
 OUTPUT = 'VNC-0'
 
+# Where desktops' sockets are; the one ours listens on has a cached
+# geometry (see vnc.py) that goes stale when we resize the desktop.
+RUN_DIR = '/run/vnc'
+
 
 def _xrandr(*args):
     """Run xrandr, capturing output; never raises."""
@@ -39,6 +47,45 @@ def _xrandr(*args):
                           encoding='ascii')
 
 
+def _desktop_sockets():
+    """
+    Return the socket(s) our desktop listens on.  That's not named after
+    us: a meeting's shared desktop listens on /run/vnc/<meetingID>.  So
+    it's found from $DISPLAY, as the -rfbunixpath its X server (the pid in
+    the display's X lock file) was started with.  A desktop adopted from
+    the warm pool (warm_pool.py) has been linked into /run/vnc under
+    another name and the one it was started with removed, so for one of
+    those, it's every desktop socket in /run/vnc that's ours.
+    """
+    m = re.fullmatch(r'[^:]*:(\d+)(\.\d+)?', os.environ.get('DISPLAY', ''))
+    if m:
+        try:
+            with open('/tmp/.X%s-lock' % m.group(1)) as f:
+                pid = int(f.read().strip())
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                argv = f.read().decode(errors='replace').split('\0')
+            path = argv[argv.index('-rfbunixpath') + 1]
+            if os.path.exists(path):
+                return [path]
+        except (OSError, ValueError, IndexError):
+            pass
+
+    sockets = []
+    try:
+        names = os.listdir(RUN_DIR)
+    except FileNotFoundError:
+        return sockets
+    for name in names:
+        path = os.path.join(RUN_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid():
+            sockets.append(path)
+    return sockets
+
+
 def _modeline_timing(width, height):
     """
     Return the RANDR modeline timing fields (everything after the name) for a
@@ -113,4 +160,7 @@ def set_geometry(geometry, output=OUTPUT):
                      '--output', output, '--mode', name)
     if result.returncode != 0:
         sys.stderr.write(result.stderr)
+    else:
+        for path in _desktop_sockets():
+            invalidate_VNC_info(path)
     return result.returncode
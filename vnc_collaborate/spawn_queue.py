@@ -0,0 +1,327 @@
+#
+# Host-wide admission control for desktop spawns.
+#
+# ensure_vnc_server serializes spawns of the same desktop, but at class
+# start 40 different students each spawn their own desktop at once:
+# 40 GNOME sessions booting together saturate the CPU, every one of
+# them takes longer, and simultaneous tigervncserver.pl runs collide
+# on display numbers (see ensure_vnc_server's retries).  So cold spawns
+# wait here for one of VNC_SPAWN_CONCURRENCY slots (by default half the
+# CPU cores, at least 2), in priority order:
+#
+#   PRIORITY_TEACHER   teachers/moderators, and the meeting's shared
+#                      (projected) desktop everyone is looking at
+#   PRIORITY_STUDENT   everyone else who is connecting right now
+#   PRIORITY_PREWARM   desktops started ahead of time (prewarm.py)
+#   PRIORITY_POOL      refilling the warm pool (warm_pool.py)
+#
+# and first come, first served within a priority.
+#
+# Spawns come from forked connection handlers, --async worker threads,
+# the prewarm service and the warm pool, so the queue lives in the
+# filesystem, in QUEUE_DIR:
+#
+#   slot.N   one per slot, flock()ed by the spawn holding it
+#   ticket.<priority>.<time>.<pid>.<thread>
+#            one per waiter, flock()ed by it while it waits, holding
+#            a line of JSON (user, priority, position, expected wait)
+#            that `GET /spawn-queue.json` on the metrics port reports
+#   boost.<desktop>
+#            a priority for the waiter spawning <desktop> (see below)
+#
+# The waiter whose ticket sorts first is the only one that tries the
+# slots; when it gets one it removes its ticket and the next waiter
+# moves up.  The kernel drops a dead process's flocks, so a crashed
+# waiter's ticket (which anyone can then lock) is removed by the next
+# waiter to notice, and a crashed holder's slot is free again.
+#
+# ensure_vnc_server waits in the queue while holding its desktop's
+# spawn lock, so a student connecting while their desktop is being
+# prewarmed waits behind the prewarm -- at prewarm priority.  Instead
+# of waiting there, it leaves a boost.<desktop> file holding its own
+# priority (and until when it's waiting), and the waiter spawning that
+# desktop moves its ticket up to that priority.  The file is removed
+# (unboost()) when that spawn leaves the queue, and again when whoever
+# left it gets the spawn lock or gives up, so boosts don't pile up.
+#
+# A waiter's expected wait is estimated from its position and the
+# average length of recent spawns.  If its spawn isn't expected to be
+# done (its slot, and then a spawn's length) until after its deadline
+# (ensure_vnc_server's, kept under noVNC's connect timeout), or the
+# deadline passes, it gives up with SpawnQueueTimeout, whose message
+# select_target sends to the client as an RFB rejection reason --
+# rather than leaving the client to time out on a black panel.
+# select_target also hands the spawn to the prewarm service, so it stays
+# in line and the desktop is (or soon will be) running on reconnect.
+
+import os
+import json
+import time
+import fcntl
+import select
+import threading
+import contextlib
+
+from .inotify import inotify_watch, drain
+
+QUEUE_DIR = '/run/vnc/.spawnq'
+
+SPAWN_CONCURRENCY = int(os.environ.get('VNC_SPAWN_CONCURRENCY', '0')) or max(2, (os.cpu_count() or 2) // 2)
+
+PRIORITY_TEACHER = 0
+PRIORITY_STUDENT = 1
+PRIORITY_PREWARM = 2
+PRIORITY_POOL = 3
+
+# Until we've timed some spawns, guess this long (seconds) for one.
+
+DEFAULT_SPAWN_SECONDS = 10
+
+# Waiters are woken by inotify when a ticket is removed or a slot is
+# released, but a holder that dies releases its slot silently, so they
+# also look again this often.
+
+POLL_INTERVAL = 0.5
+
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE = 0x00000200
+
+class SpawnQueueTimeout(RuntimeError):
+    r"""
+    A spawn couldn't be admitted in time.  The message is meant for the
+    user (select_target sends it as the RFB rejection reason).
+    """
+    pass
+
+def _try_lock(path, create=True):
+    r"""
+    Open (or with `create`, create) and flock `path` without blocking.
+    Returns the fd, or None if somebody else holds the lock (or, without
+    `create`, it doesn't exist).
+    """
+    try:
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+def _stats_path():
+    return os.path.join(QUEUE_DIR, 'spawn_seconds')
+
+def average_spawn_seconds():
+    try:
+        with open(_stats_path()) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return DEFAULT_SPAWN_SECONDS
+
+def _record_spawn_seconds(seconds):
+    # An exponentially weighted average of recent spawn times
+    fd = os.open(_stats_path(), os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            average = float(f.read())
+        except ValueError:
+            average = seconds
+        f.seek(0)
+        f.truncate()
+        f.write('{:.3f}'.format(0.8 * average + 0.2 * seconds))
+
+def _live_tickets():
+    r"""
+    The queue's tickets in order, with those left behind by dead waiters
+    removed.
+    """
+    tickets = []
+    for name in sorted(os.listdir(QUEUE_DIR)):
+        if not name.startswith('ticket.'):
+            continue
+        path = os.path.join(QUEUE_DIR, name)
+        fd = _try_lock(path, create=False)
+        if fd is None:
+            if os.path.exists(path):
+                tickets.append(path)
+        else:
+            # nobody holds it, so its waiter is gone
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+    return tickets
+
+def expected_wait(position, concurrency=SPAWN_CONCURRENCY):
+    r"""
+    Roughly how long (seconds) the waiter at `position` (0 is next) will
+    wait for a slot: the spawns ahead of it go `concurrency` at a time.
+    """
+    return (position + 1) * average_spawn_seconds() / concurrency
+
+def _busy_message(position, wait):
+    if position == 0:
+        place = 'next'
+    else:
+        place = 'number {}'.format(position + 1)
+    return ('The server is busy starting desktops.  Yours is {} in line, and should be '
+            'running in about {} seconds; please reconnect then.'.format(
+                place, int(wait + average_spawn_seconds() + 0.5)))
+
+def _write_ticket(fd, info):
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    os.write(fd, json.dumps(info).encode() + b'\n')
+
+def _boost_path(desktop):
+    return os.path.join(QUEUE_DIR, 'boost.' + desktop)
+
+def boost(desktop, priority, deadline):
+    r"""
+    Ask the waiter spawning `desktop` to wait at `priority`, if that's
+    ahead of its own, until `deadline` (a time.monotonic()).
+    """
+    os.makedirs(QUEUE_DIR, mode=0o700, exist_ok=True)
+    until = time.time() + deadline - time.monotonic()
+    with open(_boost_path(desktop), 'w') as f:
+        json.dump({'priority': priority, 'until': until}, f)
+
+def unboost(desktop):
+    r"""
+    Remove the boost for `desktop`, whose spawn is no longer waiting.
+    """
+    try:
+        os.unlink(_boost_path(desktop))
+    except FileNotFoundError:
+        pass
+
+def _boosted_priority(desktop):
+    try:
+        with open(_boost_path(desktop)) as f:
+            boost = json.load(f)
+        if boost['until'] > time.time():
+            return int(boost['priority'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def acquire_slot(UNIXuser, priority, deadline, desktop=None):
+    r"""
+    Wait for a spawn slot.  Returns its fd, to be passed to release_slot.
+    Raises SpawnQueueTimeout if the spawn isn't expected to be done (or
+    the slot doesn't come) by `deadline` (a time.monotonic()).
+    The spawn is of `desktop` (the basename of its socket), if it's one
+    that boost() can move up.
+    """
+    os.makedirs(QUEUE_DIR, mode=0o700, exist_ok=True)
+
+    arrival = '{:020d}.{}.{}'.format(time.time_ns(), os.getpid(), threading.get_ident())
+    name = '{}.{}'.format(priority, arrival)
+    ticket = os.path.join(QUEUE_DIR, 'ticket.' + name)
+    # Lock it before it appears under its ticket name, so that nobody takes
+    # it for a dead waiter's
+    ticket_fd = _try_lock(os.path.join(QUEUE_DIR, 'new.' + name))
+    os.rename(os.path.join(QUEUE_DIR, 'new.' + name), ticket)
+    watch = inotify_watch(QUEUE_DIR, IN_DELETE | IN_CLOSE_WRITE)
+    last_position = None
+    try:
+        while True:
+            boosted = _boosted_priority(desktop) if desktop else None
+            if boosted is not None and boosted < priority:
+                # the same place among the waiters at its new priority
+                priority = boosted
+                boosted_ticket = os.path.join(QUEUE_DIR, 'ticket.{}.{}'.format(priority, arrival))
+                os.rename(ticket, boosted_ticket)
+                ticket = boosted_ticket
+                last_position = None
+
+            tickets = _live_tickets()
+            position = tickets.index(ticket)
+
+            # A slot is no use without the time left to spawn in it
+            spawn_seconds = average_spawn_seconds()
+            remaining = deadline - time.monotonic()
+            if position == 0 and remaining >= spawn_seconds:
+                for n in range(SPAWN_CONCURRENCY):
+                    slot_fd = _try_lock(os.path.join(QUEUE_DIR, 'slot.{}'.format(n)))
+                    if slot_fd is not None:
+                        return slot_fd
+
+            # The estimate is rough, so only a spawn that's expected to
+            # finish after the deadline gives up early
+            wait = expected_wait(position)
+            if remaining <= 0 or wait + spawn_seconds > remaining:
+                raise SpawnQueueTimeout(_busy_message(position, wait))
+
+            if position != last_position:
+                last_position = position
+                _write_ticket(ticket_fd, {'user': UNIXuser, 'priority': priority, 'position': position,
+                                          'expected_wait': round(wait, 1)})
+
+            timeout = min(POLL_INTERVAL, remaining)
+            if watch is not None:
+                if select.select([watch], [], [], timeout)[0]:
+                    drain(watch)
+            else:
+                time.sleep(timeout)
+    finally:
+        try:
+            os.unlink(ticket)
+        except FileNotFoundError:
+            pass
+        os.close(ticket_fd)
+        if watch is not None:
+            os.close(watch)
+        if desktop:
+            unboost(desktop)
+
+def release_slot(slot_fd, spawn_seconds=None):
+    r"""
+    Give back a slot from acquire_slot, recording how long the spawn it
+    was held for took.
+    """
+    if spawn_seconds is not None:
+        _record_spawn_seconds(spawn_seconds)
+    os.close(slot_fd)
+    # wake up the waiters (see acquire_slot)
+    try:
+        with open(os.path.join(QUEUE_DIR, 'released'), 'w'):
+            pass
+    except OSError:
+        pass
+
+@contextlib.contextmanager
+def spawn_slot(UNIXuser, priority, deadline):
+    r"""
+    Hold a spawn slot for the duration of the with statement.
+    """
+    slot_fd = acquire_slot(UNIXuser, priority, deadline)
+    started = time.monotonic()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        release_slot(slot_fd, time.monotonic() - started if succeeded else None)
+
+def queue_status():
+    r"""
+    The waiting spawns, in order, as a list of dicts (see _write_ticket).
+    """
+    status = []
+    try:
+        names = sorted(os.listdir(QUEUE_DIR))
+    except FileNotFoundError:
+        return status
+    for name in names:
+        if name.startswith('ticket.'):
+            try:
+                with open(os.path.join(QUEUE_DIR, name)) as f:
+                    status.append(json.loads(f.readline()))
+            except (OSError, ValueError):
+                pass
+    return status
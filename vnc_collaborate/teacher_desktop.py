@@ -4,13 +4,18 @@
 # This code displays the grid view.
 
 import subprocess
-import multiprocessing
 import threading
 import http.server
+import collections
+import urllib.parse
+import secrets
+import hmac
+import json
 
 import sys
 import math
 import time
+import select
 import psutil
 import re
 import signal
@@ -20,18 +25,22 @@ import stat
 import getpass
 import grp
 
-import tkinter as tk
-
 from lxml import etree
 
-import bigbluebutton
+import bigbluebutton_roster
 
 import psycopg2
 
-from .simple_text import simple_text
-from .vnc import get_VNC_info
+from .services import error
+from .vnc import get_VNC_info, cached_VNC_info
 from .users import fullName_to_UNIX_username, fullName_to_rfbport
 from .desktop_name import set_vnc_desktop_name
+from .freezer import thaw_desktop
+from .grid_compositor import GridCompositor, RATES
+from .overlay import Overlay
+from .thumbnails import thumbnail_memory
+from .inotify import inotify_watch, drain
+from .x11 import X11, RootWatcher
 
 def debug(*args, **kwargs):
     pass
@@ -39,11 +48,6 @@ def debug(*args, **kwargs):
     #kwargs['flush'] = True
     #print(*args, **kwargs)
 
-def error(*args, **kwargs):
-    kwargs['file'] = sys.stderr
-    kwargs['flush'] = True
-    print(*args, **kwargs)
-
 # My user name.  Typically the UNIX user name of the user running the display in grid mode.
 
 myUNIXname = getpass.getuser()
@@ -54,6 +58,13 @@ myUNIXname = getpass.getuser()
 
 VIEWONLY_VIEWER = "ssvncviewer"
 
+# The JPEG quality (0-9) the grid's viewers ask for, unless the
+# grid_quality root window property says otherwise.  The thumbnails are
+# a fraction of the desktops' size, so their artifacts don't show, and
+# a low quality is much cheaper for the desktops to encode.
+
+THUMBNAIL_QUALITY = '1'
+
 # VALID_DISPLAYS is a list of "displays" that should appear in the teacher mode grid.
 #
 # "displays" can be almost anything that keys into the next set of dictionaries;
@@ -86,6 +97,13 @@ VNC_SOCKET = dict()
 VNCdata = dict()
 VNCdata_futures = dict()
 
+# When each display's last geometry query failed (a time.monotonic()).  A
+# desktop that doesn't answer (a dead socket, say) isn't asked again until
+# IDLE_POLL_INTERVAL has gone by, or something changes in /run/vnc or the
+# meeting; otherwise main_loop() would do nothing but ask it.
+
+VNCdata_failed = dict()
+
 # myMeetingID: the Big Blue Button meeting identifier
 
 myMeetingID = os.environ.get('MeetingId')
@@ -97,8 +115,89 @@ SCREENY = 0
 # The PostgreSQL connection (None if not connected) for screenshare notifications
 pg_conn = None
 
+# Our connection to the X display (see x11.py), watching the root
+# window's properties and size, or None if it couldn't be opened, in
+# which case we run xprop and xdotool, and poll.  It belongs to the main
+# thread; x_display() gives other threads (the HTTP listener's) their own.
+
+root_watcher = None
+
+x_displays = threading.local()
+
+def x_display():
+    r"""
+    This thread's connection to the X display, or None if there isn't one.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return root_watcher
+    if not hasattr(x_displays, 'display'):
+        try:
+            x_displays.display = X11()
+        except Exception as ex:
+            error('no connection to the X display:', ex)
+            x_displays.display = None
+    return x_displays.display
+
+def get_desktop():
+    r"""
+    The fvwm virtual desktop we're on, as a string ('' if we can't tell).
+    """
+    x = x_display()
+    if x:
+        desktop = x.get_desktop()
+        return '' if desktop is None else str(desktop)
+    return subprocess.run(["xdotool", "get_desktop"],
+                          stdout=subprocess.PIPE, encoding='ascii').stdout.strip()
+
+def set_desktop(desktop):
+    x = x_display()
+    if x:
+        x.set_desktop(desktop)
+    else:
+        subprocess.run(["xdotool", "set_desktop", str(desktop)])
+
+def send_key(key):
+    r"""
+    Press `key`, which is how we tell fvwm to do things (see the F13-F24
+    mapping in teacher_desktop()).
+    """
+    x = x_display()
+    if not x or not x.key(key):
+        subprocess.run(["xdotool", "key", key])
+
+def set_background(color):
+    x = x_display()
+    if x:
+        x.set_background(color)
+    else:
+        subprocess.run(["xsetroot", "-solid", color])
+
+# Other threads (the VNC geometry queries, open_pg_database) wake the
+# main loop up by writing to this pipe, which teacher_desktop() creates.
+
+wakeup_read = None
+wakeup_write = None
+
+def query_answered(future):
+    # a failed query is retried later, not right away (see VNCdata_failed)
+    if future.exception() is None:
+        wake_main_loop()
+
+def wake_main_loop(*args):
+    if wakeup_write is None:
+        return
+    try:
+        os.write(wakeup_write, b'\0')
+    except BlockingIOError:
+        # it's already awake
+        pass
+
 # get_xprop works for the string data type only
 def get_xprop(name, default=None):
+    if root_watcher:
+        value = root_watcher.get_property(name, default)
+        debug('xprop', name, value)
+        return value
     xprop = subprocess.Popen(["xprop", "-root"], stdout=subprocess.PIPE)
     # communicate() waits for the subprocess to exit
     (stdoutdata, stderrdata) = xprop.communicate()
@@ -109,6 +208,40 @@ def get_xprop(name, default=None):
     debug('xprop', name, 'default', default)
     return default
 
+def thaw(display):
+    r"""
+    A desktop frozen for being idle (see freezer.py) doesn't answer, so
+    thaw `display` before connecting to it.
+    """
+    try:
+        thaw_desktop(VNC_SOCKET[display], by='grid')
+    except (OSError, RuntimeError) as ex:
+        error('thawing', display, 'failed:', ex)
+
+# The (fullName, userID) of everybody in our meeting, the last time
+# get_VALID_DISPLAYS() looked (None if it didn't, because it's showing all
+# desktops).  Big Blue Button doesn't tell us when people come and go, so
+# wait_for_changes() polls for this.
+
+attendees = None
+
+# The meeting roster (see bigbluebutton_roster), created on first use: the
+# proxy's roster service if we can reach it, otherwise our own cache, which
+# fetches getMeetings() only when its copy is a couple of seconds old.
+
+roster = None
+
+def get_attendees():
+    # some kind of problem with this API call
+    # meetingInfo = bigbluebutton.getMeetingInfo(meetingID = myMeetingID)
+    global roster
+    if roster is None:
+        roster = bigbluebutton_roster.shared_roster()
+    meeting = roster.meeting(myMeetingID)
+    if meeting is None:
+        raise LookupError('meeting {} is not running'.format(myMeetingID))
+    return [(attendee['fullName'], attendee['userID']) for attendee in meeting['attendees']]
+
 def get_VALID_DISPLAYS():
     r"""
     This function relies on the desktops having UNIX domain sockets in /run/vnc.
@@ -119,11 +252,8 @@ def get_VALID_DISPLAYS():
     #
     # Default is to show all desktops running on the system.
     #
-    # Currently works by running xprop every time we query.
-    # main_loop() is called once every second.
-    #
-    # Would be more efficient to do this by leaving an "xprop -spy"
-    # running in the background
+    # get_xprop() reads it from root_watcher's cache, which a PropertyNotify
+    # clears, and main_loop() runs when that happens (see wait_for_changes).
 
     collaborate_display_mode = get_xprop('collaborate_display_mode', default='all')
 
@@ -139,13 +269,12 @@ def get_VALID_DISPLAYS():
     # Would be more efficient to do this using Big Blue Button webhooks
     # that by querying the API every time through this function.
 
+    global attendees
+    attendees = None
+
     if myMeetingID and not all_displays:
-        # some kind of problem with this API call
-        # meetingInfo = bigbluebutton.getMeetingInfo(meetingID = myMeetingID)
-        meetingInfo = bigbluebutton.getMeetings().xpath('.//internalMeetingID[text()=$meetingID]/..', meetingID= myMeetingID)[0]
-        for e in meetingInfo.xpath(".//attendee"):
-            fullName = e.find('fullName').text
-            userID = e.find('userID').text
+        attendees = get_attendees()
+        for (fullName, userID) in attendees:
             UNIXuser = fullName_to_UNIX_username(fullName)
             IDS[UNIXuser] = userID
             # If multiple BBB names map to the same UNIX user (especially
@@ -195,36 +324,72 @@ def get_VALID_DISPLAYS():
             VALID_DISPLAYS.append(display)
 
         # We now want to obtain VNC information, currently just width and height so we can figure what
-        # scaling and geometry we need to put it in the grid.  get_VNC_info() used the vncdotool
-        # package, which either waits for a response from the VNC server (return_future=False) or
-        # returns a future without waiting (return_future=True).  We use the future version, so
-        # the code can't hang here, and check later for the result.
+        # scaling and geometry we need to put it in the grid.  get_VNC_info() either waits for a
+        # response from the VNC server (return_future=False) or returns a future without waiting
+        # (return_future=True).  We use the future version, so the code can't hang here, and check
+        # later for the result (update_VNCdata).
         #
         # XXX should we only do this for the displays we're working on (to optimize this)
 
-        if display not in VNCdata_futures:
+        if display not in VNCdata_futures and \
+           time.monotonic() - VNCdata_failed.get(display, -IDLE_POLL_INTERVAL) >= IDLE_POLL_INTERVAL:
+            thaw(display)
             VNCdata_futures[display] = get_VNC_info(VNC_SOCKET[display], return_future=True)
+            VNCdata_futures[display].add_done_callback(query_answered)
+
+def update_VNCdata(display):
+    r"""
+    Record display's geometry in VNCdata once its query has finished.
+    A query that failed is forgotten, so that get_VALID_DISPLAYS() starts
+    another one, after a while (see VNCdata_failed).  When a desktop's geometry changes (see vnc.py), we
+    query it again, and main_loop_grid() restarts its viewer.
+    """
+    future = VNCdata_futures.get(display)
+    if future is None or not future.done():
+        return
+    if future.exception():
+        del VNCdata_futures[display]
+        VNCdata_failed[display] = time.monotonic()
+        return
+    VNCdata_failed.pop(display, None)
+    if display in VNCdata and VNCdata[display] != future.result() and display in processes:
+        # its viewer is scaled (and titled) for the old geometry
+        stop_viewer(display)
+        locations.pop(display, None)
+    VNCdata[display] = future.result()
+    if cached_VNC_info(VNC_SOCKET[display]) is None:
+        VNCdata_futures[display] = get_VNC_info(VNC_SOCKET[display], return_future=True)
+        VNCdata_futures[display].add_done_callback(query_answered)
 
 # 'processes' maps display names to a list of processes associated
-# with them.  Each one will have a vncviewer and a Tk label.
+# with them: a vncviewer.  Its label is a window of the overlay server
+# (see overlay.py), whose ID is the display name.
 
 processes = dict()
 
+# The overlay server, for the grid's labels, the highlight around the
+# desktop being screenshared, and the "End screenshare" button
+
+overlay = None
+
 # 'locations' maps display names to their location (an integer) in the on-screen grid.
 
 locations = dict()
 
 def kill_processes(list_of_procs):
     r"""
-    Kills a list of processes that were created with either
-    subprocess.Popen or multiprocessing.Process
+    Kills a list of processes that were created with subprocess.Popen
     """
 
     for proc in list_of_procs:
-        if isinstance(proc, subprocess.Popen):
-            proc.kill()
-        elif isinstance(proc, multiprocessing.Process):
-            proc.terminate()
+        proc.kill()
+
+def stop_viewer(display):
+    r"""
+    Kill `display`'s processes, and take down its label.
+    """
+    kill_processes(processes.pop(display))
+    overlay.destroy(display)
 
 # Current grid geometry
 
@@ -255,9 +420,7 @@ def calculate_grid_dimensions():
 
     for display in VALID_DISPLAYS:
         # check to see if our query for display geometry finished, and if so, record the result
-        if display in VNCdata_futures and display not in VNCdata:
-            if VNCdata_futures[display].done():
-                VNCdata[display] = VNCdata_futures[display].result()
+        update_VNCdata(display)
         if display in VNCdata:
             max_width = max(max_width, int(VNCdata[display]['width']))
             max_height = max(max_height, int(VNCdata[display]['height']))
@@ -289,9 +452,77 @@ def calculate_grid_dimensions():
 
     return (rows, cols)
 
+def zoom_title(display):
+    r"""
+    The window title that identifies `display`'s place on the grid to
+    the FVWM config, and passes information (its userID, display name,
+    geometry, socket and label) to teacher_zoom.
+    """
+    geometry = str(VNCdata[display]['width']) + 'x' + str(VNCdata[display]['height'])
+    # The title won't be displayed with our default FVWM config for teacher mode.
+    # A 6th field carries the BBB full name so teacher_zoom can publish it
+    # as the RFB desktop name (FVWM patterns match "TeacherViewVNC;*", so a
+    # trailing field is safe). ';' is stripped so it can't corrupt the split.
+    zoom_label = LABELS[None] if display == myMeetingID else LABELS.get(display, "")
+    zoom_label = " ".join(str(zoom_label or "").replace(";", " ").split())
+    return ";".join(["TeacherViewVNC", IDS[display], display, geometry, VNC_SOCKET[display], zoom_label])
+
+def grid_label(display):
+    r"""
+    The label on `display`'s place on the grid.  The default user is
+    special - use the label for BBB users that mapped to no UNIX user
+    """
+    if display == myMeetingID:
+        return LABELS[None]
+    else:
+        return LABELS[display]
+
 def move_window(name_regex, x, y):
-    debug(["xdotool", "search", "--name", name_regex, "windowmove", str(x), str(y)], file=sys.stderr)
-    subprocess.run(["xdotool", "search", "--name", name_regex, "windowmove", str(x), str(y)])
+    debug('move_window', name_regex, x, y)
+    if x_display():
+        x_display().move_windows(name_regex, x, y)
+    else:
+        subprocess.run(["xdotool", "search", "--name", name_regex, "windowmove", str(x), str(y)])
+
+# ssvncviewer's -scale is fixed when it starts, so main_loop_grid() can
+# only move a running viewer.  When the grid is re-laid out (a student
+# joins and it goes from 3x3 to 3x4, say), a viewer is kept, and just
+# moved to its new place, if its scale is at most its new scale, and no
+# more than SCALE_SLACK smaller.  Otherwise it has to be restarted, which
+# means a new connection and a full framebuffer from the desktop.
+#
+# 'viewer_scales' and 'viewer_positions' map display names to the scale
+# that their viewer was started with, and where it and its label are.
+
+SCALE_SLACK = 0.15
+
+viewer_scales = dict()
+viewer_positions = dict()
+
+def scale_fits(running_scale, scale):
+    return scale * (1 - SCALE_SLACK) <= running_scale <= scale * (1 + 1e-9)
+
+# How much re-laying out the grid disturbs it: for each re-layout, how
+# many viewers (or compositor tiles) were started, restarted, moved,
+# stopped, or kept as they were.  The totals, and the last re-layout's,
+# are served by the HTTP listener at /stats.json, along with how long the
+# compositor's page flips took to show their first pixel, and all their
+# tiles (see record_flip), and how long zooming in on a desktop took, from
+# the click to its viewer being on the screen (see record_zoom).
+
+grid_stats = {'relayouts': 0, 'churn': collections.Counter(), 'last_relayout': {},
+              'flips': {'count': 0, 'complete': 0, 'first_pixel_seconds_total': 0.0,
+                        'complete_seconds_total': 0.0, 'last': {}},
+              'zooms': {'count': 0, 'timed_out': 0, 'seconds_total': 0.0, 'last': {}}}
+
+def record_churn(renderer, churn):
+    if not any(n for (action, n) in churn.items() if action != 'kept'):
+        return
+    # new objects, not updates, since the HTTP listener's thread reads them
+    grid_stats['relayouts'] += 1
+    grid_stats['churn'] = grid_stats['churn'] + churn
+    grid_stats['last_relayout'] = dict(churn, renderer=renderer, time=time.time())
+    debug('relayout', renderer, dict(churn))
 
 def main_loop_grid(reset_display):
     r"""
@@ -303,9 +534,10 @@ def main_loop_grid(reset_display):
     global processes
     global locations
 
-    # If the number of clients changed enough to require a resize of
-    # the entire display grid, kill all of our old processes,
-    # triggering a rebuild of the entire display.
+    # If the screen changed size (which restarts fvwm), kill all of our
+    # old processes, triggering a rebuild of the entire display.  A
+    # change in the number of clients that resizes the grid doesn't; the
+    # loop below moves the viewers that it can (see SCALE_SLACK).
 
     # Otherwise, kill the processes for displays that are no longer
     # valid.  This is necessary to avoid a situation where we don't
@@ -315,25 +547,27 @@ def main_loop_grid(reset_display):
     starting_location = page_number * num_rows * num_cols
     ending_location = starting_location + num_rows * num_cols - 1
 
+    churn = collections.Counter()
+
     if reset_display:
         debug('killing all processes')
-        for procs in processes.values():
-            kill_processes(procs)
-        processes.clear()
+        restarted = set(processes)
+        for disp in list(processes):
+            stop_viewer(disp)
         locations.clear()
     else:
+        restarted = set()
         DEAD_DISPLAYS = [disp for disp in processes.keys() if disp not in VALID_DISPLAYS]
         for disp in DEAD_DISPLAYS:
             debug('killing DEAD_DISPLAY', disp)
-            kill_processes(processes[disp])
-            processes.pop(disp)
+            stop_viewer(disp)
             locations.pop(disp)
+            churn['stopped'] += 1
 
     delete_pkeys = []
     for pkey, plist in processes.items():
         for p in plist:
-            # These lists contain both subprocess.Popen's and multiprocessing.Process's
-            if isinstance(p, subprocess.Popen) and p.poll():
+            if p.poll():
                 # do something more than just log the error, but for now, just log the error
                 error('display process died')
                 (stdoutdata, stderrdata) = p.communicate()
@@ -342,8 +576,7 @@ def main_loop_grid(reset_display):
                 delete_pkeys.append(pkey)
 
     for disp in delete_pkeys:
-        kill_processes(processes[disp])
-        processes.pop(disp)
+        stop_viewer(disp)
         locations.pop(disp)
 
     if num_cols > 0 and num_rows > 0:
@@ -360,9 +593,7 @@ def main_loop_grid(reset_display):
 
         for display in sorted(VALID_DISPLAYS):
             # skip any displays that we don't have VNCdata for
-            if display in VNCdata_futures and display not in VNCdata:
-                if VNCdata_futures[display].done():
-                    VNCdata[display] = VNCdata_futures[display].result()
+            update_VNCdata(display)
             if display not in VNCdata:
                 continue
 
@@ -374,59 +605,217 @@ def main_loop_grid(reset_display):
             col = next_location % num_cols
             nativex = VNCdata[display]['width']
             nativey = VNCdata[display]['height']
-            geometry = str(nativex) + 'x' + str(nativey)
             scalex = SCALEX/nativex
             scaley = SCALEY/nativey
             scale = min(scalex, scaley)
             geox = int(col * SCREENX/num_cols + .005*SCREENX)
             geoy = int(row * SCREENY/num_rows + .005*SCREENY)
-            offsetx = int((SCALEX - scale*nativex)/2)
-            offsety = int((SCALEY - scale*nativey)/2)
-            # Use the title of the window to identify these windows to the FVWM config,
-            # and to pass information (their userID and display name) to teacher_zoom.
-            # The title won't be displayed with our default FVWM config for teacher mode.
-            # A 6th field carries the BBB full name so teacher_zoom can publish it
-            # as the RFB desktop name (FVWM patterns match "TeacherViewVNC;*", so a
-            # trailing field is safe). ';' is stripped so it can't corrupt the split.
-            zoom_label = LABELS[None] if display == myMeetingID else LABELS.get(display, "")
-            zoom_label = " ".join(str(zoom_label or "").replace(";", " ").split())
-            title = ";".join(["TeacherViewVNC", IDS[display], display, geometry, VNC_SOCKET[display], zoom_label])
-
-            if display in locations and locations[display] != next_location:
-                # it moved in the grid
-                if display in processes and page == page_number:
-                    # it moved in the grid, and it's already being displayed, and it's on the current page,
-                    # so just move it and its label (these are regular expressions matching the window name)
-                    move_window(f';{display};', geox+offsetx, geoy+offsety)
-                    move_window(f'^{display}$', geox+SCREENX/num_cols/2, geoy)
+            # Use the title of the window to identify these windows to the FVWM config
+            title = zoom_title(display)
 
             if display in processes and page != page_number:
                 # it moved off the page
                 debug('killing off screen display', display)
-                kill_processes(processes[display])
-                processes.pop(display)
+                stop_viewer(display)
+                churn['stopped'] += 1
+
+            if display in processes and not scale_fits(viewer_scales[display], scale):
+                # the grid changed enough that its viewer no longer fits
+                debug('restarting rescaled display', display)
+                stop_viewer(display)
+                restarted.add(display)
+
+            if display in processes:
+                # keep the viewer's scale, centered in its new place
+                scale = viewer_scales[display]
+            offsetx = int((SCALEX - scale*nativex)/2)
+            offsety = int((SCALEY - scale*nativey)/2)
+            position = ((geox+offsetx, geoy+offsety), (geox+SCREENX/num_cols/2, geoy))
+
+            if display in processes:
+                if viewer_positions[display] != position:
+                    # it moved in the grid, and it's already being displayed, and it's on the current page,
+                    # so just move it (this is a regular expression matching the window name) and its label
+                    move_window(f';{display};', *position[0])
+                    overlay.move(display, *position[1])
+                    viewer_positions[display] = position
+                    churn['moved'] += 1
+                else:
+                    churn['kept'] += 1
+                overlay.retitle(display, grid_label(display))
 
             if display not in processes and page == page_number:
                 # we haven't started a viewer for this display, but we should
+                thaw(display)
                 processes[display] = []
                 args = [VIEWONLY_VIEWER, '-viewonly', '-geometry', '+'+str(geox+offsetx)+'+'+str(geoy+offsety),
                         '-escape', 'never',
                         '-scale', str(scale),
+                        '-quality', get_xprop('grid_quality', THUMBNAIL_QUALITY),
                         '-title', title, 'unix=' + VNC_SOCKET[display]]
                 processes[display].append(subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
 
-                # Put a label on the window.  The default user is special - use the label for BBB users that
-                # mapped to no UNIX user
+                # Put a label on the window
+                overlay.create_text(display, grid_label(display), *position[1])
 
-                if display == myMeetingID:
-                    label = LABELS[None]
-                else:
-                    label = LABELS[display]
-                processes[display].append(simple_text(label, geox + SCREENX/num_cols/2, geoy))
+                viewer_scales[display] = scale
+                viewer_positions[display] = position
+                churn['restarted' if display in restarted else 'started'] += 1
+
+            locations[display] = next_location
+            next_location += 1
+
+    record_churn('viewers', churn)
+
+# In compositor mode (the grid_renderer root window property is
+# 'compositor'), one grid_compositor process draws the whole grid, and
+# there are no per-display processes.  See grid_compositor.py.
+
+grid_renderer = None
+compositor = None
+
+def stop_compositor():
+    global compositor
+    if compositor:
+        compositor.terminate()
+        compositor = None
+
+# In compositor mode, the tiles on up to PREFETCH_PAGES pages on either
+# side of the one being shown (nearest first, next before previous) are
+# prefetched: kept, hidden, with their thumbnails updated PREFETCH_FPS
+# times a second, so that flipping to their page is instant (see
+# grid_compositor.py).  Prefetching stops short of PREFETCH_MB megabytes
+# of thumbnails (see thumbnails.thumbnail_memory).  The grid_prefetch_pages,
+# grid_prefetch_fps and grid_prefetch_mb root window properties override
+# these.
+#
+# ssvncviewers can't be paced, so the one-viewer-per-desktop grid doesn't
+# prefetch: its neighbouring pages would be full-rate viewers.
+
+PREFETCH_PAGES = 1
+PREFETCH_FPS = RATES['prefetch']
+PREFETCH_MB = 256
+
+def prefetch_order(page, depth):
+    for distance in range(1, depth + 1):
+        yield page + distance
+        if page - distance >= 0:
+            yield page - distance
+
+def record_flip(report):
+    r"""
+    Record the compositor's report of how long a page flip took (see
+    grid_compositor.py) in grid_stats.
+    """
+    flips = dict(grid_stats['flips'])
+    flips['count'] += 1
+    flips['first_pixel_seconds_total'] += report['first_pixel']
+    # a flip whose tiles weren't all drawn within the compositor's
+    # FLIP_TIMEOUT has no completion time
+    if report['complete'] is not None:
+        flips['complete'] += 1
+        flips['complete_seconds_total'] += report['complete']
+    flips['last'] = dict(report, time=time.time())
+    grid_stats['flips'] = flips
+    debug('page flip', report)
+
+def main_loop_compositor(reset_display):
+    r"""
+    The portion of the main loop that lays out the grid, in compositor mode.
+    """
+
+    global compositor
+
+    if compositor and compositor.poll() is not None:
+        error('grid compositor died')
+        compositor = None
+    if not compositor:
+        compositor = GridCompositor(on_flip=record_flip)
+        compositor.highlight(current_screenshare)
+
+    if reset_display:
+        locations.clear()
+    for disp in [disp for disp in locations if disp not in VALID_DISPLAYS]:
+        locations.pop(disp)
+
+    # page number -> its tiles
+    pages = collections.defaultdict(list)
+
+    if num_cols > 0 and num_rows > 0:
+
+        # the same layout as main_loop_grid
+
+        SCALEX = int(SCREENX/num_cols - .01*SCREENX)
+        SCALEY = int(SCREENY/num_rows - .01*SCREENY)
+
+        next_location = 0
+
+        for display in sorted(VALID_DISPLAYS):
+            update_VNCdata(display)
+            if display not in VNCdata:
+                continue
+
+            row = (next_location % grid_size) // num_cols
+            col = next_location % num_cols
+            pages[next_location // grid_size].append({
+                'display': display,
+                'socket': VNC_SOCKET[display],
+                'title': zoom_title(display),
+                'label': grid_label(display),
+                # the whole cell, which is what gets highlighted, and the
+                # part of it (inside the margins) that the desktop fits in
+                'frame': [int(col * SCREENX/num_cols), int(row * SCREENY/num_rows),
+                          int(SCREENX/num_cols), int(SCREENY/num_rows)],
+                'area': [int(col * SCREENX/num_cols + .005*SCREENX), int(row * SCREENY/num_rows + .005*SCREENY),
+                         SCALEX, SCALEY],
+            })
 
             locations[display] = next_location
             next_location += 1
 
+    tiles = pages.get(page_number, [])
+
+    prefetch = []
+    memory = 0
+    max_memory = float(get_xprop('grid_prefetch_mb', str(PREFETCH_MB))) * 1024 * 1024
+    for page in prefetch_order(page_number, int(get_xprop('grid_prefetch_pages', str(PREFETCH_PAGES)))):
+        for tile in pages.get(page, []):
+            memory += thumbnail_memory(VNCdata[tile['display']]['width'], VNCdata[tile['display']]['height'],
+                                       *tile['area'][2:])
+            if memory > max_memory:
+                break
+            prefetch.append(tile)
+        else:
+            continue
+        break
+
+    # how often the thumbnails are updated (see grid_compositor.py)
+    rates = {'normal': float(get_xprop('grid_fps', str(RATES['normal']))),
+             'hover': float(get_xprop('grid_hover_fps', str(RATES['hover']))),
+             'projected': float(get_xprop('grid_projected_fps', str(RATES['projected']))),
+             'prefetch': float(get_xprop('grid_prefetch_fps', str(PREFETCH_FPS)))}
+
+    # The compositor keeps the tile (and its thumbnail's connection) of a
+    # display that stays on the page, or its neighbours, and just moves,
+    # rescales, shows or hides it
+    churn = collections.Counter()
+    previous = {tile['display']: tile for tile in
+                (compositor.last_layout[1] + compositor.last_layout[3] if compositor.last_layout else [])}
+    for tile in tiles + prefetch:
+        old = previous.pop(tile['display'], None)
+        if old is None:
+            churn['started'] += 1
+        elif old['socket'] != tile['socket']:
+            churn['restarted'] += 1
+        elif old['area'] != tile['area']:
+            churn['moved'] += 1
+        else:
+            churn['kept'] += 1
+    churn['stopped'] += len(previous)
+    record_churn('compositor', churn)
+
+    compositor.layout([SCREENX, SCREENY], tiles, rates, prefetch, page_number)
+
 def get_current_screenshare():
     if pg_conn:
         try:
@@ -441,8 +830,8 @@ def get_current_screenshare():
     return None
 
 current_screenshare = None
-current_screenshare_window = None
-current_screenshare_button = None
+current_screenshare_window = False
+current_screenshare_button = False
 
 def main_loop_screenshare(reset_display):
     r"""
@@ -459,11 +848,12 @@ def main_loop_screenshare(reset_display):
     new_screenshare = get_current_screenshare()
     if current_screenshare != new_screenshare or reset_display:
         if current_screenshare_window:
-            current_screenshare_window.terminate()
-            # commented out because I'm afraid of this deadlocking us
-            #current_screenshare_window.wait()
-            current_screenshare_window = None
-        if new_screenshare in locations and (locations[new_screenshare] // grid_size) == page_number:
+            overlay.destroy('highlight')
+            current_screenshare_window = False
+        if compositor:
+            # it only highlights a display that's on its page
+            compositor.highlight(new_screenshare)
+        elif new_screenshare in locations and (locations[new_screenshare] // grid_size) == page_number:
             location = locations[new_screenshare] % grid_size
             row = location // num_cols
             col = location % num_cols
@@ -472,15 +862,19 @@ def main_loop_screenshare(reset_display):
             SCALEX = int(SCREENX/num_cols)
             SCALEY = int(SCREENY/num_rows)
 
-            current_screenshare_window = colored_rect(SCALEX, SCALEY, geox, geoy)
+            # titled 'highlight', which causes FVWM to move it below all other windows
+            overlay.create_rect('highlight', SCALEX, SCALEY, geox, geoy)
+            current_screenshare_window = True
         current_screenshare = new_screenshare
 
+    # Once the button has been clicked, it stays gone until the screenshare
+    # it ended is gone too
     if current_screenshare and not current_screenshare_button:
-        current_screenshare_button = close_projection_button()
+        overlay.create_button('projection_controls', "End screenshare", "Projection Controls")
+        current_screenshare_button = True
     if not current_screenshare and current_screenshare_button:
-        current_screenshare_button.terminate()
-        current_screenshare_button = None
-        # again, I'd like to wait for this, but am afraid to
+        overlay.destroy('projection_controls')
+        current_screenshare_button = False
 
 def main_loop():
     try:
@@ -494,9 +888,8 @@ def main_loop():
         # (no window manager running yet), so neither triggers the restore.
         desktop_before_restart = None
         if geometry_changed:
-            desktop_before_restart = subprocess.run(
-                ["xdotool", "get_desktop"],
-                stdout=subprocess.PIPE, encoding='ascii').stdout.strip()
+            desktop_before_restart = get_desktop()
+            old_window_manager = root_watcher.window_manager() if root_watcher else None
             fvwm_config = 'teacher_mode_fvwm_config'
             args = ["fvwm", "-c", "PipeRead 'python3 -m vnc_collaborate print %s'" % fvwm_config, "-r"]
             global fvwm
@@ -505,7 +898,11 @@ def main_loop():
             # or the vncviewers that go beyond the edges of the old screen geometry will get smashed
             # into the upper-left hand corner, along with the "end screenshare" button.
             # The Tk labels on the desktops don't have this problem, who knows why.
-            time.sleep(0.1)
+            if root_watcher:
+                # it has started when it has set up its EWMH check window
+                root_watcher.wait_for_window_manager(old_window_manager)
+            else:
+                time.sleep(0.1)
 
         get_VALID_DISPLAYS()
         debug('VALID_DISPLAYS', VALID_DISPLAYS)
@@ -521,9 +918,22 @@ def main_loop():
         page_number = int(get_xprop('page_number', '0'))
         page_changed = (old_page_number != page_number)
 
-        # we don't need to pass page_changed to main_loop_grid, because it will already kill all off-screen viewers
-        main_loop_grid(geometry_changed or grid_changed)
-        main_loop_screenshare(geometry_changed or grid_changed or page_changed)
+        global grid_renderer
+        old_grid_renderer = grid_renderer
+        grid_renderer = get_xprop('grid_renderer', 'viewers')
+        renderer_changed = (old_grid_renderer != grid_renderer)
+
+        # we don't need to pass page_changed to main_loop_grid, because it will already kill all off-screen viewers,
+        # or grid_changed, because it moves (and if need be, restarts) the viewers whose places changed
+        if grid_renderer == 'compositor':
+            if renderer_changed:
+                for disp in list(processes):
+                    stop_viewer(disp)
+            main_loop_compositor(geometry_changed or renderer_changed)
+        else:
+            stop_compositor()
+            main_loop_grid(geometry_changed or renderer_changed)
+        main_loop_screenshare(geometry_changed or grid_changed or page_changed or renderer_changed)
 
         # A geometry change restarts fvwm (above), which comes up on desktop 0.
         # If the teacher was viewing the grid (desktop 1) when they picked "Set
@@ -532,18 +942,21 @@ def main_loop():
         # change made from the own-desktop view) leave the desktop as fvwm set
         # it, so the startup path in teacher_desktop() still lands on desktop 0.
         if desktop_before_restart == '1':
-            subprocess.run(["xdotool", "set_desktop", "1"])
-            subprocess.run(["xdotool", "key", "F23"])
+            set_desktop(1)
+            send_key("F23")
 
     except Exception as ex:
-        simple_text(repr(ex), SCREENX/2, SCREENY - 300)
+        overlay.create_text('error', repr(ex), SCREENX/2, SCREENY - 300)
 
 def restore_original_state():
     for procs in processes.values():
         kill_processes(procs)
+    processes.clear()
+    stop_compositor()
+    overlay.terminate()
     # Leaving grid mode -> back on our own desktop: clear the label.
     set_vnc_desktop_name("")
-    subprocess.run(["xsetroot", "-solid", "grey"])
+    set_background("grey")
     subprocess.Popen(["fvwm", "-r"])
 
 def signal_handler(sig, frame):
@@ -561,8 +974,11 @@ def get_global_display_geometry():
 
     global SCREENX, SCREENY
 
-    (screenx, screeny) = subprocess.run(['xdotool', 'getdisplaygeometry'],
-                                        stdout=subprocess.PIPE, encoding='ascii').stdout.split()
+    if root_watcher:
+        (screenx, screeny) = root_watcher.screen_size()
+    else:
+        (screenx, screeny) = subprocess.run(['xdotool', 'getdisplaygeometry'],
+                                            stdout=subprocess.PIPE, encoding='ascii').stdout.split()
     if SCREENX != int(screenx) or SCREENY != int(screeny):
         SCREENX = int(screenx)
         SCREENY = int(screeny)
@@ -575,12 +991,117 @@ def get_global_display_geometry():
 def open_pg_database():
     global pg_conn
     try:
-        pg_conn = psycopg2.connect(host='127.0.0.1', dbname='collaborate',
-                                   user='collaborate', password='collaborate')
-        pg_conn.autocommit = True
+        conn = psycopg2.connect(host='127.0.0.1', dbname='collaborate',
+                                user='collaborate', password='collaborate')
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("LISTEN vnc_screenshare")
+        cur.close()
+        pg_conn = conn
+        # so that the main loop waits for its notifications, too
+        wake_main_loop()
     except psycopg2.Error:
         pg_conn = None
 
+#
+# ZOOMING IN ON A DESKTOP
+#
+# Clicking a desktop on the grid used to run teacher_zoom (fvwm's
+# ZoomDesktop), a new Python process that imported all of vnc_collaborate,
+# and then asked BBB and freeswitch whether the student was deafed, before
+# it even started the viewer.  The teacher mode fvwm config now asks our
+# HTTP listener instead (/zoom), and zoom_desktop() starts the viewer
+# right away, and undeafs the student, and deafs them again when the
+# viewer exits, in the background, from conference data that we keep
+# for freeswitch.STATUS_MAX_AGE seconds (see freeswitch.set_deaf).
+#
+# Each zoom is timed from the click (when fvwm ran curl) until the
+# viewer's window is viewable, which is when fvwm has mapped it and
+# switched to its virtual desktop, or ZOOM_TIMEOUT seconds.
+
+ZOOM_TIMEOUT = 10
+
+def record_zoom(seconds):
+    zooms = dict(grid_stats['zooms'])
+    zooms['count'] += 1
+    if seconds is None:
+        zooms['timed_out'] += 1
+    else:
+        zooms['seconds_total'] += seconds
+    zooms['last'] = {'seconds': seconds, 'time': time.time()}
+    grid_stats['zooms'] = zooms
+    debug('zoom', seconds)
+
+def time_zoom(clicked):
+    r"""
+    Record how long it took from `clicked` (a time.time()) until a
+    zoomed viewer was on the screen.
+    """
+    from .teacher_zoom import ZOOM_WINDOWS
+    try:
+        x = X11()
+    except Exception as ex:
+        error('not timing zoom:', ex)
+        return
+    try:
+        found = x.wait_for(lambda: [window for window in x.search(ZOOM_WINDOWS, desktop=0) if x.viewable(window)],
+                           ZOOM_TIMEOUT)
+    finally:
+        x.close()
+    record_zoom(time.time() - clicked if found else None)
+
+def zoom_audio(zoom):
+    r"""
+    Undeaf `zoom`'s student, if they were deafed, since we're probably
+    about to talk to them, and deaf them again once its viewer exits.
+    """
+    from . import freeswitch
+    # Fresh conference data each time: the teacher's menu deafs and
+    # undeafs students from other processes (deaf_students), which
+    # freeswitch's cache in this one knows nothing about.  We're off the
+    # click's path here, so the extra getMeetingInfo costs nothing visible.
+    undeafed = False
+    if zoom.student_id:
+        try:
+            undeafed = freeswitch.set_deaf(zoom.student_id, False, max_age=0)
+        except Exception as ex:
+            # probably PermissionError; don't attempt deaf/undeaf operations
+            error('zoom: no freeswitch:', ex)
+    zoom.wait()
+    if undeafed:
+        try:
+            freeswitch.set_deaf(zoom.student_id, True, max_age=0)
+        except Exception as ex:
+            error('zoom: no freeswitch:', ex)
+
+def on_grid(zoom):
+    r"""
+    Is `zoom` (a teacher_zoom.Zoom) of a desktop that's on the grid now,
+    with the ID and socket that its place on the grid is titled with?
+    """
+    display = zoom.student_display
+    return (display in locations and VNC_SOCKET.get(display) == zoom.vnc_socket
+            and IDS.get(display) == zoom.student_id)
+
+def zoom_desktop(window, desktop_width, desktop_height, *optional_args, clicked=None, grid_only=False):
+    r"""
+    What teacher_zoom does, without a new process: zoom in on the desktop
+    whose place on the grid is the window named `window` (as fvwm quotes
+    it), on a `desktop_width` x `desktop_height` screen.  `clicked` is
+    when the teacher clicked it (a time.time()), if we know.  Returns
+    False if `window` isn't a desktop's place on the grid (or, with
+    `grid_only`, one of the places on our grid right now).
+    """
+    # teacher_zoom imports freeswitch, which imports us
+    from .teacher_zoom import Zoom
+    zoom = Zoom(window, desktop_width, desktop_height, *optional_args)
+    if not zoom.valid or (grid_only and not on_grid(zoom)):
+        return False
+    zoom.start()
+    threading.Thread(target=zoom_audio, args=(zoom,), daemon=True).start()
+    threading.Thread(target=time_zoom, args=(clicked or time.time(),), daemon=True).start()
+    return True
+
 def launch_desktop_viewer():
     r"""
     Launch a zoomed VNC viewer of the moderator's own desktop on desktop 0.
@@ -603,12 +1124,8 @@ def launch_desktop_viewer():
     # FVWM's DestroyWindowEvent handler recognizes it
     window_name = ";".join(["TeacherViewVNC", "", myUNIXname, geometry, vnc_socket])
 
-    # Launch teacher_zoom the same way FVWM's ZoomDesktop does
-    subprocess.Popen([
-        "python3", "-m", "vnc_collaborate", "teacher_zoom",
-        "'" + window_name + "'",
-        str(SCREENX), str(SCREENY),
-    ])
+    # Zoom in on it the same way FVWM's ZoomDesktop does
+    zoom_desktop("'" + window_name + "'", SCREENX, SCREENY)
 
     # Wait for the own-desktop viewer window to appear on desktop 0.
     # teacher_zoom picks the viewer by scale: xtigervncviewer (window name
@@ -617,6 +1134,10 @@ def launch_desktop_viewer():
     # either -- the same two names toggle_desktop_view() uses on the kill side.
     # Waiting only for "TigerVNC" made every grid->own-desktop toggle stall the
     # full 5 s whenever the grid had been resized away from the native geometry.
+    if x_display():
+        # woken up by the window being mapped
+        x_display().wait_for_window("Zoomed Student Desktop|TigerVNC", desktop=0, timeout=5)
+        return True
     for _ in range(50):  # up to 5 seconds
         result = subprocess.run(
             ["xdotool", "search", "--desktop", "0", "--name",
@@ -640,10 +1161,7 @@ def toggle_desktop_view():
     If on desktop 1 (grid view): launch a zoomed VNC viewer of the
     moderator's own desktop on desktop 0 and switch there.
     """
-    current_desk = subprocess.run(
-        ["xdotool", "get_desktop"],
-        stdout=subprocess.PIPE, encoding='ascii'
-    ).stdout.strip()
+    current_desk = get_desktop()
 
     if current_desk == '1':
         # We're in grid mode — zoom to the moderator's own desktop
@@ -651,9 +1169,9 @@ def toggle_desktop_view():
             return
 
         # Switch to desktop 0 (where zoomed views live)
-        subprocess.run(["xdotool", "set_desktop", "0"])
+        set_desktop(0)
         # Tell FVWM to remove grid bindings (F24)
-        subprocess.run(["xdotool", "key", "F24"])
+        send_key("F24")
 
     else:
         # We're on the desktop view — kill zoomed viewer windows.
@@ -666,26 +1184,73 @@ def toggle_desktop_view():
         # the moderator's "Grid" label is delayed or missing.  windowkill exits
         # both viewer types immediately (exit code 1, not a signal, so it trips
         # no "died with signal" warning in teacher_zoom).
-        for pattern in ["Zoomed Student Desktop", "TigerVNC"]:
-            result = subprocess.run(
-                ["xdotool", "search", "--desktop", "0", "--name", pattern],
-                stdout=subprocess.PIPE, encoding='ascii'
-            )
-            for wid in result.stdout.strip().split('\n'):
-                if wid:
-                    subprocess.run(["xdotool", "windowkill", wid])
+        if x_display():
+            # returns when the windows are gone
+            x_display().kill_windows("Zoomed Student Desktop|TigerVNC", desktop=0)
+        else:
+            for pattern in ["Zoomed Student Desktop", "TigerVNC"]:
+                result = subprocess.run(
+                    ["xdotool", "search", "--desktop", "0", "--name", pattern],
+                    stdout=subprocess.PIPE, encoding='ascii'
+                )
+                for wid in result.stdout.strip().split('\n'):
+                    if wid:
+                        subprocess.run(["xdotool", "windowkill", wid])
+            time.sleep(0.5)
         # Switch to desktop 1 (grid view).
-        time.sleep(0.5)
-        subprocess.run(["xdotool", "set_desktop", "1"])
+        set_desktop(1)
         # Tell FVWM to restore grid bindings (F23)
-        subprocess.run(["xdotool", "key", "F23"])
+        send_key("F23")
+
+# Any local user can connect to our HTTP listener, so the requests that
+# do something (all but /stats.json) have to carry TEACHER_DESKTOP_TOKEN,
+# which only our own processes (fvwm, and what it runs) have in their
+# environment, in this header.  fvwm's curls read it from their stdin,
+# so that it isn't on their command lines for ps to show.
+
+TOKEN_HEADER = 'X-Teacher-Desktop-Token'
 
 class TeacherDesktopHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/grid-toggle':
+        received = time.time()
+        (path, _, query) = self.path.partition('?')
+        if path in ('/grid-toggle', '/zoom') and \
+           not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), os.environ['TEACHER_DESKTOP_TOKEN']):
+            self.send_response(403)
+            self.end_headers()
+        elif path == '/grid-toggle':
             toggle_desktop_view()
             self.send_response(200)
             self.end_headers()
+        elif path == '/zoom':
+            # see ZoomDesktop in the teacher mode fvwm config
+            params = urllib.parse.parse_qs(query)
+            try:
+                window = params['window'][0]
+                width = int(params['width'][0])
+                height = int(params['height'][0])
+            except (KeyError, ValueError):
+                self.send_response(400)
+                self.end_headers()
+                return
+            options = [option for option in params.get('options', []) if option]
+            try:
+                clicked = float(params['clicked'][0])
+            except (KeyError, ValueError):
+                clicked = received
+            # only the desktops on our grid, not any socket a request names
+            if zoom_desktop(window, width, height, *options, clicked=clicked, grid_only=True):
+                self.send_response(200)
+            else:
+                self.send_response(404)
+            self.end_headers()
+        elif path == '/stats.json':
+            body = json.dumps(grid_stats).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.end_headers()
@@ -697,8 +1262,10 @@ def start_http_listener():
     r"""
     Start a lightweight HTTP server on a random port, bound to localhost only.
     Sets TEACHER_DESKTOP_PORT in the environment so FVWM key bindings can
-    use it to curl the appropriate endpoint.
+    use it to curl the appropriate endpoint, and TEACHER_DESKTOP_TOKEN,
+    which they have to send with it (see TOKEN_HEADER).
     """
+    os.environ['TEACHER_DESKTOP_TOKEN'] = secrets.token_urlsafe()
     server = http.server.HTTPServer(('127.0.0.1', 0), TeacherDesktopHandler)
     port = server.server_address[1]
     os.environ['TEACHER_DESKTOP_PORT'] = str(port)
@@ -706,6 +1273,89 @@ def start_http_listener():
     thread.start()
     return server
 
+# inotify events on /run/vnc: a desktop started or stopped, or vnc.py's
+# invalidate_VNC_info() touched its socket because it changed size
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# How long wait_for_changes() waits for an event.  Nothing tells us when
+# people join or leave the meeting, so while we're only showing the
+# current meeting, we look every MEETING_POLL_INTERVAL seconds (each
+# look is a getMeetings() of the whole server, unless the proxy's roster
+# service answers it, so not too often).  And
+# every IDLE_POLL_INTERVAL seconds, main_loop() runs anyway, to restart
+# any viewers that died and retry geometry queries that failed.  Without
+# root_watcher, the inotify watch, or a pidfd to tell us when fvwm exits,
+# it's the old once a second.
+
+MEETING_POLL_INTERVAL = 5
+IDLE_POLL_INTERVAL = 10
+POLL_INTERVAL = 1
+
+def wait_for_changes(fvwm_pidfd, vnc_watch):
+    r"""
+    Wait until something that main_loop() cares about might have
+    changed: a desktop in /run/vnc, a root window property or the screen
+    size, the screenshare, a geometry query finishing, or fvwm exiting.
+    """
+    global pg_conn
+
+    if root_watcher and root_watcher.process_events():
+        # main_loop()'s own queries can leave events queued, which
+        # select() won't see
+        return
+    now = time.monotonic()
+    if root_watcher is None or vnc_watch is None or fvwm_pidfd is None:
+        idle_deadline = now + POLL_INTERVAL
+    else:
+        idle_deadline = now + IDLE_POLL_INTERVAL
+    meeting_deadline = now + MEETING_POLL_INTERVAL
+
+    while True:
+        deadline = idle_deadline if attendees is None else min(idle_deadline, meeting_deadline)
+        sources = [wakeup_read, fvwm_pidfd, vnc_watch, root_watcher, pg_conn]
+        try:
+            (readable, _, _) = select.select([s for s in sources if s is not None], [], [],
+                                             max(deadline - time.monotonic(), 0))
+        except InterruptedError:
+            continue
+        if not readable:
+            if time.monotonic() >= idle_deadline:
+                return
+            meeting_deadline = time.monotonic() + MEETING_POLL_INTERVAL
+            try:
+                if get_attendees() == attendees:
+                    continue
+            except Exception:
+                # main_loop() will show it
+                pass
+            VNCdata_failed.clear()
+            return
+
+        if wakeup_read in readable:
+            drain(wakeup_read)
+        if vnc_watch in readable:
+            drain(vnc_watch)
+            # a desktop that didn't answer may have been restarted
+            VNCdata_failed.clear()
+        if pg_conn in readable:
+            try:
+                pg_conn.poll()
+                pg_conn.notifies.clear()
+            except psycopg2.Error:
+                pg_conn.close()
+                pg_conn = None
+                threading.Thread(target=open_pg_database).start()
+        if root_watcher in readable and not root_watcher.process_events():
+            if len(readable) == 1:
+                # just events we don't care about
+                continue
+        return
+
 def teacher_desktop(screenx=None, screeny=None):
 
     # This session lands on the moderator's own desktop (desktop 0, see the
@@ -733,16 +1383,39 @@ def teacher_desktop(screenx=None, screeny=None):
         subprocess.run(["xmodmap", "-e", f"keycode {keycode} = F{13 + i}"],
                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+    global overlay
+    overlay = Overlay(on_close=overlay_closed)
+
+    global wakeup_read, wakeup_write
+    (wakeup_read, wakeup_write) = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+
     # open the PostgreSQL database in background so it doesn't hang us if the database doesn't exist
     thread = threading.Thread(target=open_pg_database)
     thread.start()
     # at some point, should do thread.join()
 
     # I've seen a race condition where the xsetroot, and the fvwm that follows in main_loop(),
-    # errors out, unable to open the display.  So retry the xsetroot until it succeeds.
+    # errors out, unable to open the display.  So retry opening the display until it succeeds.
+    #
+    # After that, we watch the root window's properties and size ourselves, instead of
+    # running xprop and xdotool every time through main_loop(), and do our window
+    # management on the same connection (see x11.py).
+    global root_watcher
     retry_attempts = 10
-    while subprocess.run(["xsetroot", "-solid", "black"]).returncode != 0 and retry_attempts > 0:
+    while root_watcher is None and retry_attempts > 0:
+        try:
+            root_watcher = RootWatcher()
+        except Exception as ex:
+            error('not watching the X display:', ex)
         retry_attempts -= 1
+    if root_watcher:
+        root_watcher.set_background("black")
+    else:
+        retry_attempts = 10
+        while subprocess.run(["xsetroot", "-solid", "black"]).returncode != 0 and retry_attempts > 0:
+            retry_attempts -= 1
     debug('initial call to main_loop')
     main_loop()
 
@@ -750,24 +1423,38 @@ def teacher_desktop(screenx=None, screeny=None):
     # grid windows on desktop 1, which may cause FVWM to switch there
     # despite SkipMapping.  Ensure we're on desktop 0 and launch the
     # moderator's own desktop viewer so desk 0 isn't a black screen.
-    subprocess.run(["xdotool", "set_desktop", "0"])
+    set_desktop(0)
     launch_desktop_viewer()
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # Big Blue Button currently (version 2.2.22) lacks a mechanism in its REST API
-    # to get notifications when users come and go.  So we poll every second to
-    # update the display until FVWM exits.
+    # Update the display whenever something changes (see wait_for_changes)
+    # until FVWM exits.  main_loop() restarts fvwm when the screen changes
+    # size, so watch whichever one is current.
+
+    vnc_watch = inotify_watch('/run/vnc', IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM | IN_ATTRIB)
+    watched_fvwm = None
+    fvwm_pidfd = None
 
     while True:
-        try:
-            fvwm.wait(timeout=1)
+        if fvwm is not watched_fvwm:
+            if fvwm_pidfd is not None:
+                os.close(fvwm_pidfd)
+            watched_fvwm = fvwm
+            try:
+                fvwm_pidfd = os.pidfd_open(fvwm.pid)
+            except (AttributeError, OSError):
+                # the kernel is older than 5.3; we'll notice on the next poll
+                fvwm_pidfd = None
+        if fvwm.poll() is not None:
+            debug('fvwm exited')
+            break
+        wait_for_changes(fvwm_pidfd, vnc_watch)
+        if fvwm.poll() is not None:
             debug('fvwm exited')
             break
-        except subprocess.TimeoutExpired:
-            debug('fvwm.wait TimeoutExpired')
-            main_loop()
+        main_loop()
 
     restore_original_state()
 
@@ -775,94 +1462,30 @@ def teacher_desktop(screenx=None, screeny=None):
 # THE SCREENSHARE FEATURE
 #
 
-def close_projection_button():
-    def app():
-
-        window = tk.Tk()
-
-        button = tk.Label(
-            master=window,
-            text="End screenshare",
-            bg="cyan",
-            fg="black",
-        )
-
-        button.bind("<Button-1>", lambda self: window.destroy())
-
-        button.pack()
-
-        window.geometry("-0+0")
-        window.title("Projection Controls")
-        window.wm_title("Projection Controls")
-
-        window.update()
-
-        # Implementing this function with the multiprocessing package
-        # is problematic.  We inherit a lot of state from the parent
-        # process, in particular, its signal handlers, which were
-        # changed in teacher_desktop(), and I do depend on being able
-        # to close this window by sending it SIGTERM.  Maybe it would
-        # be best to spawn an entire new Python process to avoid these
-        # kinds of problems, i.e, use process.Popen rather than
-        # multiprocessing.Process.
-
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-
-        window.mainloop()
-
-        # Once the window closes, probably from the FVWM window manager
-        # (see comment there), end any active screen shares for this
-        # meeting.
-
-        try:
-            conn = psycopg2.connect(host='127.0.0.1', dbname='collaborate',
-                                    user='collaborate', password='collaborate')
-            conn.autocommit = True
-            cur = conn.cursor()
-            cur.execute('DELETE FROM vnc_screenshare WHERE "meetingId" = %s', (myMeetingID,))
-            cur.execute("NOTIFY vnc_screenshare")
-            cur.close()
-            conn.close()
-        except psycopg2.Error:
-            pass
-
-    process = multiprocessing.Process(target = app)
-    process.start()
-    return process
-
-def colored_rect(width, height, xlocation, ylocation):
+def end_screenshare():
     r"""
-    Fork a subprocess to display a colored rectangle, using the tk toolkit.
-
-    Returns a multiprocessing.Process object that manages the subprocess.
+    End any active screen shares for this meeting.
     """
-    def app():
-
-        window = tk.Tk()
-
-        window.geometry(str(width)+"x"+str(height)+"+"+str(xlocation)+"+"+str(ylocation))
-        window.configure(background = 'red')
-        # setting window title 'highlight' causes FVWM to move this window below all others
-        window.title('highlight')
-
-        # Implementing this function with the multiprocessing package
-        # is problematic.  We inherit a lot of state from the parent
-        # process, in particular, its signal handlers, which were
-        # changed in teacher_desktop(), and I do depend on being able
-        # to close this window by sending it SIGTERM.  Maybe it would
-        # be best to spawn an entire new Python process to avoid these
-        # kinds of problems, i.e, use process.Popen rather than
-        # multiprocessing.Process.
-
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-
-        window.mainloop()
+    try:
+        conn = psycopg2.connect(host='127.0.0.1', dbname='collaborate',
+                                user='collaborate', password='collaborate')
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute('DELETE FROM vnc_screenshare WHERE "meetingId" = %s', (myMeetingID,))
+        cur.execute("NOTIFY vnc_screenshare")
+        cur.close()
+        conn.close()
+    except psycopg2.Error:
+        pass
 
-    process = multiprocessing.Process(target = app)
-    process.start()
-    return process
+def overlay_closed(id):
+    r"""
+    Called (from the overlay's thread) when one of its windows closes.
+    """
+    # The "End screenshare" button closes when it's clicked, or when the
+    # FVWM window manager closes it (see comment there).
+    if id == 'projection_controls':
+        end_screenshare()
 
 def project_to_students(screenx, screeny, student_window_name = None):
 
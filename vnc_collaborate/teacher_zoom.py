@@ -6,47 +6,40 @@ import sys
 import vnc_collaborate.freeswitch as freeswitch
 from vnc_collaborate.desktop_name import set_vnc_desktop_name
 
-def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
-   r"""
-   teacher-zoom(WINDOW-NAME, DESKTOP_WIDTH, DESKTOP_HEIGHT)
-
-   Called from fvwm when a student desktop is clicked in a teacher desktop view,
-   this script is passed the window name of the miniaturized view-only student window
-   on the teacher desktop (which was created by the teacher-desktop script).
+# The names of the zoomed viewers' windows: ssvncviewer's, and
+# xtigervncviewer's ("... - TigerVNC")
 
-   We decode the window name (which was set in teacher_desktop) to figure
-   out the user name and X11 display name in order to launch a full-screen,
-   fully interactive view of the student desktop, so that the teacher can
-   interact with it.
+ZOOM_WINDOWS = "Zoomed Student Desktop|TigerVNC"
 
-   We also check to see if the student was deafed, and if so undeaf them
-   on entry, then re-deaf the student after the full-screen view exits.
-   """
+class Zoom:
+   r"""
+   Zoom(WINDOW-NAME, DESKTOP_WIDTH, DESKTOP_HEIGHT, [viewonly])
 
-   # See FVWM man page on $[w.name] - the window name is encased in single quotes
-   # and embedded single quotes are escaped with a backspace.  The window name
-   # created in the teacher_desktop.py script has the fields separated by semicolons.
-   # So, this expression undoes the FVWM quoting and splits apart our arguments.
+   A full-screen, fully interactive view of the student desktop whose
+   miniaturized view on a teacher desktop is the window named WINDOW-NAME
+   (see teacher_zoom).  `valid` is False if it isn't one of those windows.
 
-   args = window.replace("\\'", "'")[1:-1].split(';')
+   start() launches the viewer, and wait() waits for it to exit.  Deafing
+   and undeafing the student is up to the caller.
+   """
 
-   if len(args) >= 5 and args[0] == 'TeacherViewVNC':
+   def __init__(self, window, desktop_width, desktop_height, *optional_args):
 
-      STUDENT_ID = args[1]
-      STUDENT_DISPLAY = args[2]
-      NATIVE_GEOMETRY = args[3]
-      VNC_SOCKET = args[4]
+      # See FVWM man page on $[w.name] - the window name is encased in single quotes
+      # and embedded single quotes are escaped with a backspace.  The window name
+      # created in the teacher_desktop.py script has the fields separated by semicolons.
+      # So, this expression undoes the FVWM quoting and splits apart our arguments.
 
-      try:
-          freeswitch.get_status()
-          was_deafed = freeswitch.is_deaf(STUDENT_ID, default=False)
-      except:
-          # if we couldn't access freeswitch (probably PermissionError), just don't attempt deaf/undeaf operations
-          was_deafed = False
+      self.args = window.replace("\\'", "'")[1:-1].split(';')
+      self.proc = None
+      self.valid = len(self.args) >= 5 and self.args[0] == 'TeacherViewVNC'
+      if not self.valid:
+         return
 
-      # If the student was deafed, undeaf them, since we're probably about to talk to them
-      if was_deafed:
-         freeswitch.undeaf_student(STUDENT_ID)
+      self.student_id = self.args[1]
+      self.student_display = self.args[2]
+      NATIVE_GEOMETRY = self.args[3]
+      self.vnc_socket = VNC_SOCKET = self.args[4]
 
       (nativex, nativey) = map(int, NATIVE_GEOMETRY.split('x'))
       scalex = int(desktop_width)/nativex
@@ -56,7 +49,7 @@ def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
       offsetx = int((int(desktop_width) - scale*nativex)/2)
       offsety = int((int(desktop_height) - scale*nativey)/2)
 
-      geometry = desktop_width + 'x' + desktop_height + '+' + str(offsetx) + '+' + str(offsety)
+      geometry = str(desktop_width) + 'x' + str(desktop_height) + '+' + str(offsetx) + '+' + str(offsety)
 
       # Use ssvncviewer if we need to scale the view.  But xtigervncviewer's clipboard (X11
       # selection) support is much better, and better integrated with the Xtigervnc server, so
@@ -67,6 +60,7 @@ def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
           VNC_VIEWER = 'ssvncviewer'
       else:
           VNC_VIEWER = 'xtigervncviewer'
+      self.viewer = VNC_VIEWER
 
       if VNC_VIEWER == 'xtigervncviewer':
          # Send/Set Primary is turned off because we just want the clipboard, not the PRIMARY selection
@@ -110,6 +104,13 @@ def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
       if len(optional_args) > 0 and optional_args[0] == 'viewonly':
          proc_args.append('-viewonly')
 
+      self.proc_args = proc_args
+
+   def start(self):
+      r"""
+      Launch the viewer.
+      """
+
       env = os.environ
       # env['SSVNC_DEBUG_SELECTION'] = '1'
 
@@ -123,12 +124,21 @@ def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
       # Do NOT key "own desktop" on an empty STUDENT_ID: remote/tunneled
       # desktops pulled in from other servers aren't BBB participants, so their
       # STUDENT_ID (IDS[display]) is empty too, which wrongly blanked them.
-      if len(args) >= 6:
-         set_vnc_desktop_name(args[5] or STUDENT_DISPLAY)
+      #
+      # The viewer goes first, since the teacher is waiting for it.
+      self.proc = subprocess.Popen(self.proc_args, env=env)
+
+      if len(self.args) >= 6:
+         set_vnc_desktop_name(self.args[5] or self.student_display)
       else:
          set_vnc_desktop_name("")
 
-      proc = subprocess.Popen(proc_args, env=env)
+   def wait(self):
+      r"""
+      Wait for the viewer to exit.
+      """
+
+      proc = self.proc
       proc.wait()
 
       # The fullscreen viewer has exited; we're back in the grid view.
@@ -138,12 +148,54 @@ def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
          import signal as signal_module
          import syslog
          signame = signal_module.Signals(-proc.returncode).name
-         caller = "own desktop" if not STUDENT_ID else f"student {STUDENT_DISPLAY}"
+         caller = "own desktop" if not self.student_id else f"student {self.student_display}"
          display = os.environ.get('DISPLAY', '?')
-         msg = f"teacher_zoom: {VNC_VIEWER} died with {signame} (viewing {caller}, socket {VNC_SOCKET}, DISPLAY={display})"
+         msg = f"teacher_zoom: {self.viewer} died with {signame} (viewing {caller}, socket {self.vnc_socket}, DISPLAY={display})"
          syslog.syslog(syslog.LOG_WARNING, msg)
          print(msg, file=sys.stderr, flush=True)
 
+def teacher_zoom(window, desktop_width, desktop_height, *optional_args):
+   r"""
+   teacher-zoom(WINDOW-NAME, DESKTOP_WIDTH, DESKTOP_HEIGHT)
+
+   Called from fvwm when a student desktop is clicked in a teacher desktop view,
+   this script is passed the window name of the miniaturized view-only student window
+   on the teacher desktop (which was created by the teacher-desktop script).
+
+   We decode the window name (which was set in teacher_desktop) to figure
+   out the user name and X11 display name in order to launch a full-screen,
+   fully interactive view of the student desktop, so that the teacher can
+   interact with it.
+
+   We also check to see if the student was deafed, and if so undeaf them
+   on entry, then re-deaf the student after the full-screen view exits.
+
+   teacher_desktop does all this itself, without starting a Python process,
+   when the teacher mode fvwm config asks it to (see zoom_desktop there);
+   this is what the student grid, and the teacher mode config if
+   teacher_desktop doesn't answer, run instead.
+   """
+
+   zoom = Zoom(window, desktop_width, desktop_height, *optional_args)
+
+   if zoom.valid:
+
+      STUDENT_ID = zoom.student_id
+
+      try:
+          freeswitch.get_status()
+          was_deafed = freeswitch.is_deaf(STUDENT_ID, default=False)
+      except:
+          # if we couldn't access freeswitch (probably PermissionError), just don't attempt deaf/undeaf operations
+          was_deafed = False
+
+      # If the student was deafed, undeaf them, since we're probably about to talk to them
+      if was_deafed:
+         freeswitch.undeaf_student(STUDENT_ID)
+
+      zoom.start()
+      zoom.wait()
+
       # Re-deaf the student, but ONLY if they were deafed originally
       if was_deafed:
          freeswitch.deaf_student(STUDENT_ID)
@@ -0,0 +1,740 @@
+#
+# Thumbnails of the desktops, shared by everybody looking at them.
+#
+# A thumbnail is a connection to a desktop (rfbclient.py) that keeps a
+# copy of it, scaled down to fit in some area, up to date: every
+# framebuffer update is box-filtered into the thumbnail with numpy, and
+# only the thumbnail pixels it touched are recomputed.  Its updates are
+# paced -- it asks for at most so many a second -- since a desktop only
+# sends one when it's been asked for it.  Refitting a thumbnail to a new
+# area (because the grid was re-laid out) rescales the full-size copy of
+# the desktop that it keeps, without asking the desktop for anything.
+#
+# The teachers' grids (grid_compositor.py) used to each hold their own
+# thumbnails, so with three co-teachers, every desktop served three
+# connections just for thumbnails.  So the proxy forks a thumbnail
+# service (like its other helper services), which holds one thumbnail,
+# THUMBNAIL_SIZE or smaller, per desktop somebody's looking at, and
+# publishes it in shared memory, THUMBNAIL_DIR/<desktop>:
+#
+#     a HEADER (magic, stale, sequence number, the thumbnail's columns
+#     and rows, the desktop's width and height), then the thumbnail's
+#     RGB rows
+#
+# The sequence number is odd while the service is writing, so a reader
+# copies the pixels and checks that the sequence number was the same,
+# and even, before and after.  When a desktop changes size, its file is
+# replaced by a new one, and the old one marked stale.  A file has its
+# desktop socket's owner, group and read permissions, so it can be read
+# by whoever could have connected to the desktop.
+#
+# Readers tell the service what they're looking at, and how often they
+# want it updated, by connecting to THUMBNAIL_SOCKET (a SOCK_SEQPACKET
+# socket) and sending it JSON datagrams:
+#
+#     {"subscribe": {"alice": 2, "bob": 10}}
+#
+# each of which replaces that connection's last one.  The service keeps
+# a thumbnail of every desktop that somebody who may read it is
+# subscribed to, updated as often as its most demanding subscriber
+# wants, and drops it when nobody is.  So the load a desktop sees from
+# thumbnails doesn't grow with the number of people looking at it, and
+# (as far as the freezer, freezer.py, can tell) only a desktop somebody
+# is looking at has a client.  SharedThumbnail is a thumbnail read from
+# the service, that grid_compositor uses when the service is running.
+# A restarted service starts over with new files and knows nothing of
+# its old subscribers, so a SharedThumbnail that sees its connection
+# hang up reads the desktop itself (a Thumbnail) until it can
+# reconnect and subscribe again, and reopens a file that was replaced.
+#
+#     python3 -m vnc_collaborate thumbnail-service
+
+import os
+import pwd
+import json
+import mmap
+import stat
+import select
+import time
+import socket
+import struct
+import threading
+
+from .services import error, start_service
+from .rfbclient import RFBClient, RFBError
+from .freezer import thaw_desktop
+from .vnc import invalidate_VNC_info
+
+THUMBNAIL_SOCKET = '/run/vnc-thumbnails.sock'
+THUMBNAIL_DIR = '/dev/shm/vnc-thumbnails'
+
+# The largest thumbnail the service keeps, and whether the proxy starts it
+
+THUMBNAIL_SIZE = tuple(int(n) for n in os.environ.get('VNC_THUMBNAIL_SIZE', '1280x720').split('x'))
+THUMBNAILS = os.environ.get('VNC_THUMBNAILS', '1') != '0'
+
+RUN_DIR = '/run/vnc'
+
+# magic, stale, sequence number, columns, rows, desktop width, desktop height
+
+HEADER = struct.Struct('<4sIQIIII')
+HEADER_SIZE = 64
+MAGIC = b'VNCT'
+
+DEFAULT_FPS = 2
+
+# How long a thumbnail waits before reconnecting to a desktop that went away
+
+RECONNECT_INTERVAL = 2
+CONNECT_TIMEOUT = 5
+
+def _bins(size, scaled):
+    r"""
+    The boundaries of the `scaled` bins that `size` pixels are averaged
+    into: bin i is pixels bins[i] to bins[i+1]-1.
+    """
+    import numpy
+    return (numpy.arange(scaled + 1) * size) // scaled
+
+def _downscale(pixels, ybins, xbins):
+    r"""
+    Box-filter `pixels` (rows, columns, channels) into the bins
+    `ybins` x `xbins`, which start at its first row and column.
+    """
+    import numpy
+    sums = numpy.add.reduceat(pixels, ybins[:-1] - ybins[0], axis=0, dtype=numpy.uint32)
+    sums = numpy.add.reduceat(sums, xbins[:-1] - xbins[0], axis=1)
+    counts = numpy.diff(ybins)[:, None] * numpy.diff(xbins)[None, :]
+    return sums // counts[:, :, None]
+
+def _fit(width, height, area):
+    r"""
+    The size (columns, rows) of a `width` x `height` desktop scaled down
+    to fit in `area` (but never scaled up).
+    """
+    scale = min(area[0]/width, area[1]/height, 1)
+    return (max(1, int(width*scale)), max(1, int(height*scale)))
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+class Thumbnail(threading.Thread):
+    r"""
+    A connection to the desktop listening on `path`, keeping a copy of
+    it scaled down to fit in `width` x `height` (but never scaled up).
+    """
+
+    def __init__(self, path, width, height):
+        super().__init__(daemon=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.area = (width, height)
+        self.interval = 1/DEFAULT_FPS
+        self.wakeup = threading.Event()
+        self.client = None
+        self.closed = False
+        # the scaled desktop, as RGB rows, and the box (r0, c0, r1, c1)
+        # of it that changed since take() last looked
+        self.image = None
+        self.damage = None
+        self._geometry = None
+        self.rescaling = threading.Lock()
+
+    def fit(self, width, height):
+        r"""
+        Rescale the thumbnail to fit in `width` x `height`.
+        """
+        with self.lock:
+            if self.area == (width, height):
+                return
+            self.area = (width, height)
+            client = self.client
+        # from the copy of the desktop we already have: asking the desktop
+        # for all of it again would cost it (and us) a full framebuffer
+        if client:
+            self._rescale([])
+
+    def pace(self, fps):
+        r"""
+        Ask for at most `fps` updates a second (or none, if 0).
+        """
+        interval = 1/fps if fps > 0 else None
+        if interval != self.interval:
+            self.interval = interval
+            self.wakeup.set()
+
+    def _wait(self, requested):
+        r"""
+        Wait until it's time for the next update request, after one at
+        `requested`.  The wait is cut short if the thumbnail is sped up
+        (say, because the pointer moved onto its tile) or closed.
+        """
+        while not self.closed:
+            if self.interval is None:
+                self.wakeup.wait()
+            else:
+                remaining = requested + self.interval - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.wakeup.wait(remaining)
+            self.wakeup.clear()
+
+    def take(self):
+        r"""
+        Returns the thumbnail's size (columns, rows), the corner (row,
+        column) of the part of it that changed since the last take(), and
+        that part's RGB pixels -- or None, if nothing changed.
+        """
+        with self.lock:
+            if self.damage is None:
+                return None
+            (r0, c0, r1, c1) = self.damage
+            self.damage = None
+            (rows, cols) = self.image.shape[:2]
+            return ((cols, rows), (r0, c0), self.image[r0:r1, c0:c1].copy())
+
+    def _updated(self, image, damage):
+        r"""
+        Called with the thumbnail, and the box of it that just changed.
+        """
+        pass
+
+    def _rescale(self, rects):
+        # fit() calls this too, from another thread
+        with self.rescaling:
+            self._rescale_locked(rects)
+
+    def _rescale_locked(self, rects):
+        import numpy
+
+        client = self.client
+        if client is None:
+            return
+        framebuffer = client.framebuffer
+        (height, width) = framebuffer.shape[:2]
+        if width == 0 or height == 0:
+            return
+        image = self.image
+        if self._geometry != (width, height, self.area):
+            if self._geometry is not None and self._geometry[:2] != (width, height):
+                # DesktopSize: the desktop was resized under us
+                invalidate_VNC_info(self.path)
+            self._geometry = (width, height, self.area)
+            (cols, rows) = _fit(width, height, self.area)
+            self.ybins = _bins(height, rows)
+            self.xbins = _bins(width, cols)
+            image = numpy.zeros((rows, cols, 3), dtype=numpy.uint8)
+            rects = [(0, 0, width, height)]
+
+        (ybins, xbins) = (self.ybins, self.xbins)
+        damage = None
+        for (x, y, w, h) in rects:
+            if w == 0 or h == 0:
+                continue
+            r0 = int(numpy.searchsorted(ybins, y, 'right')) - 1
+            r1 = int(numpy.searchsorted(ybins, y + h, 'left'))
+            c0 = int(numpy.searchsorted(xbins, x, 'right')) - 1
+            c1 = int(numpy.searchsorted(xbins, x + w, 'left'))
+            # pixels are B, G, R, X
+            block = framebuffer[ybins[r0]:ybins[r1], xbins[c0]:xbins[c1], 2::-1]
+            image[r0:r1, c0:c1] = _downscale(block, ybins[r0:r1+1], xbins[c0:c1+1])
+            damage = _union(damage, (r0, c0, r1, c1))
+
+        with self.lock:
+            if image is not self.image:
+                self.image = image
+                (rows, cols) = image.shape[:2]
+                damage = (0, 0, rows, cols)
+                self.damage = damage
+            elif damage is not None:
+                self.damage = _union(self.damage, damage)
+        if damage is not None:
+            self._updated(image, damage)
+
+    def _serve(self):
+        thaw_desktop(self.path, by='grid')
+        client = RFBClient(self.path, timeout=CONNECT_TIMEOUT)
+        with self.lock:
+            if self.closed:
+                client.close()
+                return
+            self.client = client
+            self._geometry = None
+            client.request_update(incremental=False)
+        requested = time.monotonic()
+        while not self.closed:
+            rects = client.read_message()
+            if rects is None:
+                continue
+            self._rescale(rects)
+            self._wait(requested)
+            with self.lock:
+                client.request_update()
+            requested = time.monotonic()
+
+    def run(self):
+        while not self.closed:
+            try:
+                self._serve()
+            except (OSError, RFBError) as ex:
+                if not self.closed:
+                    error('thumbnail:', self.path, ex)
+            with self.lock:
+                if self.client:
+                    self.client.close()
+                    self.client = None
+            if not self.closed:
+                time.sleep(RECONNECT_INTERVAL)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.set()
+            if self.client:
+                self.client.close()
+
+#
+# The thumbnail service
+#
+
+class _SharedImage:
+    r"""
+    A thumbnail's file in THUMBNAIL_DIR, for a desktop whose socket has
+    the stat `st`.
+    """
+
+    def __init__(self, name, cols, rows, desktop_size, st):
+        self.path = os.path.join(THUMBNAIL_DIR, name)
+        self.cols = cols
+        self.rows = rows
+        self.desktop_size = desktop_size
+        self.seq = 0
+        new = self.path + '.new'
+        fd = os.open(new, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + rows * cols * 3)
+            self.mm = mmap.mmap(fd, HEADER_SIZE + rows * cols * 3)
+            self._header()
+            self.ino = os.fstat(fd).st_ino
+            os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, st.st_mode & 0o440)
+        finally:
+            os.close(fd)
+        os.replace(new, self.path)
+
+    def _header(self, stale=0):
+        self.mm[:HEADER.size] = HEADER.pack(MAGIC, stale, self.seq, self.cols, self.rows, *self.desktop_size)
+
+    def write(self, image, r0, r1):
+        self.seq += 1
+        self._header()
+        offset = HEADER_SIZE + r0 * self.cols * 3
+        self.mm[offset:offset + (r1 - r0) * self.cols * 3] = image[r0:r1].tobytes()
+        self.seq += 1
+        self._header()
+
+    def retire(self, unlink=False):
+        self._header(stale=1)
+        self.mm.close()
+        if unlink:
+            # A closing thumbnail is retired in the background, so the
+            # desktop may have been subscribed to again, and its file
+            # replaced, in the meantime; that one isn't ours to remove
+            try:
+                if os.stat(self.path).st_ino == self.ino:
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+class _PublishedThumbnail(Thumbnail):
+    r"""
+    The service's thumbnail of desktop `name`, published in THUMBNAIL_DIR.
+    """
+
+    def __init__(self, name):
+        super().__init__(os.path.join(RUN_DIR, name), *THUMBNAIL_SIZE)
+        self.name = name
+        self.shared = None
+
+    def _updated(self, image, damage):
+        (rows, cols) = image.shape[:2]
+        desktop_size = (self.client.width, self.client.height)
+        if not self.shared or (self.shared.cols, self.shared.rows, self.shared.desktop_size) != (cols, rows, desktop_size):
+            old = self.shared
+            self.shared = _SharedImage(self.name, cols, rows, desktop_size, os.stat(self.path))
+            if old:
+                old.retire()
+            damage = (0, 0, rows, cols)
+        self.shared.write(image, damage[0], damage[2])
+
+    def close(self):
+        super().close()
+        self.join(CONNECT_TIMEOUT)
+        if self.shared:
+            self.shared.retire(unlink=True)
+
+def _may_read(uid, gid, path):
+    r"""
+    Could the user `uid` (whose primary group is `gid`) connect to the
+    desktop socket `path`?
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if uid == 0 or uid == st.st_uid:
+        return True
+    try:
+        groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        groups = [gid]
+    return st.st_gid in groups and bool(st.st_mode & stat.S_IRGRP)
+
+class ThumbnailService:
+    r"""
+    The thumbnails somebody's subscribed to, and who wants them how often.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = dict()     # connection -> {name: fps}
+        self.thumbnails = dict()        # name -> _PublishedThumbnail
+
+    def subscribe(self, conn, wanted):
+        with self.lock:
+            if wanted is None:
+                self.subscriptions.pop(conn, None)
+            else:
+                self.subscriptions[conn] = wanted
+            rates = dict()
+            for subscription in self.subscriptions.values():
+                for (name, fps) in subscription.items():
+                    rates[name] = max(rates.get(name, 0), fps)
+            for name in list(self.thumbnails):
+                if name not in rates:
+                    threading.Thread(target=self.thumbnails.pop(name).close, daemon=True).start()
+            for (name, fps) in rates.items():
+                if name not in self.thumbnails:
+                    self.thumbnails[name] = _PublishedThumbnail(name)
+                    self.thumbnails[name].start()
+                self.thumbnails[name].pace(fps)
+
+    def serve_connection(self, conn):
+        try:
+            (pid, uid, gid) = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                                  struct.calcsize('3i')))
+            while True:
+                message = conn.recv(65536)
+                if not message:
+                    break
+                try:
+                    wanted = dict()
+                    for (name, fps) in json.loads(message)['subscribe'].items():
+                        path = os.path.join(RUN_DIR, os.path.basename(name))
+                        if name == os.path.basename(name) and not name.startswith('.') and _may_read(uid, gid, path):
+                            wanted[name] = float(fps)
+                except (ValueError, KeyError, TypeError, AttributeError) as ex:
+                    error('thumbnail service: bad request from pid {} (uid {}): {!r}'.format(pid, uid, ex))
+                    continue
+                self.subscribe(conn, wanted)
+        except OSError:
+            pass
+        finally:
+            self.subscribe(conn, None)
+            conn.close()
+
+def serve(path=THUMBNAIL_SOCKET, watch_parent=False):
+    r"""
+    Serve thumbnails until killed (or, with `watch_parent`, until the
+    process that started us exits).
+    """
+    parent = os.getppid()
+    os.makedirs(THUMBNAIL_DIR, mode=0o755, exist_ok=True)
+    for name in os.listdir(THUMBNAIL_DIR):
+        os.unlink(os.path.join(THUMBNAIL_DIR, name))
+
+    service = ThumbnailService()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.bind(path)
+    # the thumbnails' own permissions are the access check
+    os.chmod(path, 0o666)
+    sock.listen(64)
+    sock.settimeout(1)
+    try:
+        while not watch_parent or os.getppid() == parent:
+            try:
+                (conn, _) = sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            threading.Thread(target=service.serve_connection, args=(conn,), daemon=True).start()
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def start_thumbnail_service(path=THUMBNAIL_SOCKET):
+    r"""
+    Fork a thumbnail service that exits along with the calling process,
+    if we're root and VNC_THUMBNAILS isn't 0.  Returns its pid, or None.
+    """
+    if os.geteuid() != 0 or not THUMBNAILS:
+        return None
+    return start_service('thumbnail service', serve, path)
+
+def thumbnail_service(*args):
+    r"""
+    Run the thumbnail service in the foreground
+    (`vnc_collaborate thumbnail-service`).
+    """
+    if os.geteuid() != 0:
+        error('thumbnail-service must run as root')
+        return 1
+    serve()
+
+#
+# Reading thumbnails
+#
+
+def _open(name):
+    r"""
+    Map desktop `name`'s thumbnail: returns the mapping and the file's
+    inode, or None if there isn't one.
+    """
+    try:
+        with open(os.path.join(THUMBNAIL_DIR, name), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            ino = os.fstat(f.fileno()).st_ino
+    except (OSError, ValueError):
+        return None
+    if mm[:4] != MAGIC:
+        mm.close()
+        return None
+    return (mm, ino)
+
+def _replaced(name, ino):
+    r"""
+    Has desktop `name`'s thumbnail file (with inode `ino`) been removed
+    or replaced, say by a restarted service?
+    """
+    try:
+        return os.stat(os.path.join(THUMBNAIL_DIR, name)).st_ino != ino
+    except FileNotFoundError:
+        return True
+
+def _read(mm):
+    r"""
+    Read a consistent copy of the thumbnail mapped at `mm`: returns its
+    sequence number, size (columns, rows), desktop size and RGB pixels,
+    or None if it's stale.
+    """
+    while True:
+        (magic, stale, seq, cols, rows, width, height) = HEADER.unpack(mm[:HEADER.size])
+        if stale:
+            return None
+        if seq % 2:
+            time.sleep(0.001)
+            continue
+        pixels = mm[HEADER_SIZE:HEADER_SIZE + rows * cols * 3]
+        if HEADER.unpack(mm[:HEADER.size])[2] == seq:
+            return (seq, (cols, rows), (width, height), pixels)
+
+class SharedThumbnail(threading.Thread):
+    r"""
+    A Thumbnail that comes from the thumbnail service, rescaled to fit in
+    `width` x `height`.
+    """
+
+    def __init__(self, path, width, height):
+        super().__init__(daemon=True)
+        self.path = path
+        self.name = os.path.basename(path)
+        self.lock = threading.Lock()
+        self.area = (width, height)
+        self.fps = DEFAULT_FPS
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.image = None
+        self.damage = None
+        # our own Thumbnail of the desktop, while the service is down
+        self.fallback = None
+        self.sock = None
+        self._connect()
+
+    def _connect(self):
+        r"""
+        Connect to the thumbnail service, and subscribe to our desktop.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(THUMBNAIL_SOCKET)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self._subscribe()
+
+    def _subscribe(self):
+        try:
+            self.sock.send(json.dumps({'subscribe': {self.name: self.fps}}).encode())
+        except OSError as ex:
+            error('thumbnail:', self.name, ex)
+
+    def _hung_up(self):
+        r"""
+        Has the service closed our connection (because it exited)?  It
+        never sends us anything, so anything to read means it has.
+        """
+        poll = select.poll()
+        try:
+            poll.register(self.sock, select.POLLIN)
+        except ValueError:
+            # close() closed it, and we're on our way out
+            return False
+        return bool(poll.poll(0))
+
+    def fit(self, width, height):
+        with self.lock:
+            if self.area != (width, height):
+                self.area = (width, height)
+                self.wakeup.set()
+            fallback = self.fallback
+        if fallback:
+            fallback.fit(width, height)
+
+    def pace(self, fps):
+        if fps != self.fps:
+            self.fps = fps
+            with self.lock:
+                fallback = self.fallback
+            if fallback:
+                fallback.pace(fps)
+            else:
+                self._subscribe()
+            self.wakeup.set()
+
+    def take(self):
+        with self.lock:
+            fallback = self.fallback
+        if fallback:
+            return fallback.take()
+        return Thumbnail.take(self)
+
+    def _rescale(self, size, pixels):
+        import numpy
+        (cols, rows) = size
+        pixels = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(rows, cols, 3)
+        (tcols, trows) = _fit(cols, rows, self.area)
+        if (tcols, trows) == (cols, rows):
+            image = pixels
+        else:
+            image = _downscale(pixels, _bins(rows, trows), _bins(cols, tcols)).astype(numpy.uint8)
+        with self.lock:
+            self.image = image
+            self.damage = (0, 0, trows, tcols)
+
+    def _fall_back(self):
+        r"""
+        The service went away: read the desktop ourselves until it's back.
+        """
+        error('thumbnail: lost the thumbnail service; reading', self.name, 'directly')
+        self.sock.close()
+        fallback = Thumbnail(self.path, *self.area)
+        fallback.pace(self.fps)
+        fallback.start()
+        with self.lock:
+            self.fallback = fallback
+
+    def _reconnect(self):
+        r"""
+        Try to get back to the service.  Returns True if we did.
+        """
+        try:
+            self._connect()
+        except OSError:
+            return False
+        with self.lock:
+            (fallback, self.fallback) = (self.fallback, None)
+        fallback.close()
+        return True
+
+    def run(self):
+        mm = None
+        ino = None
+        last = None
+        while not self.closed:
+            if self.fallback is None and self._hung_up():
+                self._fall_back()
+                if mm:
+                    mm.close()
+                    mm = None
+            if self.fallback is not None:
+                if not self._reconnect():
+                    self.wakeup.wait(RECONNECT_INTERVAL)
+                    self.wakeup.clear()
+                    continue
+                last = None
+            if mm is not None and _replaced(self.name, ino):
+                mm.close()
+                mm = None
+            if mm is None:
+                (mm, ino) = _open(self.name) or (None, None)
+            if mm:
+                thumbnail = _read(mm)
+                if thumbnail is None:
+                    mm.close()
+                    mm = None
+                    last = None
+                    continue
+                (seq, size, desktop_size, pixels) = thumbnail
+                if seq > 0 and (seq, self.area) != last:
+                    last = (seq, self.area)
+                    self._rescale(size, pixels)
+            self.wakeup.wait(1/self.fps if self.fps > 0 else RECONNECT_INTERVAL)
+            self.wakeup.clear()
+        if mm:
+            mm.close()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.sock.close()
+        with self.lock:
+            fallback = self.fallback
+        if fallback:
+            fallback.close()
+
+def thumbnail_memory(desktop_width, desktop_height, width, height):
+    r"""
+    Roughly how many bytes open_thumbnail(path, width, height) of a
+    `desktop_width` x `desktop_height` desktop will hold in our process,
+    counting the Tk image that shows it: just the thumbnail, if it's read
+    from the thumbnail service, or the whole desktop too, if it's our own.
+    """
+    (cols, rows) = _fit(desktop_width, desktop_height, (width, height))
+    memory = cols * rows * (3 + 4)
+    if not os.path.exists(THUMBNAIL_SOCKET):
+        memory += desktop_width * desktop_height * 4
+    return memory
+
+def open_thumbnail(path, width, height):
+    r"""
+    A thumbnail of the desktop listening on `path`, that fits in `width`
+    x `height`: from the thumbnail service if it's running, or our own.
+    """
+    if os.path.exists(THUMBNAIL_SOCKET):
+        try:
+            return SharedThumbnail(path, width, height)
+        except OSError as ex:
+            error('thumbnail service:', ex)
+    return Thumbnail(path, width, height)
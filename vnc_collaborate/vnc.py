@@ -1,59 +1,184 @@
 #
-# Use the "twisted" RFB protocol implementation in the vncdotool
-# package to query a VNC desktop for its name and geometry.
+# Query VNC desktops for their name and geometry.
 #
-# The whole twisted package is a bit... twisted.  It's a
-# single-threaded implementation and its main event loop can't be
-# called twice, so we run in a different subprocess every time
-# we call get_VNC_info().
-
-from vncdotool import rfb
-from twisted.internet import reactor, protocol
-from twisted.application import internet
-import concurrent.futures
-
-VNC_data = None
-
-class RFBDataClient(rfb.RFBClient):
-    def vncConnectionMade(self):
-        if type(self.transport.addr) == bytes:
-            key = self.transport.addr.decode()   # UNIX socket case; decode() to use string, not bytes, as key
-        else:
-            key = self.transport.addr[1]         # TCP socket case
+# All we want from a desktop is its ServerInit message (width, height
+# and name), which is the first thing it sends a client after the
+# handshake: a few hundred bytes.  This used to be done with the
+# "twisted" RFB implementation in vncdotool, in a brand-new
+# ProcessPoolExecutor per query (twisted's reactor can't be run twice
+# in a process), so the teacher's grid forked a process per desktop,
+# and the executors were never shut down.
+#
+# Now a query is a coroutine, probe_VNC_info(), that speaks the
+# handshake over a plain socket, with a timeout; probe_VNC_infos()
+# queries any number of desktops at once.  get_VNC_info() and
+# get_VNC_infos() are the same for callers that aren't asyncio: they
+# run on one event loop, in a background thread, and get_VNC_info()
+# can return a concurrent.futures.Future instead of waiting.
+#
+# A desktop's geometry only changes when somebody resizes it, so the
+# answers for UNIX sockets are cached, keyed on the socket's inode and
+# mtime: a new desktop on the same path is a new inode, and
+# invalidate_VNC_info() touches the socket, which set_geometry does
+# after resizing a desktop, and the thumbnails (thumbnails.py) do when
+# they see a desktop change size (the DesktopSize pseudo-encoding).
+# Since the mtime is in the socket's inode, this works across
+# processes.
+
+import os
+import time
+import struct
+import asyncio
+import threading
+
+PROBE_TIMEOUT = 5
 
-        global VNC_data
-        VNC_data = {
-            'name': self.name,
-            'width': self.width,
-            'height': self.height
-        }
-        reactor.stop()
+SECURITY_NONE = 1
 
-class RFBFactory(protocol.ClientFactory):
-    """A factory for remote frame buffer connections."""
+# UNIX socket path -> ((st_dev, st_ino, st_mtime_ns), info)
 
-    protocol = RFBDataClient
+_cache = dict()
 
-    # shared = 1 because we don't want to kick out
-    # our users just to query their desktops
+def _cache_key(port):
+    if isinstance(port, int):
+        return None
+    try:
+        st = os.stat(port)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
 
-    def __init__(self, password = None, shared = 1):
-        self.password = password
-        self.shared = shared
+def cached_VNC_info(port):
+    r"""
+    The cached answer for the desktop at `port` (a TCP port on
+    localhost, or a UNIX socket), or None if there isn't a current one.
+    """
+    key = _cache_key(port)
+    if key is not None and port in _cache and _cache[port][0] == key:
+        return _cache[port][1]
+    return None
 
-def get_VNC_info_subprocess(port):
-    if type(port) == int:
-        vncClient = internet.TCPClient('localhost', port, RFBFactory())
+def invalidate_VNC_info(path):
+    r"""
+    Forget what we know about the desktop listening on `path`, here and
+    in every other process, because its geometry changed.
+    """
+    _cache.pop(path, None)
+    # filesystem timestamps are coarse, so make sure the mtime changes
+    try:
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, max(time.time_ns(), st.st_mtime_ns + 1)))
+    except OSError:
+        pass
+
+async def _handshake(reader, writer):
+    async def reason():
+        (length,) = struct.unpack('>I', await reader.readexactly(4))
+        return (await reader.readexactly(length)).decode(errors='replace')
+
+    version = await reader.readexactly(12)
+    if not version.startswith(b'RFB '):
+        raise ConnectionError('not an RFB server')
+    if version < b'RFB 003.007\n':
+        writer.write(b'RFB 003.003\n')
+        (security,) = struct.unpack('>I', await reader.readexactly(4))
+        if security == 0:
+            raise ConnectionError(await reason())
     else:
-        vncClient = internet.UNIXClient(port, RFBFactory())
-    vncClient.startService()
-    reactor.run()
-    return VNC_data
-
-def get_VNC_info(port, return_future=False):
-    executor = concurrent.futures.ProcessPoolExecutor()
-    future = executor.submit(get_VNC_info_subprocess, port)
+        writer.write(b'RFB 003.008\n')
+        (count,) = struct.unpack('>B', await reader.readexactly(1))
+        if count == 0:
+            raise ConnectionError(await reason())
+        security = SECURITY_NONE if SECURITY_NONE in await reader.readexactly(count) else None
+        if security is None:
+            raise ConnectionError('authentication required')
+        writer.write(struct.pack('>B', security))
+    if security != SECURITY_NONE:
+        raise ConnectionError('authentication required')
+    if version >= b'RFB 003.008\n':
+        (result,) = struct.unpack('>I', await reader.readexactly(4))
+        if result != 0:
+            raise ConnectionError(await reason())
+
+    # shared, because we don't want to kick out our users just to
+    # query their desktops
+    writer.write(b'\x01')
+    (width, height) = struct.unpack('>HH16x', await reader.readexactly(20))
+    name = await reason()
+    return {'name': name, 'width': width, 'height': height}
+
+async def probe_VNC_info(port, timeout=PROBE_TIMEOUT):
+    r"""
+    Returns the name, width and height (in a dictionary) of the desktop
+    at `port`: a TCP port on localhost, or a UNIX socket.  Raises
+    OSError (ConnectionError, or TimeoutError after `timeout` seconds)
+    if it can't.
+    """
+    info = cached_VNC_info(port)
+    if info is not None:
+        return info
+    # before the probe, so that a resize during it invalidates the answer
+    key = _cache_key(port)
+
+    async def probe():
+        if isinstance(port, int):
+            (reader, writer) = await asyncio.open_connection('localhost', port)
+        else:
+            (reader, writer) = await asyncio.open_unix_connection(port)
+        try:
+            return await _handshake(reader, writer)
+        finally:
+            writer.close()
+
+    try:
+        info = await asyncio.wait_for(probe(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError('no answer from {}'.format(port))
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('{} hung up'.format(port))
+    if key is not None:
+        _cache[port] = (key, info)
+    return info
+
+async def probe_VNC_infos(ports, timeout=PROBE_TIMEOUT):
+    r"""
+    Query all of the desktops in `ports` at once.  Returns a dictionary
+    mapping each one to its info, or to None if it didn't answer.
+    """
+    results = await asyncio.gather(*(probe_VNC_info(port, timeout) for port in ports),
+                                   return_exceptions=True)
+    return {port: (None if isinstance(result, Exception) else result)
+            for (port, result) in zip(ports, results)}
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _run(coroutine):
+    r"""
+    Run `coroutine` on our background event loop, returning a
+    concurrent.futures.Future for its result.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop)
+
+def get_VNC_info(port, return_future=False, timeout=PROBE_TIMEOUT):
+    r"""
+    probe_VNC_info(), for callers that aren't asyncio: waits for the
+    answer, or (with `return_future`) returns a concurrent.futures.Future
+    for it.
+    """
+    future = _run(probe_VNC_info(port, timeout))
     if return_future:
         return future
     else:
         return future.result()
+
+def get_VNC_infos(ports, timeout=PROBE_TIMEOUT):
+    r"""
+    probe_VNC_infos(), for callers that aren't asyncio.
+    """
+    return _run(probe_VNC_infos(list(ports), timeout)).result()
@@ -0,0 +1,184 @@
+#
+# A warm pool of pre-started desktops.
+#
+# A cold spawn (machinectl shell -> tigervncserver.pl -> Xtigervnc ->
+# the desktop session) takes most of start_VNC_server's 25 second
+# timeout.  The pool keeps VNC_POOL_SIZE desktops already started and
+# listening under /run/vnc/.pool, and ensure_vnc_server adopts one
+# when it would otherwise cold-spawn: the pooled socket is re-homed to
+# the requested /run/vnc path, which takes a couple of system calls.
+#
+# A desktop runs as a UNIX user, and re-homing it can't change that,
+# so pooled desktops are only adopted for desktops that would run as
+# the pool's user anyway: VNC_POOL_USER, by default 'default', the
+# account behind the per-meeting shared desktops /run/vnc/<meetingID>
+# (and whatever fullName mapping sends participants to a shared
+# account).  Handing someone a desktop that runs as another account
+# would give them that account's home directory.  Desktops for
+# participants with their own UNIX accounts are pre-started by name
+# instead; see prewarm.py.
+#
+# The pool is refilled in the background by run_warm_pool(), which
+# websockify() starts when VNC_POOL_SIZE is set.  Refills are limited
+# to VNC_POOL_SPAWN_RATE spawns a minute, so that refilling after a
+# burst of adoptions doesn't itself become a spawn storm.
+#
+# Pooled sockets are named <user>.<ro|rw>.<n>: view-only and
+# interactive desktops aren't interchangeable (the shared desktops
+# are view-only, see new_websocket_client).  They live in a dot
+# directory, so the teacher grid (which globs /run/vnc/*) never shows
+# them.
+
+import os
+import glob
+import time
+import socket
+import threading
+
+from .services import error, start_service
+from .spawn_queue import spawn_slot, PRIORITY_POOL
+
+POOL_DIR = '/run/vnc/.pool'
+
+POOL_SIZE = int(os.environ.get('VNC_POOL_SIZE', '0'))
+POOL_USER = os.environ.get('VNC_POOL_USER', 'default')
+POOL_VIEWONLY = os.environ.get('VNC_POOL_VIEWONLY', 'yes' if POOL_USER == 'default' else 'no') == 'yes'
+POOL_SPAWN_RATE = float(os.environ.get('VNC_POOL_SPAWN_RATE', '6'))
+
+# How long a refill may wait in the spawn queue, and then spawn
+
+POOL_SPAWN_TIMEOUT = 600
+
+def _slot_prefix(UNIXuser, viewOnly):
+    return os.path.join(POOL_DIR, '{}.{}.'.format(UNIXuser, 'ro' if viewOnly else 'rw'))
+
+def is_listening(path):
+    r"""
+    Is a VNC server accepting connections on the UNIX socket `path`?
+    (A pooled desktop whose server died leaves its socket file behind,
+    and so does an adopted one, at the path it was adopted to.)
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # a server that's too busy to accept (its backlog is full) is listening
+    sock.setblocking(False)
+    try:
+        sock.connect(path)
+        return True
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def adopt_pooled_desktop(UNIXuser, rfbpath, viewOnly=False):
+    r"""
+    Re-home a ready pooled desktop for `UNIXuser` to `rfbpath`.  Returns
+    True if one was adopted, False if the pool had none.
+
+    Adoption first renames the pooled socket to a name private to this
+    caller -- only one of several concurrent adopters can win that rename --
+    then links it into place, which (unlike rename) fails rather than
+    replacing an rfbpath that appeared in the meantime.
+
+    The server only knows the name it bound, so when it exits, the link
+    at `rfbpath` stays behind; ensure_vnc_server removes it (see
+    is_listening) before it spawns a new desktop there.
+    """
+    for slot in sorted(glob.glob(_slot_prefix(UNIXuser, viewOnly) + '*')):
+        if '.claimed.' in slot:
+            continue
+        claimed = '{}.claimed.{}.{}'.format(slot, os.getpid(), threading.get_ident())
+        try:
+            os.rename(slot, claimed)
+        except FileNotFoundError:
+            continue        # somebody else adopted it first
+        if not is_listening(claimed):
+            os.unlink(claimed)
+            continue
+        try:
+            os.link(claimed, rfbpath)
+        except FileExistsError:
+            os.rename(claimed, slot)
+            return True
+        os.unlink(claimed)
+        return True
+    return False
+
+def _spawn_pooled_desktop(path, UNIXuser, viewOnly):
+    from .websockify import start_VNC_server
+    try:
+        # Refills wait behind every other spawn (see spawn_queue.py)
+        with spawn_slot(UNIXuser, PRIORITY_POOL, time.monotonic() + POOL_SPAWN_TIMEOUT):
+            start_VNC_server(UNIXuser, path, viewOnly=viewOnly)
+    except RuntimeError as ex:
+        error('warm pool spawn failed:', ex)
+
+def run_warm_pool(size=POOL_SIZE, UNIXuser=POOL_USER, viewOnly=POOL_VIEWONLY,
+                  spawn_rate=POOL_SPAWN_RATE, watch_parent=False):
+    r"""
+    Keep `size` desktops for `UNIXuser` started in the pool, starting at
+    most `spawn_rate` of them a minute.  Runs until killed (or, with
+    `watch_parent`, until the process that started us exits).
+    """
+    parent = os.getppid()
+    os.makedirs(POOL_DIR, mode=0o755, exist_ok=True)
+    prefix = _slot_prefix(UNIXuser, viewOnly)
+
+    # Token bucket: up to a minute's worth of spawns can go at once, so a
+    # freshly started pool fills quickly, and then `spawn_rate` a minute.
+    tokens = max(1.0, spawn_rate)
+    last = time.monotonic()
+    spawning = dict()
+    serial = 0
+
+    while not watch_parent or os.getppid() == parent:
+        now = time.monotonic()
+        tokens = min(max(1.0, spawn_rate), tokens + (now - last) * spawn_rate / 60)
+        last = now
+
+        for path, thread in list(spawning.items()):
+            if not thread.is_alive():
+                spawning.pop(path)
+
+        ready = []
+        for p in glob.glob(prefix + '*'):
+            if '.claimed.' in p or p in spawning:
+                continue
+            if is_listening(p):
+                ready.append(p)
+            else:
+                os.unlink(p)
+
+        while len(ready) + len(spawning) < size and tokens >= 1:
+            tokens -= 1
+            serial += 1
+            path = '{}{}-{}'.format(prefix, int(time.time()), serial)
+            thread = threading.Thread(target=_spawn_pooled_desktop, args=(path, UNIXuser, viewOnly), daemon=True)
+            thread.start()
+            spawning[path] = thread
+
+        time.sleep(1)
+
+def start_warm_pool():
+    r"""
+    Fork a process running run_warm_pool(), if VNC_POOL_SIZE asks for a
+    pool, that exits along with the calling process.  Returns its pid, or
+    None.
+    """
+    if POOL_SIZE <= 0:
+        return None
+    return start_service('warm pool', run_warm_pool)
+
+def warm_pool(*args):
+    r"""
+    warm_pool [SIZE [USER]]
+
+    Run the pool refiller in the foreground.
+    """
+    size = int(args[0]) if len(args) > 0 else POOL_SIZE
+    UNIXuser = args[1] if len(args) > 1 else POOL_USER
+    try:
+        run_warm_pool(size, UNIXuser)
+    except KeyboardInterrupt:
+        pass
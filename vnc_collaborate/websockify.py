@@ -32,7 +32,6 @@
 
 import sys
 import os
-import re
 import psutil
 import glob
 import fcntl
@@ -40,10 +39,10 @@ import urllib
 import subprocess
 import time
 import random
-import tempfile
+import socket
+import threading
 import pwd
 import grp
-import requests
 
 # Per-user startup lock. Closes the race in which two simultaneous
 # websocket connects both pass the `not os.path.exists(rfbpath)` check
@@ -62,19 +61,58 @@ import requests
 # each child gets its own independent copy.  fcntl.flock works
 # because the kernel tracks flock ownership per inode, so separate
 # open()s in separate processes serialize correctly.
-def _acquire_spawn_lock(UNIXuser):
+#
+# The lock is polled rather than waited for, so that a caller gives up
+# at its deadline like everywhere else in ensure_vnc_server.  And since
+# whoever holds it may be waiting in the spawn queue at a lower priority
+# than ours (a prewarm, say), we ask it to wait at ours (see boost() in
+# spawn_queue.py) until we have the lock or give up.
+
+SPAWN_LOCK_POLL = 0.1
+
+def _acquire_spawn_lock(UNIXuser, deadline, priority):
     lockpath = '/run/vnc/.' + UNIXuser + '.spawnlock'
     fd = os.open(lockpath, os.O_CREAT | os.O_WRONLY, 0o660)
-    fcntl.flock(fd, fcntl.LOCK_EX)
-    return fd
+    boosted = False
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                pass
+            if not boosted:
+                boost(UNIXuser, priority, deadline)
+                boosted = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                os.close(fd)
+                raise SpawnQueueTimeout('Your desktop is still starting; please reconnect in a minute.')
+            time.sleep(min(SPAWN_LOCK_POLL, remaining))
+    finally:
+        if boosted:
+            unboost(UNIXuser)
 
 def _release_spawn_lock(fd):
     fcntl.flock(fd, fcntl.LOCK_UN)
     os.close(fd)
 
-import bigbluebutton
+import bigbluebutton_roster
 
 from .users import fullName_to_UNIX_username, fullName_to_rfbport
+from .auth_cache import auth_cache_from_environment
+from .warm_pool import adopt_pooled_desktop, start_warm_pool, is_listening
+from .prewarm import record_arrival, request_spawn, start_prewarm_service
+from .inotify import wait_for_path
+from .displays import reserve_display, release_display, release_display_when_running
+from .provision import provision_users, adduser_version
+from .freezer import thaw_desktop, start_freezer
+from .budgets import budget_new_desktop, start_budget_keeper
+from .thumbnails import start_thumbnail_service
+from .privileged import make_run_dir, share_socket, start_desktop, start_session, start_helper_service
+from .rfb_reject import reject_socket
+from .metrics import ConnectionMetrics, CountingSocket, start_metrics_service
+from .spawn_queue import acquire_slot, release_slot, boost, unboost, SpawnQueueTimeout, PRIORITY_TEACHER, PRIORITY_STUDENT
 
 try:
     import importlib.resources as pkg_resources
@@ -103,17 +141,9 @@ def get_or_add_user(UNIXuser):
     try:
         passwd_struct = pwd.getpwnam(UNIXuser)
     except KeyError:
+        # Classes are normally provisioned ahead of time (see provision.py)
         print(f'User {UNIXuser} does not exist; creating them')
-        # There's was race condition in the system adduser script, so protect this code with a semaphore
-        # We don't need it (and might not have posix_ipc installed) if adduser is new enough
-        proc = subprocess.run(['adduser', '--version'], stdout=subprocess.PIPE)
-        adduser_version = float(re.search('[0-9.]+', [l for l in proc.stdout.decode().split('\n') if 'adduser version' in l][0])[0])
-        if adduser_version < 3.137:
-            import posix_ipc
-            with posix_ipc.Semaphore('/etc.passwd', posix_ipc.O_CREAT, initial_value=1):
-                subprocess.run(['sudo', 'adduser', '--force-badname', '--disabled-password', '--gecos', '', UNIXuser])
-        else:
-            subprocess.run(['sudo', 'adduser', '--force-badname', '--disabled-password', '--gecos', '', UNIXuser])
+        provision_users([UNIXuser])
         passwd_struct = pwd.getpwnam(UNIXuser)
     return passwd_struct
 
@@ -123,21 +153,23 @@ def start_VNC_server(UNIXuser, rfbpath, viewOnly=False, timeout=25):
     connections on `rfbpath`, optionally in `viewOnly` mode, where no
     keyboard or mouse input will be accepted.
 
-    This is ONE bounded spawn attempt.  It waits up to `timeout` seconds
-    for the socket to appear, watching the spawned server so it fails fast
-    if the server dies (e.g. a display-number collision, where two
-    simultaneous spawns pick the same X display and the loser exits with
-    "Server is already active for display N").  On success
-    it adjusts the socket's group/mode and returns; on failure it raises
+    This is ONE bounded spawn attempt.  The server's X display number is
+    reserved host-wide beforehand (see displays.py), so simultaneous spawns
+    no longer collide on it.  It waits up to `timeout` seconds for the
+    socket to appear, watching the spawned server so it fails fast if the
+    server dies (say, the user has no home directory).  On success
+    it adjusts the socket's group/mode, gives the desktop its resource
+    budget (see budgets.py) and returns; on failure it raises
     RuntimeError rather than blocking forever.  Callers that want the
     serialized + retried behaviour should go through `ensure_vnc_server`.
     """
 
     tigervnc_version = 10
 
-    subprocess.run(['sudo', 'mkdir', '-p', '-m', '01777', '/run/vnc'])
+    make_run_dir()
 
     proc = None
+    display = None
 
     if os.path.exists('/usr/bin/tigervncserver'):
 
@@ -160,33 +192,24 @@ def start_VNC_server(UNIXuser, rfbpath, viewOnly=False, timeout=25):
             # that waits for the server to be listening on a TCP port even
             # if you requested a UNIX domain socket via "-rfbunixpath"
 
-            # GPT-4o suggested machinectl shell as a way to get gnome-session
-            # to start properly (i.e, to start at all).
-            # I had done it with sudo on Ubuntu 18, but had problems with sudo
-            # on Ubuntu 20; gnome-shell kept failing with "Unset XDG_SESSION_ID".
+            # The display number is reserved up front (see displays.py), so
+            # simultaneous spawns can't both pick the same one.
 
-            args = ['sudo', 'machinectl', 'shell', UNIXuser+'@.host',
-                    '/usr/bin/python3', '-m', 'vnc_collaborate', 'tigervncserver',
-                    '-localhost', 'yes',
-                    '-SendPrimary=0', '-SetPrimary=0',
-                    '-rfbunixpath', rfbpath,
-                    '-SecurityTypes', 'None',
-                    '-BlacklistThreshold', '1000000',
-                    '-fg',
-            ]
-
-            if (viewOnly):
-                args.extend(['-AcceptPointerEvents=0', '-AcceptKeyEvents=0'])
+            display = reserve_display()
 
             # runs it and waits for it to return
             # subprocess.run(args, start_new_session=True, env=env)
 
             # runs it and never waits to join it when it's done; it becomes a zombie (probably not the best design)
-            # It isn't going to exit until the X server exits, because of the -fg switch above.
+            # It isn't going to exit until the X server exits, because of its -fg switch (see _start_desktop in privileged.py).
             # We keep the handle so the wait loop below can tell "still starting"
             # from "died" (the machinectl shell stays in the foreground while the
             # server runs, and exits with the server's status when it dies).
-            proc = subprocess.Popen(args, start_new_session=True)
+            try:
+                proc = start_desktop(UNIXuser, display, rfbpath, viewOnly)
+            except (OSError, RuntimeError):
+                release_display(display)
+                raise
 
     else:
 
@@ -214,8 +237,9 @@ def start_VNC_server(UNIXuser, rfbpath, viewOnly=False, timeout=25):
                               'UNIX-LISTEN:{},fork,user={},group={},mode=775'.format(rfbpath, UNIXuser, 'bigbluebutton'),
                               'TCP4:localhost:'+str(rfbport)],
                              start_new_session=True)
-            while not os.path.exists(rfbpath):
-                time.sleep(0.1)
+            if not wait_for_path(rfbpath, timeout):
+                raise RuntimeError(
+                    "socat for {} did not appear within {}s".format(UNIXuser, timeout))
     else:
         # Xvnc allows us to set the mode of its UNIX domain socket, but not its group,
         # so we need to wait for it to appear and adjust things accordingly
@@ -228,21 +252,43 @@ def start_VNC_server(UNIXuser, rfbpath, viewOnly=False, timeout=25):
         # spinning forever (which, while we hold the per-user spawn lock in
         # ensure_vnc_server, used to wedge that user permanently -- the
         # spawn-lock deadlock this whole bounded-wait change fixes).
-        deadline = time.monotonic() + timeout
-        while not os.path.exists(rfbpath):
-            if proc is not None and proc.poll() is not None:
-                raise RuntimeError(
-                    "VNC server for {} exited (rc={}) before creating {}".format(
-                        UNIXuser, proc.returncode, rfbpath))
-            if time.monotonic() > deadline:
+        # wait_for_path sleeps on inotify and the server's pidfd, so we
+        # wake up as soon as the socket appears or the server dies.
+        try:
+            if not wait_for_path(rfbpath, timeout, proc):
+                if proc is not None and proc.poll() is not None:
+                    raise RuntimeError(
+                        "VNC server for {} exited (rc={}) before creating {}".format(
+                            UNIXuser, proc.returncode, rfbpath))
                 raise RuntimeError(
                     "VNC server for {} did not appear within {}s".format(UNIXuser, timeout))
-            time.sleep(0.1)
-        subprocess.run(['sudo', 'chgrp', 'bigbluebutton', rfbpath])
-        subprocess.run(['sudo', 'chmod', 'g+rw', rfbpath])
+        finally:
+            # Once the server is listening, its X lock file holds the display
+            if display is not None:
+                release_display(display)
+        share_socket(rfbpath)
+        budget_new_desktop(UNIXuser)
 
 
-def ensure_vnc_server(UNIXuser, rfbpath, viewOnly=False, max_attempts=5, total_timeout=40, jitter=True):
+def _desktop_running(rfbpath):
+    r"""
+    Is a desktop listening on `rfbpath`?  A socket file that nobody is
+    listening on is removed: a desktop adopted from the warm pool leaves
+    one when it exits (see adopt_pooled_desktop), and so does one that
+    crashed.
+    """
+    if not os.path.exists(rfbpath):
+        return False
+    if is_listening(rfbpath):
+        return True
+    try:
+        os.unlink(rfbpath)
+    except FileNotFoundError:
+        pass
+    return False
+
+def ensure_vnc_server(UNIXuser, rfbpath, viewOnly=False, max_attempts=5, total_timeout=40, jitter=True,
+                      metrics=None, priority=PRIORITY_STUDENT):
     r"""
     Make sure a persistent VNC server is listening on `rfbpath`, serializing
     against concurrent callers and retrying a failed spawn.
@@ -259,32 +305,74 @@ def ensure_vnc_server(UNIXuser, rfbpath, viewOnly=False, max_attempts=5, total_t
     /run/vnc/<meetingID>, so each meeting gets its own lock and meetings don't
     serialize against (or stall) each other.
 
-    Retry-with-jitter recovers a display-number collision *in place*: when
-    simultaneous class-start spawns pick the same `:N`, the loser dies, but by
-    the time we retry the winner holds the display lock, so the retry is
-    effectively a lone spawn and cleanly skips to the next free display.
-    Randomized backoff de-synchronizes a batch of losers so they spread out
-    instead of re-colliding on the next display.  The whole thing is bounded
+    Retry-with-jitter recovers a failed spawn *in place*.  It was written for
+    display-number collisions between simultaneous class-start spawns, which
+    the display allocator (displays.py) now prevents, so retries are rare;
+    they still cover a spawn that dies for some other reason, like a display
+    taken by an X server that didn't come from us.  Randomized backoff
+    de-synchronizes a batch of failed spawns.  The whole thing is bounded
     by `total_timeout` (kept under noVNC's ~50 s connect timeout, so the heal
     lands on the live connection without needing a client page reload), and
     the lock is ALWAYS released -- a failed spawn can no longer wedge the user
     forever (the spawn-lock deadlock).
+
+    Each spawn attempt also waits its turn in the host-wide spawn queue, at
+    `priority` (see spawn_queue.py), which caps how many desktops boot at
+    once.  If the queue is too long, or the time left too short, for the
+    spawn to finish by the deadline, this raises SpawnQueueTimeout right
+    away instead of timing out later.
+    So does waiting for the lock past the deadline; meanwhile, whoever
+    holds it is moved up to our priority in the queue.
+
+    A desktop that's running but frozen (see freezer.py) is thawed first.
+
+    If `metrics` (a ConnectionMetrics) is given, the time spent thawing,
+    waiting for the lock and spawning is recorded in it, along with how the desktop was
+    found ('running', 'adopted' from the warm pool, or 'spawned') and the
+    number of spawn attempts.
     """
-    spawn_lock_fd = _acquire_spawn_lock(os.path.basename(rfbpath))
+    if metrics is None:
+        metrics = ConnectionMetrics()
+    # A desktop frozen for being idle (see freezer.py) wouldn't answer
+    with metrics.phase('thaw'):
+        thaw_desktop(rfbpath, UNIXuser=UNIXuser)
+    deadline = time.monotonic() + total_timeout
+    with metrics.phase('spawn_lock'):
+        spawn_lock_fd = _acquire_spawn_lock(os.path.basename(rfbpath), deadline, priority)
+    metrics.label(desktop='running')
     try:
-        deadline = time.monotonic() + total_timeout
         for attempt in range(1, max_attempts + 1):
-            if os.path.exists(rfbpath):
+            if _desktop_running(rfbpath):
                 return
             remaining = deadline - time.monotonic()
             if remaining <= 0:
                 raise RuntimeError(
                     "VNC server for {} not ready within {}s".format(UNIXuser, total_timeout))
+            # A pre-started desktop from the warm pool, if there is one for
+            # this user, comes up in a couple of system calls (see warm_pool.py)
+            if attempt == 1 and adopt_pooled_desktop(UNIXuser, rfbpath, viewOnly=viewOnly):
+                metrics.label(desktop='adopted')
+                return
             try:
-                start_VNC_server(UNIXuser, rfbpath, viewOnly=viewOnly, timeout=remaining)
+                metrics.label(desktop='spawned')
+                with metrics.phase('spawn_queue'):
+                    slot_fd = acquire_slot(UNIXuser, priority, deadline,
+                                           desktop=os.path.basename(rfbpath))
+                metrics.attempts += 1
+                started = time.monotonic()
+                try:
+                    with metrics.phase('spawn'):
+                        start_VNC_server(UNIXuser, rfbpath, viewOnly=viewOnly,
+                                         timeout=max(1, deadline - started))
+                except RuntimeError:
+                    release_slot(slot_fd)
+                    raise
+                release_slot(slot_fd, time.monotonic() - started)
                 return
+            except SpawnQueueTimeout:
+                raise
             except RuntimeError:
-                if os.path.exists(rfbpath):   # a concurrent/previous spawn won the race
+                if _desktop_running(rfbpath):   # a concurrent/previous spawn won the race
                     return
                 if attempt >= max_attempts or time.monotonic() >= deadline:
                     raise
@@ -296,27 +384,136 @@ def ensure_vnc_server(UNIXuser, rfbpath, viewOnly=False, max_attempts=5, total_t
 
 from websockify.websocketproxy import ProxyRequestHandler
 
-old_new_websocket_client = ProxyRequestHandler.new_websocket_client
-
 REJECT_SENTINEL = '/run/vnc-collaborate-reject'
 
+# checkAuthorization is `internal;` in bbb-web.nginx, so it can't be reached
+# via the public serverURL -- we hit bbb-web directly on loopback.
+# 127.0.0.1:8090 is hardcoded ~9x in bbb-web.nginx (LISTEN_PORT is read only
+# by bbb-web.service, not by nginx), so it's a de-facto fixed constant; we
+# match BBB's own convention rather than over-engineer a port lookup.
+BBB_WEB = 'http://127.0.0.1:8090'   # matches bbb-web.nginx's own hardcode
 
-def _reject_with_rfb_reason(self, reason):
-    """Route this connection to the rfb_reject responder so the client gets an
-    RFB security-failure with `reason` (and the plugin shows it) instead of a
-    blank panel.  socat bridges the WebSocket (via websockify's unix_target) to
-    the inetd-style rfb_reject filter, exactly like the real VNC servers."""
-    socket_fn = tempfile.mktemp()
-    env = dict(os.environ, RFB_REJECT_REASON=reason)
-    subprocess.Popen(["socat", "UNIX-LISTEN:" + socket_fn + ",mode=666",
-                      "EXEC:python3 -m vnc_collaborate rfb_reject"], env=env)
-    while not os.path.exists(socket_fn):
-        time.sleep(0.1)
-    self.server.unix_target = socket_fn
-    old_new_websocket_client(self)
+auth_cache = auth_cache_from_environment(BBB_WEB + '/bigbluebutton/connection/checkAuthorization')
 
 
-def new_websocket_client(self):
+def launch_inetd(UNIXuser, session, env, group=None, display=None):
+    r"""
+    Start `session` inetd-style as `UNIXuser` (see start_session), with one
+    end of a socketpair as its stdin and stdout, and return the other
+    end: a connected socket to relay the RFB session on.
+
+    This used to be a socat listening on a tempfile.mktemp() socket with
+    the program on its EXEC: address, because websockify couldn't relay
+    to a pipe.  A socketpair is what socat's EXEC: handed the program
+    anyway, so the program sees no difference, and we save the socat
+    process, the poll for its socket, a copy of every byte, and the
+    stale sockets it left in /tmp.  Starting it as the user used to be a
+    `sudo -u USER -i`; now it's done without sudo (see privileged.py).
+
+    If `session` starts an X server on a `display` we reserved (see
+    displays.py), the reservation is given back once the server is up.
+    """
+    try:
+        sock = start_session(UNIXuser, session, env, group, display)
+    except BaseException:
+        if display is not None:
+            release_display(display)
+        raise
+    if display is not None:
+        release_display_when_running(display)
+    return sock
+
+
+def _proxy_to_socket(self, tsock, metrics):
+    r"""
+    The tail end of websockify's new_websocket_client, for a target
+    socket we already have: relay the websocket to `tsock` until either
+    side closes, counting the bytes into `metrics`.
+    """
+    self.request.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+    self.print_traffic(self.traffic_legend)
+    metrics.setup_done()
+    try:
+        self.do_proxy(CountingSocket(tsock, metrics))
+    finally:
+        try:
+            tsock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        tsock.close()
+
+
+def check_authorization(path, cookie):
+    r"""
+    Authenticate the session token by calling bbb-web's checkAuthorization
+    ourselves (this used to be an nginx `auth_request`, but that can only
+    allow/deny with an HTTP 401 -- opaque to the browser as a bare WS close
+    1006).  By moving the check here, an invalid/expired token can be refused
+    at the RFB layer with a specific reason string that the remote-desktop
+    plugin surfaces on its connection-error overlay.
+
+    checkAuthorization reads the token from X-Original-URI and validates the
+    JSESSIONID-keyed session, so BOTH X-Original-URI (= the websocket's
+    request path, e.g. /vnc?sessionToken=...) and the browser Cookie must be
+    forwarded.  On success it returns User-Id/Meeting-Id response headers +
+    200, else 401.
+
+    Returns a (userID, meetingID) tuple, or None if the token was refused.
+
+    Answers are cached for a few seconds, and the HTTP requests go over a
+    keep-alive session; see auth_cache.py.
+    """
+    return auth_cache.check(path, cookie)
+
+
+# The indexed meeting roster (see bigbluebutton_roster), created on first use
+# in each process.  When the proxy runs a roster service (websockify() starts
+# one for the workers or forked handlers to share), this is a client of it.
+
+roster = None
+
+def lookup_attendee(userID):
+    r"""
+    Return the roster's attendee dict (fullName, role, meeting...) for the
+    attendee `userID`.
+
+    This used to fetch the whole server's getMeetings() and XPath-scan it on
+    every connection.  (getMeetingInfo would be the obvious call here, but it
+    returned 500 Internal Server Error when tried, Aug 26 2022.)
+    """
+    global roster
+    if roster is None:
+        roster = bigbluebutton_roster.shared_roster()
+    attendee = roster.user(userID)
+    if attendee is None:
+        raise LookupError('userID {} is not in any meeting'.format(userID))
+    return attendee
+
+
+def select_target(path, cookie, metrics=None):
+    r"""
+    Decide where a new /vnc websocket connection should be relayed,
+    starting whatever VNC server it needs along the way.
+
+    `path` is the websocket's request path (carrying the sessionToken) and
+    `cookie` the browser's Cookie header.  Returns one of
+
+        ('reject', reason)        refuse at the RFB layer with `reason`
+        ('tcp', host, port)       relay to a TCP port
+        ('unix', socket_path)     relay to a UNIX-domain socket
+        ('inetd', user, session, env, group[, display])
+                                  run `session` as `user` with the connection
+                                  as its stdin and stdout (see launch_inetd)
+
+    This is the part of connection setup that both proxy front ends share:
+    the forking websockify handler below, and the asyncio one in
+    async_websockify.py.  It blocks (HTTP calls, user creation, desktop
+    spawns), so the asyncio front end runs it off its event loop.
+
+    The time each step takes is recorded in `metrics`, a ConnectionMetrics.
+    """
+    if metrics is None:
+        metrics = ConnectionMetrics()
 
     # Reject switch (test/ops): while the sentinel file exists, every /vnc
     # connection is refused at the RFB layer with a security-failure reason (the
@@ -329,93 +526,63 @@ def new_websocket_client(self):
             reason = open(REJECT_SENTINEL).read().strip()
         except OSError:
             reason = ''
-        _reject_with_rfb_reason(self, reason or 'The remote desktop is currently unavailable.')
-        return
-
-    # Authenticate the session token by calling bbb-web's checkAuthorization
-    # ourselves (this used to be an nginx `auth_request`, but that can only
-    # allow/deny with an HTTP 401 -- opaque to the browser as a bare WS close
-    # 1006).  By moving the check here, an invalid/expired token can be refused
-    # at the RFB layer with a specific reason string that the remote-desktop
-    # plugin surfaces on its connection-error overlay.
-    #
-    # checkAuthorization is `internal;` in bbb-web.nginx, so it can't be reached
-    # via the public serverURL -- we hit bbb-web directly on loopback.
-    # 127.0.0.1:8090 is hardcoded ~9x in bbb-web.nginx (LISTEN_PORT is read only
-    # by bbb-web.service, not by nginx), so it's a de-facto fixed constant; we
-    # match BBB's own convention rather than over-engineer a port lookup.
-    #
-    # checkAuthorization reads the token from X-Original-URI and validates the
-    # JSESSIONID-keyed session, so BOTH X-Original-URI (= self.path, e.g.
-    # /vnc?sessionToken=...) and the browser Cookie must be forwarded.  On
-    # success it returns User-Id/Meeting-Id response headers + 200, else 401.
-    BBB_WEB = 'http://127.0.0.1:8090'   # matches bbb-web.nginx's own hardcode
-    resp = requests.get(BBB_WEB + '/bigbluebutton/connection/checkAuthorization',
-                        headers={'X-Original-URI': self.path,
-                                 'Cookie': self.headers.get('Cookie', '')},
-                        allow_redirects=False)
-    if resp.status_code != 200:
-        _reject_with_rfb_reason(
-            self,
-            'Your BigBlueButton token is not valid (it may have expired). '
-            'Please rejoin the meeting')
-        return
-    userID    = resp.headers['User-Id']
-    meetingID = resp.headers['Meeting-Id']
-
-    # something seems to be wrong with this API call - returns 500 Internal Server Error (Aug 26 2022)
-    #meetings = bigbluebutton.getMeetingInfo(meetingID=meetingID)
-    meetings = bigbluebutton.getMeetings()
-    fullName = meetings.xpath('.//userID[text()=$userID]/../fullName', userID=userID)[0].text
+        return ('reject', reason or 'The remote desktop is currently unavailable.')
+
+    with metrics.phase('auth'):
+        auth = check_authorization(path, cookie)
+    if auth is None:
+        return ('reject',
+                'Your BigBlueButton token is not valid (it may have expired). '
+                'Please rejoin the meeting')
+    (userID, meetingID) = auth
+
+    with metrics.phase('roster'):
+        attendee = lookup_attendee(userID)
+    fullName = attendee['fullName']
 
     rfbport = fullName_to_rfbport(fullName)
     UNIXuser = fullName_to_UNIX_username(fullName)
 
     if rfbport:
 
-        self.server.target_host = 'localhost'
-        self.server.target_port = int(rfbport)
+        return ('tcp', 'localhost', int(rfbport))
 
     elif UNIXuser and UNIXuser != "":
 
         # Create a new UNIX user if they don't exist already
-        passwd_struct = get_or_add_user(UNIXuser)
+        with metrics.phase('user'):
+            passwd_struct = get_or_add_user(UNIXuser)
 
         homesocket = passwd_struct.pw_dir + '/.vncsocket'
         homeserver = passwd_struct.pw_dir + '/.vncserver'
         rfbpath = '/run/vnc/' + UNIXuser
 
+        # The environment handed to per-connection programs, on top of their
+        # login environment (see start_session in privileged.py).  A dict of
+        # its own rather than os.environ: the asyncio front end serves many
+        # connections from one process.
+        env = dict(UserId=userID, MeetingId=meetingID,
+                   fullName=fullName, UNIXuser=UNIXuser)
+
         if os.path.exists(homesocket) and (os.stat(homesocket).st_mode & ~0o777 == 0o140000):
             # If .vncsocket is a socket, relay the connection to it
-            self.server.unix_target = homesocket
+            return ('unix', homesocket)
         elif os.path.exists(homeserver) and (os.stat(homeserver).st_mode & 0o111 != 0):
             # If .vncserver is a executable, execute it and relay the connection.
             #
             # Probably should be a "sudo -u nobody" and the script has to be SUID.
-            #
-            # The "socat" is needed because websockify currently can't handle a pipe.
-            # It needs to be modified so that it can operate like "inetd".
-            socket_fn = tempfile.mktemp()
-            env = os.environ
-            env['UserId'] = userID
-            env['MeetingId'] = meetingID
-            env['fullName'] = fullName
-            env['UNIXuser'] = UNIXuser
-            subprocess.Popen(["sudo", "-u", UNIXuser, "-i",
-                              "--preserve-env=UserId", "--preserve-env=MeetingId", "--preserve-env=fullName", "--preserve-env=UNIXuser",
-                              "socat", "UNIX-LISTEN:" + socket_fn + ",mode=666", "EXEC:" + homeserver], env=env);
-            while not os.path.exists(socket_fn):
-                time.sleep(0.1)
-            self.server.unix_target = socket_fn
+            return ('inetd', UNIXuser, 'vncserver', env, None)
         else:
             # default if no .vncserver or .vncsocket exists
-            # ensure_vnc_server serializes the check+spawn+wait per user (so the
-            # two websockets the BBB plugin sends per page load can't double-spawn)
-            # and retries a failed spawn with jitter, bounded in time, always
-            # releasing the lock.  See its docstring for the full rationale.
-            ensure_vnc_server(UNIXuser, rfbpath)
 
-            # Next, select teacher mode if user can access more than one desktop in /run/vnc
+            # Remember when this user showed up, so that the next session of
+            # this meeting can start their desktop before they arrive (prewarm.py)
+            try:
+                record_arrival(attendee, UNIXuser)
+            except Exception as ex:
+                print('recording arrival of', UNIXuser, 'failed:', repr(ex), file=sys.stderr)
+
+            # Select teacher mode if user can access more than one desktop in /run/vnc
             # This way doesn't work right because this script runs as root:
             #    teacher_mode = list(map(lambda fn: os.access(fn, os.W_OK), glob.glob('/run/vnc/*'))).count(True) > 1
             try:
@@ -425,6 +592,21 @@ def new_websocket_client(self):
                 teacher_mode = False
                 bigbluebutton_group_exists = False
 
+            # ensure_vnc_server serializes the check+spawn+wait per user (so the
+            # two websockets the BBB plugin sends per page load can't double-spawn)
+            # and retries a failed spawn with jitter, bounded in time, always
+            # releasing the lock.  See its docstring for the full rationale.
+            # Teachers' desktops go to the front of the spawn queue.
+            if teacher_mode or attendee.get('role') == 'MODERATOR':
+                priority = PRIORITY_TEACHER
+            else:
+                priority = PRIORITY_STUDENT
+            try:
+                ensure_vnc_server(UNIXuser, rfbpath, metrics=metrics, priority=priority)
+            except SpawnQueueTimeout as ex:
+                request_spawn(userID)
+                return ('reject', str(ex))
+
             # Finally, start a dynamic VNC server running 'vnc_function'
 
             if teacher_mode:
@@ -432,36 +614,17 @@ def new_websocket_client(self):
             else:
                 vnc_function='student_desktop'
 
-            # The "socat" is needed because websockify currently can't handle a pipe.
-            # It needs to be modified so that it can operate like "inetd".
+            # The server runs in -inetd mode on the connection itself (see launch_inetd,
+            # and _session_argv in privileged.py for its command line).
             #
             # We add group bigbluebutton to allow the student desktop to execute screen shares,
             # not to allow the students direct accesss to that group.
-            socket_fn = tempfile.mktemp()
-            env = os.environ
-            env['UserId'] = userID
-            env['MeetingId'] = meetingID
-            env['fullName'] = fullName
-            # isn't this available as $USER?
-            env['UNIXuser'] = UNIXuser
-            # -blank-name forces an empty RFB desktop name at spawn. Without it,
-            # tigervncserver's stock default ("<HOSTFQDN>:<display> (<USER>)")
-            # rides in the RFB ServerInit the client reads on connect, so the
-            # moderator user list briefly flashes e.g. "itpietraining.com:29
-            # (SamuelRodriguez)" before student_desktop.py blanks it a beat
-            # later. We use a dedicated no-argument flag (not -name "") because
-            # this command is word-split by socat's EXEC: address, which cannot
-            # carry an empty or whitespace-containing argument token.
-            command = "python3 -m vnc_collaborate tigervncserver -quiet -fg -localhost yes -SecurityTypes None -I-KNOW-THIS-IS-INSECURE -blank-name -inetd -xstartup python3 -- -m vnc_collaborate {}".format(vnc_function)
-            sudo_command = ["sudo", "-u", UNIXuser]
-            if bigbluebutton_group_exists:
-                sudo_command.extend(["-g", "bigbluebutton"])
-            sudo_command.extend(["-i", "--preserve-env=UserId", "--preserve-env=MeetingId", "--preserve-env=fullName", "--preserve-env=UNIXuser",
-                                 "socat", "UNIX-LISTEN:" + socket_fn + ",mode=666", "EXEC:" + command])
-            subprocess.Popen(sudo_command, env=env)
-            while not os.path.exists(socket_fn):
-                time.sleep(0.1)
-            self.server.unix_target = socket_fn
+            #
+            # Its display number is reserved too (see displays.py); launch_inetd
+            # releases the reservation once the server has its own X lock file.
+            display = reserve_display()
+            group = 'bigbluebutton' if bigbluebutton_group_exists else None
+            return ('inetd', UNIXuser, vnc_function, env, group, display)
 
     else:
 
@@ -476,12 +639,66 @@ def new_websocket_client(self):
         # Same serialized + bounded + retried spawn as the student/teacher path.
         # The lock is keyed on the meeting's socket (basename of rfbpath), so the
         # screenshare desktops of different meetings don't serialize against each
-        # other; viewOnly keeps this desktop input-free.
-        ensure_vnc_server(UNIXuser, rfbpath, viewOnly=True)
-        self.server.unix_target = rfbpath
+        # other; viewOnly keeps this desktop input-free.  Everybody in the
+        # meeting is looking at it, so it goes to the front of the spawn queue.
+        try:
+            ensure_vnc_server(UNIXuser, rfbpath, viewOnly=True, metrics=metrics, priority=PRIORITY_TEACHER)
+        except SpawnQueueTimeout as ex:
+            request_spawn(userID)
+            return ('reject', str(ex))
+        return ('unix', rfbpath)
 
-    # pass through to the "parent" class's version of this method
-    old_new_websocket_client(self)
+
+def _connect_target(self, target):
+    r"""
+    Return a socket connected to the ('tcp', ...), ('unix', ...) or
+    ('inetd', ...) `target` chosen by select_target.
+    """
+    if target[0] == 'inetd':
+        self.log_message("starting inetd server for %s: %s", target[1], target[2])
+        return launch_inetd(*target[1:])
+    try:
+        if target[0] == 'tcp':
+            self.log_message("connecting to: %s:%s", target[1], target[2])
+            tsock = socket.create_connection((target[1], target[2]))
+            tsock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.log_message("connecting to unix socket: %s", target[1])
+            tsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            tsock.connect(target[1])
+    except OSError as e:
+        self.log_message("Failed to connect to %s: %s", target[1], e)
+        raise self.CClose(1011, "Failed to connect to downstream server")
+    return tsock
+
+def new_websocket_client(self):
+
+    # We connect to the target ourselves rather than pass it through to
+    # websockify's version of this method, so that every kind of target
+    # (including the inetd servers and rejections) is relayed the same way,
+    # and the relay is counted in the connection's metrics (see metrics.py).
+
+    metrics = ConnectionMetrics()
+    outcome = 'failed'
+    try:
+        target = select_target(self.path, self.headers.get('Cookie', ''), metrics)
+
+        if target[0] == 'reject':
+            # Refuse at the RFB layer with a security-failure reason, which the
+            # remote-desktop plugin shows on its connection-error overlay (rather
+            # than a blank panel).  The handshake runs in a thread on one end of
+            # a socketpair, and we relay the other end like any VNC server.
+            outcome = 'rejected'
+            (ours, theirs) = socket.socketpair()
+            threading.Thread(target=reject_socket, args=(theirs, target[1]), daemon=True).start()
+            _proxy_to_socket(self, ours, metrics)
+        else:
+            with metrics.phase('connect'):
+                tsock = _connect_target(self, target)
+            outcome = 'relayed'
+            _proxy_to_socket(self, tsock, metrics)
+    finally:
+        metrics.finish(outcome)
 
 ProxyRequestHandler.new_websocket_client = new_websocket_client
 
@@ -489,6 +706,27 @@ def websockify():
     if sys.argv[0] != 'websockify':
         sys.argv.pop(0)
 
+    # --async selects the asyncio front end (async_websockify.py), which
+    # handles every connection as a coroutine instead of forking a process
+    # per connection.  It takes the same listen/target arguments.
+    if '--async' in sys.argv:
+        sys.argv.remove('--async')
+        from .async_websockify import async_websockify
+        return async_websockify(sys.argv[1:])
+
+    # One roster cache for all of the per-connection handlers (see lookup_attendee)
+    bigbluebutton_roster.start_roster_service()
+    # Look up adduser's version once, here, rather than in each forked handler
+    # that creates a user (see provision.py)
+    adduser_version()
+    start_warm_pool()
+    start_prewarm_service()
+    start_metrics_service()
+    start_helper_service()
+    start_freezer()
+    start_budget_keeper()
+    start_thumbnail_service()
+
     # BigBlueButton 2.7 (or maybe 2.6) introduced the use of haproxy with a 60 second timeout.
     # Fortunately, the Python websockify library has a --heartbeat option that will keep the connection alive
     #    by sending something every 30 seconds.
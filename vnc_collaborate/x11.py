@@ -0,0 +1,353 @@
+#
+# The teacher's X display, from inside the process.
+#
+# teacher_desktop used to drive its display by forking helpers for
+# everything: `xprop -root` several times a second to find out what the
+# teacher had picked from the fvwm menus (the collaborate_display_mode,
+# max_rows, max_cols, page_number, grid_* root window properties),
+# `xdotool getdisplaygeometry` once a second for the screen size (which
+# "Set Geometry" changes), an `xdotool search ... windowmove` for every
+# thumbnail that moved in the grid, `xdotool get_desktop`, `set_desktop`,
+# `key` and `windowkill` to switch between the grid and the teacher's own
+# desktop, and `xsetroot`.  Waiting for a window to appear was fifty
+# `xdotool search`es 100 ms apart, and waiting for one to go away was a
+# fixed half-second sleep.
+#
+# X11 is instead one persistent connection (python-xlib) to the display,
+# that does all of that with requests on the connection.  Its waits
+# select SubstructureNotify on the root window for their duration, so
+# that they wake up when a window is mapped, unmapped or destroyed (or,
+# with PropertyChange, when the window manager changes a root window
+# property), and check again.
+#
+# RootWatcher is an X11 connection that also keeps the root window's
+# properties and size: a property is read from the server once, and then
+# from a cache until a PropertyNotify says it changed, and the size is
+# read again on RandR screen change (and root ConfigureNotify) events.
+# The connection's fileno() can go in a select() with everything else
+# that the teacher's main loop waits for, and process_events() says
+# whether anything it cares about has changed.
+#
+# A python-xlib connection isn't shared between threads, so each thread
+# that drives the display has its own X11.
+#
+# python-xlib is imported when an X11 is created, so that just
+# importing this module (which `import vnc_collaborate` does) doesn't
+# need it.
+
+import re
+import time
+import select
+
+class X11:
+    r"""
+    A connection to the X display `display_name` (default $DISPLAY),
+    selecting `event_mask` events on its root window.
+    """
+
+    def __init__(self, display_name=None, event_mask=0):
+        import Xlib.X
+        import Xlib.XK
+        import Xlib.error
+        import Xlib.display
+        import Xlib.protocol.event
+
+        self.X = Xlib.X
+        self.XK = Xlib.XK
+        self.XError = Xlib.error.XError
+        self.ClientMessage = Xlib.protocol.event.ClientMessage
+        self.display = Xlib.display.Display(display_name)
+        self.root = self.display.screen().root
+        self.event_mask = event_mask
+        self.root.change_attributes(event_mask=event_mask)
+        self.display.flush()
+        self.interned = dict()
+
+    def fileno(self):
+        return self.display.fileno()
+
+    def close(self):
+        self.display.close()
+
+    def _ignore_error(self, *args):
+        # a window can go away between our finding it and asking
+        # something of it
+        pass
+
+    def atom(self, name):
+        if name not in self.interned:
+            self.interned[name] = self.display.intern_atom(name)
+        return self.interned[name]
+
+    def _read_property(self, window, name):
+        r"""
+        The value of `window`'s property `name`: a string for string
+        properties, a list of numbers for others, or None if it isn't set
+        (or the window is gone).
+        """
+        try:
+            prop = window.get_full_property(self.atom(name), self.X.AnyPropertyType)
+        except self.XError:
+            return None
+        if prop is None:
+            return None
+        if isinstance(prop.value, bytes):
+            return prop.value.decode(errors='replace')
+        if isinstance(prop.value, str):
+            return prop.value
+        return list(prop.value)
+
+    def _handle(self, event):
+        r"""
+        Called with every event that arrives on the connection.
+        """
+        if event.type == self.X.MappingNotify:
+            # xmodmap, say (teacher_desktop maps F13-F24)
+            self.display.refresh_keyboard_mapping(event)
+
+    def _dispatch(self):
+        r"""
+        Handle the events that have arrived, without waiting for any.
+        """
+        while self.display.pending_events():
+            self._handle(self.display.next_event())
+
+    def wait_for(self, predicate, timeout):
+        r"""
+        Call `predicate` until it returns something true, which we
+        return, or until `timeout` seconds go by, when we return whatever
+        it last returned.  It's called again whenever a window is mapped,
+        unmapped, destroyed or reparented, or a root window property
+        changes.
+        """
+        self.root.change_attributes(event_mask=self.event_mask | self.X.SubstructureNotifyMask |
+                                    self.X.PropertyChangeMask)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                # events that arrive while predicate() waits for its
+                # replies get queued, so handle them before it runs, not
+                # after: whatever they say, predicate() has already seen
+                self._dispatch()
+                result = predicate()
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return result
+                try:
+                    select.select([self.display], [], [], remaining)
+                except InterruptedError:
+                    pass
+        finally:
+            self.root.change_attributes(event_mask=self.event_mask)
+            self.display.flush()
+
+    #
+    # Windows
+    #
+
+    def window_name(self, window):
+        name = self._read_property(window, '_NET_WM_NAME')
+        if name is None:
+            name = self._read_property(window, 'WM_NAME')
+        return name if isinstance(name, str) else None
+
+    def search(self, name_regex, desktop=None):
+        r"""
+        The windows whose names match `name_regex` (case insensitive, like
+        `xdotool search --name`), and are on virtual desktop `desktop`,
+        if it's not None.
+        """
+        regex = re.compile(name_regex, re.IGNORECASE)
+        found = []
+        stack = [self.root]
+        while stack:
+            try:
+                children = stack.pop().query_tree().children
+            except self.XError:
+                continue
+            for window in children:
+                stack.append(window)
+                name = self.window_name(window)
+                if name is None or not regex.search(name):
+                    continue
+                if desktop is not None and self._read_property(window, '_NET_WM_DESKTOP') != [desktop]:
+                    continue
+                found.append(window)
+        return found
+
+    def wait_for_window(self, name_regex, desktop=None, timeout=5):
+        r"""
+        Wait (up to `timeout` seconds) for a window matching
+        `name_regex` to appear on `desktop`, and return them all (or [] if
+        none did).
+        """
+        return self.wait_for(lambda: self.search(name_regex, desktop), timeout)
+
+    def viewable(self, window):
+        r"""
+        Whether `window` is mapped, and so are its ancestors (so it's on
+        the current virtual desktop).
+        """
+        try:
+            return window.get_attributes().map_state == self.X.IsViewable
+        except self.XError:
+            return False
+
+    def move(self, window, x, y):
+        # the window manager gets this as a ConfigureRequest, and moves
+        # the window's frame
+        window.configure(x=int(x), y=int(y), onerror=self._ignore_error)
+
+    def move_windows(self, name_regex, x, y):
+        for window in self.search(name_regex):
+            self.move(window, x, y)
+        self.display.flush()
+
+    def kill(self, window):
+        r"""
+        Disconnect the client that created `window`, like `xdotool
+        windowkill` (XKillClient).
+        """
+        window.kill_client(onerror=self._ignore_error)
+
+    def kill_windows(self, name_regex, desktop=None, timeout=2):
+        r"""
+        Kill the clients with windows matching `name_regex` on `desktop`,
+        and wait (up to `timeout` seconds) for their windows to go away.
+        """
+        windows = self.search(name_regex, desktop)
+        for window in windows:
+            self.kill(window)
+        if windows:
+            self.display.flush()
+            self.wait_for(lambda: not self.search(name_regex, desktop), timeout)
+
+    #
+    # The window manager's virtual desktops, and the keyboard
+    #
+
+    def get_desktop(self):
+        r"""
+        The number of the virtual desktop we're on, or None if the window
+        manager doesn't say.
+        """
+        value = self._read_property(self.root, '_NET_CURRENT_DESKTOP')
+        return value[0] if value else None
+
+    def set_desktop(self, desktop):
+        event = self.ClientMessage(window=self.root, client_type=self.atom('_NET_CURRENT_DESKTOP'),
+                                   data=(32, [desktop, self.X.CurrentTime, 0, 0, 0]))
+        self.root.send_event(event, event_mask=self.X.SubstructureRedirectMask | self.X.SubstructureNotifyMask)
+        self.display.flush()
+
+    def window_manager(self):
+        r"""
+        An identifier for the running window manager (its EWMH check
+        window), or None if there isn't one.
+        """
+        value = self._read_property(self.root, '_NET_SUPPORTING_WM_CHECK')
+        return value[0] if value else None
+
+    def wait_for_window_manager(self, old, timeout=2):
+        r"""
+        Wait (up to `timeout` seconds) for a window manager other than
+        `old` (a window_manager()) to start.
+        """
+        return self.wait_for(lambda: self.window_manager() not in (None, old), timeout)
+
+    def key(self, keysym_name):
+        r"""
+        Press and release a key, like `xdotool key`.  Returns False if
+        we can't, because the server has no XTEST or the key isn't mapped.
+        """
+        if not self.display.has_extension('XTEST'):
+            return False
+        from Xlib.ext import xtest
+        keycode = self.display.keysym_to_keycode(self.XK.string_to_keysym(keysym_name))
+        if not keycode:
+            return False
+        xtest.fake_input(self.display, self.X.KeyPress, keycode)
+        xtest.fake_input(self.display, self.X.KeyRelease, keycode)
+        self.display.sync()
+        return True
+
+    def set_background(self, color):
+        r"""
+        Set the root window's background to `color`, like `xsetroot -solid`.
+        """
+        colormap = self.display.screen().default_colormap
+        pixel = colormap.alloc_named_color(color).pixel
+        self.root.change_attributes(background_pixel=pixel)
+        self.root.clear_area()
+        self.display.sync()
+
+class RootWatcher(X11):
+    r"""
+    An X11 connection that also watches its root window's properties and
+    size.
+    """
+
+    def __init__(self, display_name=None):
+        import Xlib.X
+        super().__init__(display_name, Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask)
+        if self.display.has_extension('RANDR'):
+            import Xlib.ext.randr
+            self.root.xrandr_select_input(Xlib.ext.randr.RRScreenChangeNotifyMask)
+            self.display.flush()
+
+        # atom -> name, for the properties somebody asked about, and
+        # name -> value (None if it isn't set) for the ones we've read
+        self.atoms = dict()
+        self.properties = dict()
+        self.size = self._query_size()
+        self.changed = False
+
+    def _query_size(self):
+        geometry = self.root.get_geometry()
+        return (geometry.width, geometry.height)
+
+    def get_property(self, name, default=None):
+        r"""
+        The value of the root window's string property `name`, or
+        `default` if it isn't set.
+        """
+        if name not in self.properties:
+            self.atoms[self.atom(name)] = name
+            value = self._read_property(self.root, name)
+            if isinstance(value, list):
+                value = ' '.join(str(v) for v in value)
+            self.properties[name] = value
+        value = self.properties[name]
+        return default if value is None else value
+
+    def screen_size(self):
+        r"""
+        The root window's (width, height).
+        """
+        return self.size
+
+    def _handle(self, event):
+        super()._handle(event)
+        if event.type == self.X.PropertyNotify:
+            if event.window == self.root and event.atom in self.atoms:
+                self.properties.pop(self.atoms[event.atom], None)
+                self.changed = True
+        elif event.type == self.X.ConfigureNotify and event.window == self.root or \
+             event.type >= self.X.LASTEvent:
+            # the root window, or a RandR ScreenChangeNotify: has the
+            # screen changed size?
+            size = self._query_size()
+            if size != self.size:
+                self.size = size
+                self.changed = True
+
+    def process_events(self):
+        r"""
+        Handle the events that have arrived, without waiting for any.
+        Returns True if a property that somebody has asked about, or the
+        screen size, changed since the last time.
+        """
+        self._dispatch()
+        changed = self.changed
+        self.changed = False
+        return changed